@@ -5,112 +5,527 @@
 from utilities import *
 setup_django()
 from tqdm import tqdm
+import json
+import time
+import hashlib
+import argparse
+import functools
 import traceback
-from django.db import transaction
-from core.models import Pdb
+from contextlib import ExitStack
+from collections import Counter, deque
+from atomium.utilities import parse_string
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from django.db import transaction, connections
+from core.models import *
 from django.conf import settings
 if not settings.DEBUG: tqdm = lambda l: l
 
-def process_pdb_code(code):
-    """Builds all the relevant objects for any given PDB code."""
+PRUNE_TOLERANCE = 0.05
 
-    from factories import create_pdb_record, create_metal_record
-    from factories import create_chain_record, create_site_record
+BULK_LOAD_MODELS = [
+ Pdb, Chain, ZincSite, Metal, ChainInteraction, Residue, Atom,
+ CoordinateBond, StabilisingBond
+]
+
+def describe_pdb_code(code, filestring=None, revision=None, cache=False,
+                      offline=False, profile=None):
+    """Fetches a PDB and works out everything that needs to be saved for it,
+    returning it as a plain, picklable description. No database access is
+    needed, so this can be run in a worker process. If the PDB's file has
+    already been downloaded, its filestring can be given instead.
+
+    If the local structure cache is to be used, the description will record
+    whether the structure was found in it, and only a cached copy of the
+    revision given will be used. If a profile is given, the time taken by each
+    stage is added to it."""
+
+    from descriptions import describe_pdb, describe_metal, describe_site
+    from cache import fetch_structure
+    from profiling import time_stage
 
     # Get PDB
     log(f"Fetching {code}")
-    pdb = atomium.fetch(code)
+    with time_stage(profile, "fetch"):
+        if cache or offline:
+            pdb, cache_status = fetch_structure(
+             code, revision=revision, offline=offline, filestring=filestring
+            )
+        elif filestring:
+            pdb, cache_status = parse_string(filestring, f"{code}.cif"), None
+        else:
+            pdb, cache_status = atomium.fetch(code), None
     log(f"Getting best {code} assembly")
-    model, assembly_id = get_best_model(pdb)
-    model.optimise_distances()
-    log(f"Saving {code} to database")
-    pdb_record = create_pdb_record(pdb, assembly_id)
+    with time_stage(profile, "assembly"):
+        model, assembly_id = get_best_model(pdb)
+        skeletons = get_skeleton_chains(pdb.model)
+    description = {
+     "pdb": describe_pdb(pdb, assembly_id, all(skeletons.values())),
+     "omitted_metals": [], "chains": [], "sites": [], "cache": cache_status
+    }
+    omitted = description["omitted_metals"]
 
     # Check model is usable
-    if model_is_skeleton(model):
+    if all(skeletons[chain._internal_id] for chain in model.chains()):
         for zinc in sorted(model.atoms(element="ZN"), key=lambda m: m.id):
-            create_metal_record(zinc, pdb_record,
-             omission="No side chain information in PDB."
-            )
-        return
+            omitted.append((
+             describe_metal(zinc), "No side chain information in PDB."
+            ))
+        return description
 
     # Save any zincs not in model
     for zinc in sorted(zincs_outside_model(model, pdb), key=lambda m: m.id):
-        create_metal_record(zinc, pdb_record,
-         omission="Zinc in asymmetric unit but not biological assembly."
-        )
+        omitted.append((
+         describe_metal(zinc),
+         "Zinc in asymmetric unit but not biological assembly."
+        ))
 
     # Get metals
     log(f"Finding {code} liganding atoms")
-    metals = remove_duplicate_atoms(model.atoms(is_metal=True))
+    with time_stage(profile, "liganding"):
+        index = create_spatial_index(model)
+        metals = list(remove_duplicate_atoms(model.atoms(is_metal=True)))
 
-    # Determine liganding atoms of all metals
-    metals = {m: get_atom_liganding_atoms(m) for m in metals}
+        # Determine liganding atoms of all metals
+        nearby = get_nearby_atoms(index, metals, 3)
+        metals = {
+         m: get_atom_liganding_atoms(m, n) for m, n in zip(metals, nearby)
+        }
 
-    # Ignore metals with too few liganding atoms
-    useless_metals = remove_salt_metals(metals)
+        # Ignore metals with too few liganding atoms
+        useless_metals = remove_salt_metals(metals)
     for metal in sorted(useless_metals, key=lambda m: m.id):
         if metal.element == "ZN":
-            create_metal_record(metal, pdb_record,
-             omission="Zinc has too few liganding atoms."
-            )
+            omitted.append((
+             describe_metal(metal), "Zinc has too few liganding atoms."
+            ))
 
     log(f"Processing {code} sites")
-    # Get list of binding site dicts from the metals dict
-    sites = [{"metals": {m: v}} for m, v in metals.items()]
+    with time_stage(profile, "merge"):
+        # Get list of binding site dicts from the metals dict
+        sites = [{"metals": {m: v}} for m, v in metals.items()]
 
-    # Merge those that share residues
-    merge_metal_groups(sites)
+        # Merge those that share residues
+        merge_metal_groups(sites)
 
-    # Remove sites with no zinc
-    sites = [site for site in sites if "ZN" in [
-     a.element for a in site["metals"].keys()
-    ]]
+        # Remove sites with no zinc
+        sites = [site for site in sites if "ZN" in [
+         a.element for a in site["metals"].keys()
+        ]]
 
-    # Sort sites to make ID allocation deterministic
-    sites.sort(key=lambda s: min(a.id for a in s["metals"].keys()))
+        # Sort sites to make ID allocation deterministic
+        sites.sort(key=lambda s: min(a.id for a in s["metals"].keys()))
 
-    # Add residues and chains to site dicts
-    for site in sites:
-        site["residues"] = get_site_residues(site)
-        site["chains"] = get_site_chains(site)
+        # Add residues and chains to site dicts
+        for site in sites:
+            site["residues"] = get_site_residues(site)
+            site["chains"] = get_site_chains(site)
     
-    # Create chains involved in all binding sites
+    # Describe chains involved in all binding sites
     log(f"Processing {code} chains")
-    chains, residues = get_all_chains(sites), get_all_residues(sites)
-    chains_dict = {}
-    for chain in chains:
-        sequence = get_chain_sequence(chain, residues)
-        chains_dict[chain.id] = create_chain_record(chain, pdb_record, sequence)
+    with time_stage(profile, "alignment"):
+        chains, residues = get_all_chains(sites), get_all_residues(sites)
+        for chain in sorted(chains, key=lambda c: c.id):
+            description["chains"].append({
+             "atomium_id": chain.id,
+             "sequence": get_chain_sequence(chain, residues)
+            })
     
-    # Save sites to database
-    for index, site in enumerate(sites, start=1):
+    # Describe sites
+    with time_stage(profile, "sites"):
+        description["sites"] = [describe_site(site, index) for site in sites]
+    return description
+
+
+def save_pdb_description(description):
+    """Saves a description produced by describe_pdb_code to the database."""
+
+    from factories import create_pdb_record, create_metal_record
+    from factories import create_chain_record, create_site_record
+
+    code = description["pdb"]["id"]
+    log(f"Saving {code} to database")
+    pdb_record = create_pdb_record(description["pdb"])
+    for metal, omission in description["omitted_metals"]:
+        create_metal_record(metal, pdb_record, omission=omission)
+    chains_dict = {}
+    for chain in description["chains"]:
+        chains_dict[chain["atomium_id"]] = create_chain_record(chain, pdb_record)
+    for index, site in enumerate(description["sites"], start=1):
         log(f"Saving {code} site")
-        site_record = create_site_record(site, pdb_record, index, chains_dict)
+        create_site_record(site, pdb_record, index, chains_dict)
+
+
+def process_pdb_code(code):
+    """Builds all the relevant objects for any given PDB code."""
+
+    save_pdb_description(describe_pdb_code(code))
+
+
+def describe_pdb_code_safely(code, filestring=None, error=None, profile=False,
+                             trace_memory=False, **kwargs):
+    """Describes a PDB code in a worker process. The code is returned with
+    either its description or, if it couldn't be processed (or couldn't be
+    prefetched), the traceback. If requested, a profile of the stage timings
+    and peak memory is added to the description - the memory can be traced
+    exactly, at the cost of slowing the stages down."""
+
+    from profiling import create_profile, measure_memory
+
+    if error: return code, None, error
+    profile = create_profile(code) if profile else None
+    try:
+        with measure_memory(profile, trace=trace_memory):
+            description = describe_pdb_code(
+             code, filestring, profile=profile, **kwargs
+            )
+        if profile: description["profile"] = profile
+        return code, description, None
+    except Exception as e:
+        return code, None, traceback.format_exc()
+
 
+def describe_pdb_codes(structures, workers=1, revisions=None, **kwargs):
+    """Takes an iterable of code, filestring, error tuples (where the
+    filestring and error are None unless the structure was prefetched) and
+    yields the code, description and error for each PDB in turn. The latest
+    known revision of each PDB can be given as a dictionary.
+
+    If more than one worker is requested, the PDBs are described in a pool of
+    processes, but are still yielded in the original order so that IDs are
+    allocated deterministically. Only a few PDBs per worker are handed out at
+    a time, so that the structures iterable is not consumed too far ahead.
+
+    If a worker dies (killed for using too much memory, say), the pool is
+    replaced and the PDB that was being waited on is tried again by itself -
+    if that kills its worker too, it is recorded as unprocessable. Any other
+    PDBs that were in the pool are handed to the new one."""
+
+    describe = functools.partial(describe_pdb_code_safely, **kwargs)
+    revisions = revisions or {}
+    if workers > 1:
+        connections.close_all()
+        submit = lambda executor, structure: executor.submit(
+         describe, *structure, revision=revisions.get(structure[0])
+        )
+        executor, pending = ProcessPoolExecutor(workers), deque()
+        try:
+            structures = iter(structures)
+            while True:
+                for structure in structures:
+                    pending.append((structure, submit(executor, structure)))
+                    if len(pending) >= workers * 2: break
+                if not pending: break
+                structure, future = pending.popleft()
+                try:
+                    yield future.result()
+                except BrokenProcessPool:
+                    executor.shutdown(wait=False)
+                    executor = ProcessPoolExecutor(workers)
+                    yield describe_in_own_process(structure, submit)
+                    pending = deque(
+                     (s, submit(executor, s)) for s, _ in pending
+                    )
+        finally:
+            executor.shutdown(wait=False)
+    else:
+        for structure in structures:
+            yield describe(*structure, revision=revisions.get(structure[0]))
+
+
+def describe_in_own_process(structure, submit):
+    """Describes a PDB in a process of its own, using the function given to
+    submit it, so that if the process dies it can only have been this PDB's
+    fault. The PDB is then returned with an error saying so."""
+
+    with ProcessPoolExecutor(1) as executor:
+        try:
+            return submit(executor, structure).result()
+        except BrokenProcessPool:
+            return structure[0], None, "Worker process died describing PDB"
+
+
+def get_description_hash(description):
+    """Hashes everything in a description that would be saved to the database,
+    so that a rebuilt PDB can be compared with what was saved last time."""
+
+    content = {
+     k: v for k, v in description.items() if k not in ("cache", "profile")
+    }
+    return hashlib.sha256(
+     json.dumps(content, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def save_pdb_descriptions(descriptions, unprocessable, revisions=None,
+                          bulk=False):
+    """Saves a batch of PDB descriptions to the database, recording any that
+    can't be saved in the unprocessable dictionary. In bulk mode the whole
+    batch is saved with bulk inserts in one transaction - if that fails, each
+    PDB is retried by itself so that only the bad ones are lost.
+
+    Any existing records for these PDBs are replaced in the same transaction,
+    unless the description is identical to the one they were built from, in
+    which case only the revision is updated. If this is called inside a larger
+    transaction, those transactions become savepoints, so a PDB that can't be
+    saved only rolls back its own records."""
+
+    from factories import create_records_in_bulk, create_build_state_record
+    from profiling import add_stage_time
+    revisions = revisions or {}
+    hashes = {d["pdb"]["id"]: get_description_hash(d) for d in descriptions}
+    states = BuildState.objects.in_bulk(list(hashes))
+    unchanged = set(code for code, content_hash in hashes.items()
+     if code in states and states[code].content_hash == content_hash)
+    for code in unchanged:
+        create_build_state_record(code, revisions.get(code), hashes[code])
+    descriptions = [d for d in descriptions if d["pdb"]["id"] not in unchanged]
+
+    def save(descriptions):
+        codes = [d["pdb"]["id"] for d in descriptions]
+        start = time.perf_counter()
+        with transaction.atomic():
+            Pdb.objects.filter(id__in=codes).delete()
+            if bulk:
+                create_records_in_bulk(descriptions)
+            else:
+                for description in descriptions:
+                    save_pdb_description(description)
+            for code in codes:
+                create_build_state_record(code, revisions.get(code), hashes[code])
+        add_stage_time(
+         [d.get("profile") for d in descriptions], "write",
+         time.perf_counter() - start
+        )
+
+    if bulk and len(descriptions) > 1:
+        try:
+            save(descriptions)
+            return
+        except Exception as e: pass
+    for description in descriptions:
+        try:
+            save([description])
+        except Exception as e:
+            unprocessable[description["pdb"]["id"]] = traceback.format_exc()
+
+
+def main(workers=1, bulk=0, defer_indexes=False, cache=False, offline=False,
+         cache_max_size=None, cache_max_age=None, prefetch=0, prefetch_queue=32,
+         profile=None, commit_every=0, commit_interval=None, force_prune=False,
+         trace_memory=False):
+    from factories import drop_secondary_indexes, create_indexes
+    from factories import create_build_state_records
+    from cache import get_cached_codes, get_cache_entry, is_cached
+    from cache import evict_structures
+    from prefetch import prefetch_structures
+    from chains import align_sequences
+    from profiling import write_profiles, summarise_profiles
+    from workqueue import reset_interrupted_codes, queue_codes
+    from workqueue import start_codes, finish_codes
 
-def main():
     log("\n\n\nSTARTING DATABASE BUILD")
+    align_sequences.cache_clear()
     # What PDBs have zinc in them?
-    codes = get_zinc_pdb_codes()
+    if offline:
+        cached_codes = set(get_cached_codes())
+        codes = get_saved_zinc_pdb_codes() or sorted(cached_codes)
+        codes = [code for code in codes if code in cached_codes]
+    else:
+        codes = get_zinc_pdb_codes()
     print(f"There are {len(codes)} PDB codes with zinc")
 
+    # What are their latest revisions?
+    if offline:
+        revisions = {code: get_cache_entry(code)["revision"] for code in codes}
+    else:
+        try:
+            revisions = get_pdb_revisions(codes)
+        except Exception as e:
+            print("Could not get revision dates - only new PDBs will be checked")
+            revisions = {}
+
     # How many should be checked
-    current_codes = Pdb.objects.all().values_list("id", flat=True)
-    codes_to_check = [code for code in codes if code not in current_codes]
-    print(f"{len(codes_to_check)} of these need to be checked")
+    all_codes, built_codes = set(codes), set(Pdb.objects.values_list("id", flat=True))
+    states = dict(BuildState.objects.values_list("id", "revision"))
+    # Those built before revisions were recorded are assumed to be up to date
+    adopted = {code: revisions[code] for code in built_codes - set(states)
+     if code in revisions}
+    create_build_state_records(adopted)
+    states.update(adopted)
+    new_codes = all_codes - built_codes
+    revised_codes = set(code for code in all_codes & built_codes
+     if code in revisions and revisions[code] != states.get(code))
+    codes_to_check = [c for c in codes if c in new_codes or c in revised_codes]
+    print(f"{len(codes_to_check)} of these need to be checked "
+     f"({len(new_codes)} new, {len(revised_codes)} revised)")
+
+    # Resume any interrupted build, and hold back PDBs which keep failing
+    interrupted = reset_interrupted_codes()
+    if interrupted: print(f"Resuming {interrupted} PDBs from an interrupted build")
+    queued_codes = queue_codes(codes_to_check, revisions)
+    if len(queued_codes) < len(codes_to_check):
+        print(f"Skipping {len(codes_to_check) - len(queued_codes)} PDBs "
+         "which failed recently")
+    codes_to_check = queued_codes
+
+    # Remove any that are no longer in the list - unless the list looks wrong
+    if not offline:
+        obsolete_codes = (built_codes | set(states)) - all_codes
+        if obsolete_codes and not force_prune and (not all_codes or
+         len(all_codes) < len(built_codes) * (1 - PRUNE_TOLERANCE)):
+            print(f"Not removing {len(obsolete_codes)} obsolete PDBs, as the "
+             "list of codes is much shorter than the PDBs already built - "
+             "use --force-prune to remove them anyway")
+        else:
+            with transaction.atomic():
+                Pdb.objects.filter(id__in=obsolete_codes).delete()
+                BuildState.objects.filter(id__in=obsolete_codes).delete()
+                queued = set(BuildQueueEntry.objects.values_list("id", flat=True))
+                BuildQueueEntry.objects.filter(
+                 id__in=obsolete_codes | (queued - all_codes)
+                ).delete()
+            if obsolete_codes:
+                log(f"Removed obsolete PDBs {', '.join(sorted(obsolete_codes))}")
+                print(f"Removed {len(obsolete_codes)} obsolete PDBs")
 
     # Check
-    unprocessable = {}
-    for code in tqdm(codes_to_check):
-        try:
-            with transaction.atomic(): process_pdb_code(code)
-        except Exception as e: unprocessable[code] = traceback.format_exc()
+    unprocessable, batch, cache_statuses = {}, [], Counter()
+    profiles, unwritten_profiles = [], []
+    commits, transaction_started, uncommitted = ExitStack(), None, 0
+
+    def save_batch(batch):
+        # Saves a batch, committing every so often if PDBs are grouped
+        nonlocal transaction_started, uncommitted, unwritten_profiles
+        if (commit_every or commit_interval) and transaction_started is None:
+            commits.enter_context(transaction.atomic())
+            transaction_started = time.time()
+        save_pdb_descriptions(batch, unprocessable, revisions, bulk=bool(bulk))
+        finish_codes([d["pdb"]["id"] for d in batch], unprocessable)
+        unwritten_profiles += [d["profile"] for d in batch if "profile" in d]
+        uncommitted += len(batch)
+        if transaction_started is not None and (
+         (commit_every and uncommitted >= commit_every) or (commit_interval
+          and time.time() - transaction_started >= commit_interval)):
+            commits.close()
+            transaction_started, uncommitted = None, 0
+
+    if prefetch and not offline:
+        structures = prefetch_structures(
+         codes_to_check, concurrency=prefetch, queue_size=prefetch_queue,
+         skip=(lambda code: is_cached(code, revisions.get(code))) if cache else None
+        )
+    else:
+        structures = ((code, None, None) for code in codes_to_check)
+    if defer_indexes: indexes = drop_secondary_indexes(BULK_LOAD_MODELS)
+    try:
+        with commits:
+            for code, description, error in tqdm(describe_pdb_codes(
+             start_codes(structures), workers, revisions, cache=cache,
+             offline=offline, profile=bool(profile),
+             trace_memory=trace_memory)):
+                if error:
+                    unprocessable[code] = error
+                    finish_codes([code], unprocessable)
+                else:
+                    batch.append(description)
+                    cache_statuses[description["cache"]] += 1
+                if len(batch) >= max(bulk, 1):
+                    save_batch(batch)
+                    batch = []
+                if profile and len(unwritten_profiles) >= 100:
+                    write_profiles(profile, unwritten_profiles)
+                    profiles += unwritten_profiles
+                    unwritten_profiles = []
+            save_batch(batch)
+    finally:
+        if profile:
+            write_profiles(profile, unwritten_profiles)
+            profiles += unwritten_profiles
+        if defer_indexes:
+            print("Recreating database indexes...")
+            create_indexes(indexes)
+    if cache or offline:
+        print("Structure cache: {} hits, {} raw hits, {} misses".format(
+         cache_statuses["hit"], cache_statuses["raw"], cache_statuses["miss"]
+        ))
+        if cache_max_size is not None or cache_max_age is not None:
+            evicted = evict_structures(cache_max_size, cache_max_age)
+            print(f"Evicted {evicted} structures from the cache")
+    if profile:
+        print(f"Stage timings written to {profile}")
+        for line in summarise_profiles(profiles): print(line)
     print("The following PDBs could not be processed:\n")
     start, end = "\033[91m", "\033[0m"
     for code in unprocessable: print(f"{code}\n{start}{unprocessable[code]}{end}")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+     "--workers", type=int, default=1,
+     help="number of processes to fetch and process PDBs with"
+    )
+    parser.add_argument(
+     "--bulk", type=int, default=0, metavar="N",
+     help="save PDBs to the database with bulk inserts, N PDBs at a time"
+    )
+    parser.add_argument(
+     "--defer-indexes", action="store_true",
+     help="drop secondary indexes while loading and recreate them at the end"
+    )
+    parser.add_argument(
+     "--cache", action="store_true",
+     help="keep fetched structures in a local cache and reuse them"
+    )
+    parser.add_argument(
+     "--offline", action="store_true",
+     help="only use structures already in the local cache"
+    )
+    parser.add_argument(
+     "--cache-max-size", type=float, metavar="MB",
+     help="evict least recently used structures beyond this cache size"
+    )
+    parser.add_argument(
+     "--cache-max-age", type=float, metavar="DAYS",
+     help="evict structures not used for this many days"
+    )
+    parser.add_argument(
+     "--prefetch", type=int, default=0, metavar="N",
+     help="download upcoming structures in the background, N at a time"
+    )
+    parser.add_argument(
+     "--prefetch-queue", type=int, default=32, metavar="N",
+     help="how many structures to download ahead of processing"
+    )
+    parser.add_argument(
+     "--profile", metavar="PATH",
+     help="write stage timings and peak memory of each PDB to a JSON lines file"
+    )
+    parser.add_argument(
+     "--trace-memory", action="store_true",
+     help="trace Python's memory use exactly when profiling - this slows the "
+     "build down, so its timings can't be compared with untraced ones"
+    )
+    parser.add_argument(
+     "--commit-every", type=int, default=0, metavar="N",
+     help="commit after every N PDBs instead of after each one"
+    )
+    parser.add_argument(
+     "--commit-interval", type=float, metavar="SECONDS",
+     help="commit at least this often instead of after each PDB"
+    )
+    parser.add_argument(
+     "--force-prune", action="store_true",
+     help="remove PDBs missing from the list of codes even if it looks too short"
+    )
+    args = parser.parse_args()
     print()
-    main()
+    main(
+     workers=args.workers, bulk=args.bulk, defer_indexes=args.defer_indexes,
+     cache=args.cache, offline=args.offline, cache_max_size=args.cache_max_size,
+     cache_max_age=args.cache_max_age, prefetch=args.prefetch,
+     prefetch_queue=args.prefetch_queue, profile=args.profile,
+     commit_every=args.commit_every, commit_interval=args.commit_interval,
+     force_prune=args.force_prune, trace_memory=args.trace_memory
+    )
     print()
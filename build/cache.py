@@ -0,0 +1,162 @@
+"""Contains functions for keeping a local cache of structure files, so that
+builds don't have to download and parse every structure again."""
+
+import os
+import gzip
+import json
+import time
+import pickle
+import hashlib
+import requests
+from atomium.mmcif import mmcif_string_to_mmcif_dict, mmcif_dict_to_data_dict
+from atomium.data import data_dict_to_file
+
+CACHE_LOCATION = os.path.join("data", "structures")
+STRUCTURE_URL = "https://files.rcsb.org/view/{}.cif"
+
+def fetch_structure(code, revision=None, offline=False, filestring=None):
+    """Gets an atomium File for a PDB code, going through the local cache. If a
+    revision is given, cached copies of any other revision are ignored. If the
+    file has already been downloaded, its filestring can be given to save it to
+    the cache without downloading it again.
+
+    The cache status is returned alongside the File - 'hit' if the parsed form
+    was loaded, 'raw' if only the raw file was cached and had to be parsed
+    again, and 'miss' if the structure had to be downloaded. When offline, a
+    miss raises an exception rather than going to the network."""
+
+    entry = get_cache_entry(code)
+    if entry and (revision is None or entry["revision"] == revision):
+        parsed_path, raw_path = get_object_paths(entry["hash"])
+        if os.path.exists(parsed_path):
+            with open(parsed_path, "rb") as f: data_dict = pickle.load(f)
+            status = "hit"
+        elif os.path.exists(raw_path):
+            with gzip.open(raw_path, "rt") as f: filestring = f.read()
+            data_dict = parse_structure(filestring, entry["hash"])[0]
+            status = "raw"
+        else:
+            entry = None
+        if entry:
+            entry["used"] = time.time()
+            save_cache_entry(entry)
+            return data_dict_to_file(data_dict, "cif"), status
+    if filestring is None:
+        if offline:
+            raise ValueError(f"{code} is not in the structure cache")
+        response = requests.get(STRUCTURE_URL.format(code.lower()))
+        if response.status_code != 200:
+            raise ValueError(f"Could not fetch {code}")
+        filestring = response.text
+    digest = hashlib.sha256(filestring.encode()).hexdigest()
+    raw_path = get_object_paths(digest)[1]
+    if not os.path.exists(raw_path):
+        with gzip.open(raw_path + ".tmp", "wt") as f: f.write(filestring)
+        os.replace(raw_path + ".tmp", raw_path)
+    data_dict, file_revision = parse_structure(filestring, digest)
+    save_cache_entry({
+     "code": code, "revision": revision or file_revision, "hash": digest,
+     "fetched": time.time(), "used": time.time()
+    })
+    return data_dict_to_file(data_dict, "cif"), "miss"
+
+
+def parse_structure(filestring, digest):
+    """Parses an mmCIF filestring as far as an atomium data dictionary, which
+    is pickled under the content hash given so that it can be loaded quickly
+    next time. The data dictionary and the file's latest revision date are
+    returned."""
+
+    mmcif_dict = mmcif_string_to_mmcif_dict(filestring)
+    history = mmcif_dict.get("pdbx_audit_revision_history", [])
+    dates = [h["revision_date"] for h in history if h.get("revision_date")]
+    data_dict = mmcif_dict_to_data_dict(mmcif_dict)
+    parsed_path = get_object_paths(digest)[0]
+    with open(parsed_path + ".tmp", "wb") as f:
+        pickle.dump(data_dict, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(parsed_path + ".tmp", parsed_path)
+    return data_dict, max(dates) if dates else None
+
+
+def get_object_paths(digest):
+    """Gets the locations of the parsed and raw forms of a structure with a
+    given content hash, creating the directory if needed."""
+
+    directory = os.path.join(CACHE_LOCATION, "objects")
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, digest)
+    return path + ".pickle", path + ".cif.gz"
+
+
+def get_cache_entry(code):
+    """Gets the cache entry for a PDB code, or None if it has never been
+    cached."""
+
+    try:
+        with open(os.path.join(CACHE_LOCATION, "entries", f"{code}.json")) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError): return None
+
+
+def save_cache_entry(entry):
+    """Saves a cache entry, which maps a PDB code to the content hash of the
+    revision of it that was last fetched. Each code has its own file so that
+    separate processes can update the cache at the same time."""
+
+    directory = os.path.join(CACHE_LOCATION, "entries")
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{entry['code']}.json")
+    with open(path + ".tmp", "w") as f: json.dump(entry, f)
+    os.replace(path + ".tmp", path)
+
+
+def is_cached(code, revision=None):
+    """Checks whether a PDB code has a cache entry, and if a revision is given,
+    whether it is for that revision."""
+
+    entry = get_cache_entry(code)
+    return bool(entry) and (revision is None or entry["revision"] == revision)
+
+
+def get_cached_codes():
+    """Gets the PDB codes which have a cache entry."""
+
+    try:
+        filenames = os.listdir(os.path.join(CACHE_LOCATION, "entries"))
+    except FileNotFoundError: return []
+    return sorted(f[:-5] for f in filenames if f.endswith(".json"))
+
+
+def evict_structures(max_size=None, max_age=None):
+    """Removes entries from the cache which were last used more than max_age
+    days ago, and then removes the least recently used entries until the cache
+    takes up no more than max_size megabytes. Stored objects that no entry
+    refers to any more are deleted. The number of entries removed is
+    returned."""
+
+    entries = [get_cache_entry(code) for code in get_cached_codes()]
+    entries = sorted([e for e in entries if e], key=lambda e: e["used"])
+    removed = []
+    if max_age is not None:
+        cutoff = time.time() - max_age * 86400
+        while entries and entries[0]["used"] < cutoff:
+            removed.append(entries.pop(0))
+    if max_size is not None:
+        sizes = {}
+        for entry in entries:
+            sizes[entry["hash"]] = sum(os.path.getsize(path) for path in
+             get_object_paths(entry["hash"]) if os.path.exists(path))
+        total = sum(sizes.values())
+        while entries and total > max_size * 1024 * 1024:
+            entry = entries.pop(0)
+            removed.append(entry)
+            if entry["hash"] not in [e["hash"] for e in entries]:
+                total -= sizes.pop(entry["hash"], 0)
+    for entry in removed:
+        os.remove(os.path.join(CACHE_LOCATION, "entries", f"{entry['code']}.json"))
+    directory = os.path.join(CACHE_LOCATION, "objects")
+    in_use = set(e["hash"] for e in entries)
+    for filename in os.listdir(directory) if os.path.exists(directory) else []:
+        if filename.split(".")[0] not in in_use:
+            os.remove(os.path.join(directory, filename))
+    return len(removed)
@@ -2,6 +2,10 @@
 
 import subprocess
 import re
+import io
+import hashlib
+from functools import lru_cache
+import numpy as np
 
 def get_all_chains(sites):
     """Takes a list of site dicts, and gets all chains with unique IDs."""
@@ -27,14 +31,16 @@ def get_chain_sequence(chain, residues):
     """Gets a chain's sequence as it should appear in the database - all
     lowercase but with certain residues (those given) in upper case."""
 
-    full = "".join(res.code for res in chain)
+    chain_residues = list(chain)
+    full = "".join(res.code for res in chain_residues)
     alignment = align_sequences(full, chain.sequence)
-    seq, indices, dash_count = "", [], 0
+    residue_ids = set(r.id for r in residues)
+    seq, indices, dash_count = "", set(), 0
     for i, char in enumerate(alignment[0]):
         if char == "-":
             dash_count += 1
-        elif chain[i - dash_count].id in [r.id for r in residues]:
-            indices.append(i)
+        elif chain_residues[i - dash_count].id in residue_ids:
+            indices.add(i)
     for i, char in enumerate(chain.sequence):
         seq += char.upper() if i in indices else char.lower()
     return seq
@@ -51,24 +57,34 @@ def match_score(alpha, beta, match_award, mismatch_penalty, gap_penalty):
         return mismatch_penalty
 
 
+@lru_cache(maxsize=4096)
 def align_sequences(seq1, seq2):
-    """Adapted from github.com/alevchuk/pairwise-alignment-in-python/"""
+    """Adapted from github.com/alevchuk/pairwise-alignment-in-python/
+
+    The score matrix is filled a row at a time with NumPy - within a row, the
+    best run of insertions ending at each cell is a running maximum. Results
+    are cached, as the same chains get aligned many times in a build."""
 
     match_award      = 10
     mismatch_penalty = -5
     gap_penalty      = -5
     m, n = len(seq1), len(seq2)
-    score = [[0 for y in range(n + 1)] for x in range(m + 1)]
-    for i in range(0, m + 1): score[i][0] = gap_penalty * i
-    for j in range(0, n + 1): score[0][j] = gap_penalty * j
+    score = np.zeros((m + 1, n + 1), dtype=np.int64)
+    score[:, 0] = gap_penalty * np.arange(m + 1)
+    score[0, :] = gap_penalty * np.arange(n + 1)
+    chars2 = np.array(list(seq2), dtype="U1")
+    gaps2 = chars2 == "-"
+    offsets = gap_penalty * np.arange(n + 1)
     for i in range(1, m + 1):
-        for j in range(1, n + 1):
-            match = score[i - 1][j - 1] + match_score(
-             seq1[i-1], seq2[j-1], match_award, mismatch_penalty, gap_penalty
-            )
-            delete = score[i - 1][j] + gap_penalty
-            insert = score[i][j - 1] + gap_penalty
-            score[i][j] = max(match, delete, insert)
+        substitution = np.where(chars2 == seq1[i - 1], match_award, np.where(
+         gaps2 | (seq1[i - 1] == "-"), gap_penalty, mismatch_penalty
+        ))
+        row = np.empty(n + 1, dtype=np.int64)
+        row[0] = score[i - 1][0] + gap_penalty
+        row[1:] = np.maximum(
+         score[i - 1, :-1] + substitution, score[i - 1, 1:] + gap_penalty
+        )
+        score[i] = np.maximum.accumulate(row - offsets) + offsets
     align1, align2 = "", ""
     i, j = m, n
     while i > 0 and j > 0:
@@ -106,14 +122,45 @@ def get_all_chains_fasta():
     """Gets the text of a FASTA file representing all chains in the database."""
 
     from core.models import Chain
-    lines = []
-    for chain in Chain.objects.all():
-        lines.append(">lcl|" + str(chain.id))
-        sequence = chain.sequence
-        while sequence:
-            lines.append(sequence[:80])
-            sequence = sequence[80:]
-    return "\n".join(lines)
+    f = io.StringIO()
+    write_chains_fasta(Chain.objects.values_list("id", "sequence").iterator(), f)
+    return f.getvalue()
+
+
+def get_chains_fasta(chains):
+    """Gets the text of a FASTA file representing the chains given."""
+
+    f = io.StringIO()
+    write_chains_fasta(((chain.id, chain.sequence) for chain in chains), f)
+    return f.getvalue()
+
+
+def save_all_chains_fasta(path):
+    """Saves a FASTA file representing all chains in the database. The chains
+    are streamed from the database and written as they arrive, rather than
+    all being loaded first. The SHA-256 digest of the file is returned."""
+
+    from core.models import Chain
+    with open(path, "w") as f:
+        return write_chains_fasta(
+         Chain.objects.values_list("id", "sequence").iterator(), f
+        )
+
+
+def write_chains_fasta(chains, f):
+    """Writes (chain ID, sequence) pairs to an open file in FASTA format, with
+    sequences wrapped at 80 characters, and returns the SHA-256 digest of what
+    was written."""
+
+    digest = hashlib.sha256()
+    for n, (id, sequence) in enumerate(chains):
+        lines = [f">lcl|{id}"] + [
+         sequence[i:i + 80] for i in range(0, len(sequence), 80)
+        ]
+        text = ("\n" if n else "") + "\n".join(lines)
+        f.write(text)
+        digest.update(text.encode())
+    return digest.hexdigest()
 
 
 def get_chain_clusters(sequence_identity):
@@ -129,3 +176,25 @@ def get_chain_clusters(sequence_identity):
     clusters = data.split(">Cluster ")[1:]
     clusters = [re.compile(r">(.+?)\.\.\.").findall(c) for c in clusters]
     return [[chain.split("|")[1] for chain in cluster] for cluster in clusters]
+
+
+def get_chain_assignments(sequence_identity):
+    """Uses the CD-Hit-2D binary to compare the chains in chains.fasta with the
+    cluster representatives in representatives.fasta, and returns a dict
+    which maps each chain similar enough to a representative to that
+    representative's ID."""
+
+    subprocess.call(
+     "cd-hit-2d -i representatives.fasta -i2 chains.fasta -d 0 -o temp2d -c {} "
+     "-n 5 -G 1 -g 1 -b 20 -s 0.0 -s2 0.0 -aL 0.0 -aS 0.0 -T 4 -M 32000".format(
+      sequence_identity
+     ), shell=True, stdout=subprocess.PIPE
+    )
+    with open("temp2d.clstr") as f: data = f.read()
+    assignments = {}
+    for cluster in data.split(">Cluster ")[1:]:
+        representative = re.compile(r">(.+?)\.\.\. \*").findall(cluster)
+        if not representative: continue
+        for chain in re.compile(r">(.+?)\.\.\. at").findall(cluster):
+            assignments[chain.split("|")[1]] = representative[0].split("|")[1]
+    return assignments
@@ -1,80 +1,228 @@
 #! /usr/bin/env python3
 
-"""This script will cluster chains and sites, after removing existing ones."""
+"""This script will cluster chains and sites, replacing existing ones. With
+--incremental, only new and changed chains are clustered."""
 
 import sys
 import os
+import argparse
+import multiprocessing
 from utilities import *
-from chains import get_all_chains_fasta, get_chain_clusters
-from sites import get_site_clusters, add_fingerprint_to_site
+from chains import save_all_chains_fasta, get_chains_fasta, get_chain_clusters
+from chains import get_chain_assignments
+from sites import get_site_clusters, add_fingerprints_to_sites
+from sites import get_group_information
 setup_django()
 from tqdm import tqdm
 from django.db import transaction
-from django.db.models import F
-from core.models import ChainCluster, Group, ZincSite, Chain
+from django.db.models import F, Q
+from core.models import ChainCluster, Group, ZincSite, Chain, Pdb
 from django.conf import settings
 if not settings.DEBUG: tqdm = lambda l: l
 
 SEQUENCE_IDENTITY = 0.9
+TEMPORARY_FILES = [
+ "chains.fasta", "temp", "temp.clstr", "representatives.fasta", "temp2d",
+ "temp2d.clstr"
+]
 
-def main():
-    from factories import create_chain_cluster_record, create_group_record
-
+def main(incremental=False, workers=1):
     # Check if CD-HIT is installed
     if not is_cd_hit_installed():
         print("Cannot proceed as CD-HIT is not installed or not in PATH")
         sys.exit()
 
     try:
+        if incremental:
+            cluster_incrementally(workers)
+        else:
+            cluster_everything(workers)
+    finally:
+        # Remove any temporary files saved
+        for filename in TEMPORARY_FILES:
+            try:
+                os.remove(filename)
+            except: pass
+
+
+def cluster_everything(workers=1):
+    """Clusters all chains and sites from scratch. The existing clusters and
+    groups are only replaced once the new ones are ready, in one transaction,
+    so that there is never a time when there are none."""
+
+    # Save temporary FASTA file
+    save_all_chains_fasta("chains.fasta")
+    size = os.path.getsize("chains.fasta")
+    print("Saved current chains to chains.fasta ({:.2f} KB)".format(size / 1024))
+
+    # Run CD-HIT
+    clusters = get_chain_clusters(SEQUENCE_IDENTITY)
+    print(f"Clustered chains into {len(clusters)} clusters ({SEQUENCE_IDENTITY * 100}% sequence identity)")
+
+    with transaction.atomic():
         # Remove any existing clusters and groups
-        clusters, groups = ChainCluster.objects.all(), Group.objects.all()
-        text = f"Deleted {clusters.count()} chain clusters and {groups.count()} site groups"
-        clusters.delete()
+        clusters_, groups = ChainCluster.objects.all(), Group.objects.all()
+        text = f"Deleted {clusters_.count()} chain clusters and {groups.count()} site groups"
+        clusters_.delete()
         groups.delete()
+        ZincSite.objects.filter(representative=True).update(representative=False)
         print(text)
 
-        # Save temporary FASTA file
-        fasta = get_all_chains_fasta()
-        with open("chains.fasta", "w") as f: f.write(fasta)
-        print("Saved current chains to chains.fasta ({:.2f} KB)".format(len(fasta) / 1024))
+        # Save clusters to database
+        save_chain_clusters(clusters)
+
+        # Cluster sites based on chain clusters
+        save_site_groups(ZincSite.objects.all(), workers=workers)
+
+
+def cluster_incrementally(workers=1):
+    """Clusters only the chains which aren't in a cluster. Each is compared with
+    the representatives of the existing clusters, and joins the cluster of
+    any it is similar enough to. The rest are clustered amongst themselves.
 
-        # Run CD-HIT
+    A cluster whose representative has gone (or been rebuilt) is broken up and
+    its chains are clustered again. Only sites on chains which have moved,
+    sites without a group, and sites in groups which have lost their
+    representative are then regrouped."""
+
+    # Which clusters are still intact?
+    representatives = Chain.objects.filter(cluster_id=F("id"))
+    broken = ChainCluster.objects.exclude(id__in=representatives.values("id"))
+    chains = list(Chain.objects.filter(
+     Q(cluster=None) | Q(cluster__in=broken.values("id"))
+    ))
+    print(f"{len(chains)} chains need clustering ({broken.count()} clusters broken up)")
+
+    # Compare them with the existing clusters' representatives
+    assignments = {}
+    if chains and representatives.exists():
+        with open("representatives.fasta", "w") as f:
+            f.write(get_chains_fasta(representatives.iterator()))
+        with open("chains.fasta", "w") as f: f.write(get_chains_fasta(chains))
+        assignments = get_chain_assignments(SEQUENCE_IDENTITY)
+    print(f"{len(assignments)} chains joined existing clusters")
+
+    # Cluster the rest amongst themselves
+    remaining = [chain for chain in chains if chain.id not in assignments]
+    clusters = []
+    if remaining:
+        with open("chains.fasta", "w") as f: f.write(get_chains_fasta(remaining))
         clusters = get_chain_clusters(SEQUENCE_IDENTITY)
-        print(f"Clustered chains into {len(clusters)} clusters ({SEQUENCE_IDENTITY * 100}% sequence identity)")
+    print(f"Clustered the others into {len(clusters)} new clusters")
 
-        # Save clusters to database
-        print("Saving these to the database...")
-        chain_dates = {chain.id: chain.date for chain in
-         Chain.objects.all().annotate(date=F("pdb__deposition_date"))}
-        with transaction.atomic():
-            for cluster in tqdm(clusters):
-                create_chain_cluster_record(cluster, chain_dates)
-        for chain in Chain.objects.filter(cluster=None):
-            create_chain_cluster_record([chain.id], chain_dates)
-        
-        # Cluster sites based on chain clusters
-        print("Clustering zinc sites based on associated chains...")
-        sites = ZincSite.objects.all().annotate(date=F("pdb__deposition_date"))
-        for site in tqdm(sites):
-            add_fingerprint_to_site(site)
-        site_clusters = get_site_clusters(sites)
-
-        # Save zinc site clusters to database
-        print("Saving these clusters to the database...")
-        with transaction.atomic():
-            for sites in tqdm(site_clusters.values()):
-                create_group_record(sites)
+    with transaction.atomic():
+        # Break up the broken clusters, leaving every moving chain unclustered
+        broken.delete()
+        moved = Chain.objects.filter(cluster=None)
 
-    finally:
-        # Remove any temporary files saved
-        for filename in ["chains.fasta", "temp", "temp.clstr"]:
-            try:
-                os.remove(filename)
-            except: pass
+        # Break up the groups of sites on those chains, and those which have
+        # lost their representative, leaving every site to regroup ungrouped
+        Group.objects.filter(
+         Q(zincsite__residue__chain__in=moved.values("id")) |
+         ~Q(id__in=ZincSite.objects.filter(group_id=F("id")).values("id"))
+        ).delete()
+
+        # Save the new clusters
+        for chain in chains:
+            chain.cluster_id = assignments.get(chain.id)
+        Chain.objects.bulk_update(
+         [chain for chain in chains if chain.cluster_id], ["cluster"],
+         batch_size=500
+        )
+        save_chain_clusters(clusters)
+
+        # Regroup the sites affected
+        sites = ZincSite.objects.filter(group=None)
+        print(f"Regrouping {sites.count()} zinc sites")
+        save_site_groups(sites, workers=workers)
+
+
+def save_chain_clusters(clusters):
+    """Saves chain clusters (lists of chain IDs) to the database, and then puts
+    every chain that is still without a cluster in a cluster of its own."""
+
+    from factories import create_chain_cluster_records
+
+    print("Saving these to the database...")
+    chain_dates = dict(Chain.objects.values_list("id", "pdb__deposition_date"))
+    create_chain_cluster_records(clusters, chain_dates)
+    create_chain_cluster_records([[id] for id in Chain.objects.filter(
+     cluster=None
+    ).values_list("id", flat=True)], chain_dates)
+
+
+def save_site_groups(sites, replaced_groups=None, workers=1):
+    """Groups zinc sites by their fingerprints and saves the groups to the
+    database. If other groups already exist, any sites with the same
+    fingerprint as one of them join it. The groups listed as being replaced
+    are deleted first."""
+
+    from factories import create_group_record
+
+    # Cluster sites based on chain clusters
+    print("Clustering zinc sites based on associated chains...")
+    site_clusters = get_site_clusters(add_fingerprints_to_sites(
+     sites.annotate(date=F("pdb__deposition_date"))
+    ))
+
+    # Which existing groups would new sites join?
+    Group.objects.filter(id__in=replaced_groups or []).delete()
+    joined_groups = {}
+    if Group.objects.exists():
+        representatives = add_fingerprints_to_sites(ZincSite.objects.filter(
+         representative=True, group__isnull=False
+        ).exclude(id__in=sites.values("id")).select_related("group"))
+        for site in representatives:
+            if site.fingerprint in site_clusters:
+                joined_groups[site.fingerprint] = site.group
+    for fingerprint, group in joined_groups.items():
+        members = group.zincsite_set.annotate(date=F("pdb__deposition_date"))
+        site_clusters[fingerprint] += list(members)
+        group.delete()
+    for sites in site_clusters.values():
+        for site in sites: site.representative = False
+
+    # Save zinc site clusters to database
+    print("Saving these clusters to the database...")
+    site_clusters = list(site_clusters.values())
+    information = get_groups_information(site_clusters, workers)
+    for sites, (keywords, classifications) in tqdm(list(zip(
+     site_clusters, information
+    ))):
+        create_group_record(sites, keywords, classifications)
+
+
+def get_groups_information(site_clusters, workers=1):
+    """Gets the keywords and classifications of each site cluster in a list.
+    The PDBs of every cluster are read from the database together first, and
+    if more than one worker is requested, the clusters are then processed in a
+    pool of processes."""
+
+    pdb_ids = set(site.pdb_id for sites in site_clusters for site in sites)
+    pdbs = {pdb.id: (pdb.classification, pdb.keywords, pdb.title) for pdb in
+     Pdb.objects.only("classification", "keywords", "title").in_bulk(
+      list(pdb_ids)
+     ).values()}
+    groups = [[pdbs[id] for id in sorted(set(site.pdb_id for site in sites))]
+     for sites in site_clusters]
+    if workers > 1:
+        with multiprocessing.Pool(workers) as pool:
+            return pool.map(get_group_information, groups, chunksize=100)
+    return [get_group_information(pdbs) for pdbs in groups]
 
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+     "--incremental", action="store_true",
+     help="only cluster new and changed chains, keeping the existing clusters"
+    )
+    parser.add_argument(
+     "--workers", type=int, default=1,
+     help="number of processes to work out the groups' keywords with"
+    )
+    args = parser.parse_args()
+    print()
+    main(incremental=args.incremental, workers=args.workers)
     print()
-    main()
-    print()
\ No newline at end of file
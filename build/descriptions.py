@@ -0,0 +1,129 @@
+"""Contains functions for turning atomium structures into plain, picklable
+descriptions which can be passed between processes and then saved."""
+
+import atomium
+from chains import get_chain_sequence
+from sites import create_site_family, get_nearby_atoms
+
+def split_residue_id(residue_id):
+    """Takes an atomium residue ID such as A.100B and returns the numeric
+    part and the insertion code - (100, "B") in this case."""
+
+    numeric_id, insertion = residue_id.split(".")[1], ""
+    while not numeric_id[-1].isdigit():
+        insertion += numeric_id[-1]
+        numeric_id = numeric_id[:-1]
+    return int(numeric_id), insertion
+
+
+def describe_pdb(pdb, assembly_id, skeleton):
+    """Describes the header information of an atomium File."""
+
+    return {
+     "id": pdb.code, "rvalue": pdb.rvalue, "classification": pdb.classification,
+     "deposition_date": pdb.deposition_date, "organism": pdb.source_organism,
+     "expression_system": pdb.expression_system, "technique": pdb.technique,
+     "keywords": ", ".join(pdb.keywords) if pdb.keywords else "",
+     "title": pdb.title, "resolution": pdb.resolution, "skeleton": skeleton,
+     "assembly": assembly_id
+    }
+
+
+def describe_metal(atom):
+    """Describes a metal atom, along with the het it belongs to."""
+
+    residue = atom.het
+    numeric_id, insertion = split_residue_id(residue.id)
+    x, y, z = atom.location
+    return {
+     "atomium_id": atom.id, "element": atom.element, "name": atom.name,
+     "x": x, "y": y, "z": z, "residue_number": numeric_id,
+     "insertion_code": insertion, "chain_id": atom.chain.id,
+     "residue_name": residue.name
+    }
+
+
+def describe_atom(atom, key):
+    """Describes an atom. The key is used to refer to the atom from bonds
+    within the same site."""
+
+    x, y, z = atom.location
+    return {
+     "key": key, "atomium_id": atom.id, "name": atom.name,
+     "x": x, "y": y, "z": z, "element": atom.element
+    }
+
+
+def describe_residue(residue, atom_keys, primary=True):
+    """Describes a residue and its atoms. Each atom is given a key from the
+    atom keys dictionary provided, which is updated as it goes."""
+
+    numeric_id, insertion = split_residue_id(residue.id)
+    signature, chain = [], None
+    if isinstance(residue, atomium.Residue):
+        if residue.previous: signature = [residue.previous.name.lower()]
+        signature.append(residue.name)
+        if residue.next: signature.append(residue.next.name.lower())
+        chain = residue.chain.id
+    atoms = []
+    for atom in sorted(residue.atoms(), key=lambda a: a.id):
+        atom_keys[atom] = len(atom_keys)
+        atoms.append(describe_atom(atom, atom_keys[atom]))
+    return {
+     "residue_number": numeric_id, "chain_identifier": residue.chain.id,
+     "insertion_code": insertion, "chain_signature": ".".join(signature),
+     "primary": primary, "name": residue.name, "atomium_id": residue.id,
+     "chain": chain, "atoms": atoms
+    }
+
+
+def describe_site(site, index=None):
+    """Describes a binding site dict (with metals, residues and chains) in full,
+    including its secondary residues and the bonds between atoms. If a spatial
+    index of the model is given, the atoms near each residue atom are found
+    with it in one batch."""
+
+    residue_names = sorted(set([f".{r.name}." for r in site["residues"]]))
+    metals = sorted(site["metals"].keys(), key=lambda m: m.id)
+    chains = sorted(site["chains"], key=lambda c: c.id)
+
+    # Primary residues
+    atom_keys, residues = {}, []
+    for res in sorted(site["residues"], key=lambda r: r.id):
+        residues.append(describe_residue(res, atom_keys))
+
+    # Secondary residues
+    second_residues, stabiliser_contacts = set(), set()
+    site_atoms = [atom for res in site["residues"] for atom in res.atoms()]
+    if index:
+        nearby = get_nearby_atoms(index, site_atoms, 3)
+    else:
+        nearby = [atom.nearby_atoms(3) for atom in site_atoms]
+    for atom, nearby_atoms in zip(site_atoms, nearby):
+        for nearby_atom in nearby_atoms:
+            if isinstance(nearby_atom.het, atomium.Residue)\
+             and nearby_atom.het not in site["residues"]:
+                second_residues.add(nearby_atom.het)
+                stabiliser_contacts.add((atom, nearby_atom))
+    for res in sorted(second_residues, key=lambda r: r.id):
+        residues.append(describe_residue(res, atom_keys, primary=False))
+
+    # Bonds
+    coordinate_bonds = []
+    for metal_index, metal in enumerate(metals):
+        for atom in sorted(site["metals"][metal], key=lambda a: a.id):
+            coordinate_bonds.append((metal_index, atom_keys[atom]))
+    stabilising_bonds = sorted([
+     (atom_keys[primary], atom_keys[secondary])
+     for primary, secondary in stabiliser_contacts
+    ])
+    return {
+     "family": create_site_family(site["residues"]),
+     "residue_names": "".join(residue_names),
+     "metals": [describe_metal(metal) for metal in metals],
+     "chain_interactions": [{
+      "chain": chain.id, "sequence": get_chain_sequence(chain, site["residues"])
+     } for chain in chains],
+     "residues": residues, "coordinate_bonds": coordinate_bonds,
+     "stabilising_bonds": stabilising_bonds
+    }
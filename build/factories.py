@@ -1,105 +1,66 @@
 """Contains functions for building objects in the database."""
 
+from django.db import connection, transaction
 from core.models import *
-from chains import get_chain_sequence
-from sites import get_group_information, create_site_family
-
-def create_pdb_record(pdb, assembly_id):
-    """Creates a Pdb record from an atomium File and an assembly ID."""
-
-    from utilities import model_is_skeleton
-    return Pdb.objects.create(
-     id=pdb.code, rvalue=pdb.rvalue, classification=pdb.classification,
-     deposition_date=pdb.deposition_date, organism=pdb.source_organism,
-     expression_system=pdb.expression_system, technique=pdb.technique,
-     keywords=", ".join(pdb.keywords) if pdb.keywords else "", title=pdb.title,
-     resolution=pdb.resolution, skeleton=model_is_skeleton(pdb.model),
-     assembly=assembly_id
-    )
 
+def create_pdb_record(pdb):
+    """Creates a Pdb record from a PDB description."""
+
+    return Pdb.objects.create(**pdb)
 
-def create_metal_record(atom, pdb_record, site_record=None, omission=None):
-    """Creates a Metal record. You specify a Pdb record, and optionally either
-    a Site record (if part of one) or a reason for omission (if not)."""
 
-    residue = atom.het
-    numeric_id, insertion = residue.id.split(".")[1], ""
-    while not numeric_id[-1].isdigit():
-        insertion += numeric_id[-1]
-        numeric_id = numeric_id[:-1]
-    numeric_id = int(numeric_id)
-    x, y, z = atom.location
+def create_metal_record(metal, pdb_record, site_record=None, omission=None):
+    """Creates a Metal record from a metal description. You specify a Pdb
+    record, and optionally either a Site record (if part of one) or a reason for
+    omission (if not)."""
+
     return Metal.objects.create(
-     atomium_id=atom.id, element=atom.element, name=atom.name, x=x, y=y, z=z, 
-     residue_number=numeric_id, insertion_code=insertion,
-     chain_id=atom.chain.id, residue_name=residue.name,
-     pdb=pdb_record, site=site_record, omission_reason=omission
+     **metal, pdb=pdb_record, site=site_record, omission_reason=omission
     )
 
 
-def create_chain_record(chain, pdb_record, sequence):
-    """Creates a Chain record from an atomium Chain, a Pdb record, and a
-    sequence."""
+def create_chain_record(chain, pdb_record):
+    """Creates a Chain record from a chain description and a Pdb record."""
 
     return Chain.objects.create(
-     id=f"{pdb_record.id}{chain.id}", pdb=pdb_record,
-     sequence=sequence, atomium_id=chain.id
+     id=f"{pdb_record.id}{chain['atomium_id']}", pdb=pdb_record,
+     sequence=chain["sequence"], atomium_id=chain["atomium_id"]
     )
 
 
 def create_site_record(site_dict, pdb_record, index, chains_dict):
-    """Creates a ZincSite record and all its sub-components from a dictionary
-    representing its metals, residues and chains. The ID will be created from
-    the index provided, and the chain information from the chain dictionary
-    provided."""
+    """Creates a ZincSite record and all its sub-components from a site
+    description. The ID will be created from the index provided, and the chain
+    information from the chain dictionary provided."""
 
     # Create site record itself
-    residue_names = set([f".{r.name}." for r in site_dict["residues"]])
-    residue_names = sorted(list(residue_names))
     site_record = ZincSite.objects.create(
-     id=f"{pdb_record.id}-{index}",
-     family=create_site_family(site_dict["residues"]), pdb=pdb_record,
-     residue_names="".join(residue_names)
+     id=f"{pdb_record.id}-{index}", family=site_dict["family"],
+     pdb=pdb_record, residue_names=site_dict["residue_names"]
     )
 
     # Create metals
-    metals_dict = {}
-    for metal in sorted(site_dict["metals"].keys(), key=lambda m: m.id):
-        metals_dict[metal.id] = create_metal_record(metal, pdb_record, site_record)
+    metal_records = [create_metal_record(metal, pdb_record, site_record)
+     for metal in site_dict["metals"]]
     
     # Create chain interactions
-    for chain in sorted(site_dict["chains"], key=lambda c: c.id):
-        sequence = get_chain_sequence(chain, site_dict["residues"])
+    for interaction in site_dict["chain_interactions"]:
         create_chain_interaction_record(
-         chains_dict[chain.id], site_record, sequence
+         chains_dict[interaction["chain"]], site_record, interaction["sequence"]
         )
     
     # Create residue records
     atoms_dict = {}
-    for res in sorted(site_dict["residues"], key=lambda r: r.id):
-        chain_record = chains_dict[res.chain.id] if isinstance(res, atomium.Residue) else None
+    for res in site_dict["residues"]:
+        chain_record = chains_dict[res["chain"]] if res["chain"] and res["primary"] else None
         create_residue_record(res, site_record, atoms_dict, chain_record)
     
-    # Add secondary residues
-    second_residues,  stabiliser_contacts = set(), set()
-    for residue in site_dict["residues"]:
-        for atom in residue.atoms():
-            nearby = atom.nearby_atoms(3)
-            for nearby_atom in nearby:
-                if isinstance(nearby_atom.het, atomium.Residue)\
-                 and nearby_atom.het not in site_dict["residues"]:
-                    second_residues.add(nearby_atom.het)
-                    stabiliser_contacts.add((atom, nearby_atom))
-    for res in second_residues:
-        create_residue_record(res, site_record, atoms_dict, primary=False)
-    
     # Create bond records
-    for metal, atoms in sorted(site_dict["metals"].items(), key=lambda a: a[0].id):
-        for atom in sorted(atoms, key=lambda a: a.id):
-            CoordinateBond.objects.create(
-             metal=metals_dict[metal.id], atom=atoms_dict[atom]
-            )
-    for primary, secondary in stabiliser_contacts:
+    for metal_index, atom_key in site_dict["coordinate_bonds"]:
+        CoordinateBond.objects.create(
+         metal=metal_records[metal_index], atom=atoms_dict[atom_key]
+        )
+    for primary, secondary in site_dict["stabilising_bonds"]:
         StabilisingBond.objects.create(
          primary_atom=atoms_dict[primary], secondary_atom=atoms_dict[secondary]
         )
@@ -114,60 +75,196 @@ def create_chain_interaction_record(chain_record, site_record, sequence):
     )
 
 
-def create_residue_record(residue, site_record, atoms_dict, chain_record=None, primary=True):
-    """Creates a Residue record along with its atoms, from information given. A
-    dictionary of atoms must be given to make coordinate bonds later."""
-
-    numeric_id, insertion = residue.id.split(".")[1], ""
-    while not numeric_id[-1].isdigit():
-        insertion += numeric_id[-1]
-        numeric_id = numeric_id[:-1]
-    numeric_id = int(numeric_id)
-    signature = []
-    if isinstance(residue, atomium.Residue):
-        if residue.previous: signature = [residue.previous.name.lower()]
-        signature.append(residue.name)
-        if residue.next: signature.append(residue.next.name.lower())
-    signature = ".".join(signature)
+def create_residue_record(residue, site_record, atoms_dict, chain_record=None):
+    """Creates a Residue record along with its atoms, from a residue
+    description. A dictionary of atoms must be given to make bonds later - it
+    will be updated with atom records by their keys."""
+
     residue_record = Residue.objects.create(
-     residue_number=numeric_id, chain_identifier=residue.chain.id,
-     insertion_code=insertion, chain_signature=signature, primary=primary,
-     name=residue.name, chain=chain_record, site=site_record, atomium_id=residue.id
+     residue_number=residue["residue_number"],
+     chain_identifier=residue["chain_identifier"],
+     insertion_code=residue["insertion_code"],
+     chain_signature=residue["chain_signature"], primary=residue["primary"],
+     name=residue["name"], chain=chain_record, site=site_record,
+     atomium_id=residue["atomium_id"]
     )
-    for atom in sorted(residue.atoms(), key=lambda a: a.id):
-        atoms_dict[atom] = create_atom_record(atom, residue_record)
+    for atom in residue["atoms"]:
+        atoms_dict[atom["key"]] = create_atom_record(atom, residue_record)
     return residue_record
 
 
 def create_atom_record(atom, residue_record):
-    """Creates an Atom record from the information provided."""
+    """Creates an Atom record from an atom description."""
 
-    x, y, z = atom.location
     return Atom.objects.create(
-     atomium_id=atom.id, name=atom.name, x=x, y=y, z=z,
-     element=atom.element, residue=residue_record
+     atomium_id=atom["atomium_id"], name=atom["name"], x=atom["x"],
+     y=atom["y"], z=atom["z"], element=atom["element"], residue=residue_record
     )
 
 
-def create_chain_cluster_record(chain_ids, dates):
-    """Creates a ChainCluster record from the information provided. All chains
-    will be updated as required."""
+def create_records_in_bulk(descriptions):
+    """Saves a batch of PDB descriptions to the database using bulk inserts,
+    one model at a time in dependency order, rather than one row at a time.
+    Foreign keys to auto-incremented records are resolved after each step."""
+
+    pdbs, chains, sites, metals, interactions = [], {}, [], [], []
+    for description in descriptions:
+        pdb = Pdb(**description["pdb"])
+        pdbs.append(pdb)
+        for metal, omission in description["omitted_metals"]:
+            metals.append(Metal(**metal, pdb=pdb, omission_reason=omission))
+        for chain in description["chains"]:
+            chains[(pdb.id, chain["atomium_id"])] = Chain(
+             id=f"{pdb.id}{chain['atomium_id']}", pdb=pdb,
+             sequence=chain["sequence"], atomium_id=chain["atomium_id"]
+            )
+        for index, site_dict in enumerate(description["sites"], start=1):
+            site = ZincSite(
+             id=f"{pdb.id}-{index}", family=site_dict["family"], pdb=pdb,
+             residue_names=site_dict["residue_names"]
+            )
+            site_metals = [Metal(**metal, pdb=pdb, site=site)
+             for metal in site_dict["metals"]]
+            metals += site_metals
+            sites.append((site, site_dict, site_metals))
+            for interaction in site_dict["chain_interactions"]:
+                interactions.append(ChainInteraction(
+                 chain=chains[(pdb.id, interaction["chain"])], site=site,
+                 sequence=interaction["sequence"]
+                ))
+    bulk_create_records(Pdb, pdbs)
+    bulk_create_records(Chain, chains.values())
+    bulk_create_records(ZincSite, [site[0] for site in sites])
+    bulk_create_records(Metal, metals)
+    bulk_create_records(ChainInteraction, interactions)
+
+    # Residues and then atoms need the IDs of the records before them
+    residues, atoms = [], []
+    for site, site_dict, _ in sites:
+        for res in site_dict["residues"]:
+            chain = chains[(site.pdb.id, res["chain"])]\
+             if res["chain"] and res["primary"] else None
+            residues.append((Residue(
+             residue_number=res["residue_number"],
+             chain_identifier=res["chain_identifier"],
+             insertion_code=res["insertion_code"],
+             chain_signature=res["chain_signature"], primary=res["primary"],
+             name=res["name"], chain=chain, site=site,
+             atomium_id=res["atomium_id"]
+            ), res["atoms"]))
+    bulk_create_records(Residue, [residue[0] for residue in residues])
+    for residue, atom_dicts in residues:
+        for atom in atom_dicts:
+            atoms.append(Atom(
+             atomium_id=atom["atomium_id"], name=atom["name"], x=atom["x"],
+             y=atom["y"], z=atom["z"], element=atom["element"], residue=residue
+            ))
+    bulk_create_records(Atom, atoms)
+
+    # Bonds refer to atoms by their key within the site
+    coordinate_bonds, stabilising_bonds, atoms = [], [], iter(atoms)
+    for site, site_dict, site_metals in sites:
+        atoms_dict = {}
+        for res in site_dict["residues"]:
+            for atom in res["atoms"]: atoms_dict[atom["key"]] = next(atoms)
+        for metal_index, atom_key in site_dict["coordinate_bonds"]:
+            coordinate_bonds.append(CoordinateBond(
+             metal=site_metals[metal_index], atom=atoms_dict[atom_key]
+            ))
+        for primary, secondary in site_dict["stabilising_bonds"]:
+            stabilising_bonds.append(StabilisingBond(
+             primary_atom=atoms_dict[primary], secondary_atom=atoms_dict[secondary]
+            ))
+    bulk_create_records(CoordinateBond, coordinate_bonds)
+    bulk_create_records(StabilisingBond, stabilising_bonds)
+
+
+def bulk_create_records(model, records):
+    """Inserts records with a single bulk insert (or as few as the database
+    allows). Not every database sends back the IDs of bulk inserted rows, so if
+    they are missing, the newest IDs are read back and assigned in insertion
+    order - this assumes nothing else is writing to the table at the time."""
+
+    records = list(records)
+    model.objects.bulk_create(records)
+    if records and records[0].pk is None:
+        ids = model.objects.order_by("-pk").values_list("pk", flat=True)
+        ids = reversed(list(ids[:len(records)]))
+        for record, id in zip(records, ids): record.pk = id
+
+
+def drop_secondary_indexes(models):
+    """Drops all non-unique indexes on the tables of the models given, so that
+    they don't need to be updated on every insert. The indexes are returned so
+    that they can be recreated later."""
+
+    indexes = []
+    with connection.cursor() as cursor:
+        for model in models:
+            table = model._meta.db_table
+            constraints = connection.introspection.get_constraints(cursor, table)
+            for name, constraint in sorted(constraints.items()):
+                if constraint["index"] and not constraint["unique"]\
+                 and not constraint["primary_key"]:
+                    indexes.append((name, table, constraint["columns"]))
+        for name, table, columns in indexes:
+            cursor.execute(f"DROP INDEX {connection.ops.quote_name(name)}")
+    return indexes
+
+
+def create_indexes(indexes):
+    """Recreates indexes previously dropped by drop_secondary_indexes."""
+
+    quote = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        for name, table, columns in indexes:
+            cursor.execute("CREATE INDEX {} ON {} ({})".format(
+             quote(name), quote(table), ", ".join(quote(c) for c in columns)
+            ))
+
+
+def create_build_state_record(code, revision, content_hash):
+    """Records the revision of a PDB that was last built, and the hash of its
+    contents, creating or updating its BuildState record."""
+
+    return BuildState.objects.update_or_create(id=code, defaults={
+     "revision": revision, "content_hash": content_hash
+    })[0]
+
+
+def create_build_state_records(revisions, batch_size=500):
+    """Creates BuildState records for PDBs that have none, from a dict of their
+    revisions, with bulk inserts in one transaction. They are assumed to be up
+    to date, so have no content hash."""
+
+    with transaction.atomic():
+        BuildState.objects.bulk_create([
+         BuildState(id=code, revision=revision, content_hash=None)
+         for code, revision in revisions.items()
+        ], batch_size=batch_size)
+
+
+def create_chain_cluster_records(clusters, dates, batch_size=500):
+    """Creates ChainCluster records from lists of chain IDs, in batches. Each
+    cluster's representative is its oldest chain, going by the dates given, and
+    each batch's chains are assigned to their clusters with one bulk update."""
 
-    dates = [dates[id] for id in chain_ids]
-    id = chain_ids[dates.index(min(dates))]
-    cluster_object = ChainCluster.objects.create(id=id)
-    for chain_id in chain_ids:
-        chain = Chain.objects.get(id=chain_id)
-        chain.cluster = cluster_object
-        chain.save()
+    for start in range(0, len(clusters), batch_size):
+        cluster_records, chains = [], []
+        for chain_ids in clusters[start:start + batch_size]:
+            chain_dates = [dates[id] for id in chain_ids]
+            id = chain_ids[chain_dates.index(min(chain_dates))]
+            cluster_records.append(ChainCluster(id=id))
+            chains += [Chain(id=chain_id, cluster_id=id) for chain_id in chain_ids]
+        ChainCluster.objects.bulk_create(cluster_records)
+        Chain.objects.bulk_update(chains, ["cluster"])
 
 
-def create_group_record(sites):
+def create_group_record(sites, keywords, classifications):
     """Creates a Group record from the information provided. All relevant sites
     will be updated."""
 
     oldest = sorted(sites, key=lambda s: s.date)[0]
-    keywords, classifications = get_group_information(sites)
     group = Group.objects.create(
      id=oldest.id, family=sites[0].family,
      keywords=keywords, classifications=classifications
@@ -1,20 +1,99 @@
 #! /usr/bin/env python3
 
-"""This script will create chains.fasta and associated BLAST files."""
+"""This script will create chains.fasta and associated BLAST files, and an
+index of the k-mers in each chain's sequence. Each version of the BLAST
+database is made in its own directory, named after a digest of the chains,
+and data/blastdb/current is then switched over to it - so nothing is rebuilt
+if the chains haven't changed, and blastp never sees a half-made database."""
 
-import sys
 import os
+import time
+import shutil
+import argparse
 import subprocess
 from utilities import setup_django
-from chains import get_all_chains_fasta
+from chains import save_all_chains_fasta
 setup_django()
+from core.models import Chain
+from core.kmers import create_kmer_index, save_kmer_index
 
-fasta = get_all_chains_fasta()
-with open("data/chains.fasta", "w") as f: f.write(fasta)
-print("Saved current chains to chains.fasta ({:.2f} KB)".format(len(fasta) / 1024))
+BLAST_LOCATION = os.path.join("data", "blastdb")
+KMER_INDEX_LOCATION = os.path.join("data", "chains.kmers.npz")
 
-print("Building BLAST database...\n")
-subprocess.call(
- "makeblastdb -in data/chains.fasta -dbtype prot",
- shell=True, stdout=subprocess.PIPE
-)
\ No newline at end of file
+def main(force=False):
+    # Save FASTA file to a staging directory
+    os.makedirs(BLAST_LOCATION, exist_ok=True)
+    staging = os.path.join(BLAST_LOCATION, "staging")
+    shutil.rmtree(staging, ignore_errors=True)
+    os.mkdir(staging)
+    fasta = os.path.join(staging, "chains.fasta")
+    digest = save_all_chains_fasta(fasta)[:16]
+    size = os.path.getsize(fasta)
+    print("Saved current chains to chains.fasta ({:.2f} KB)".format(size / 1024))
+
+    # Have the chains changed since last time?
+    previous = get_current_version()
+    if previous and previous.split("-")[0] == digest\
+     and os.path.exists(KMER_INDEX_LOCATION) and not force:
+        shutil.rmtree(staging)
+        print(f"Chains are unchanged - keeping BLAST database {previous}")
+        return
+
+    # Build the BLAST database and switch over to it
+    print("Building BLAST database...\n")
+    subprocess.run(
+     ["makeblastdb", "-in", fasta, "-dbtype", "prot"],
+     stdout=subprocess.PIPE, check=True
+    )
+    version = f"{digest}-{int(time.time())}"
+    os.rename(staging, os.path.join(BLAST_LOCATION, version))
+    switch_version(version)
+    remove_old_versions([version, previous])
+    print(f"Switched to BLAST database {version}")
+
+    print("Building k-mer index...\n")
+    index = create_kmer_index(Chain.objects.values_list("id", "sequence").iterator())
+    save_kmer_index(index, KMER_INDEX_LOCATION)
+
+
+def get_current_version():
+    """Gets the version of the BLAST database currently in use, if any."""
+
+    link = os.path.join(BLAST_LOCATION, "current")
+    if os.path.islink(link) and os.path.isdir(link):
+        return os.path.basename(os.readlink(link))
+
+
+def switch_version(version):
+    """Points data/blastdb/current at a version of the BLAST database. The new
+    link is made alongside the old one and renamed over it, so the switch is
+    atomic."""
+
+    link = os.path.join(BLAST_LOCATION, "current")
+    temporary = link + ".tmp"
+    if os.path.lexists(temporary): os.remove(temporary)
+    os.symlink(version, temporary)
+    os.replace(temporary, link)
+
+
+def remove_old_versions(keep):
+    """Deletes every version of the BLAST database except those given. The
+    one that was current before is kept, as blastp may still be reading it."""
+
+    for name in os.listdir(BLAST_LOCATION):
+        path = os.path.join(BLAST_LOCATION, name)
+        if name not in keep and os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+     "--force", action="store_true",
+     help="rebuild the BLAST database even if the chains haven't changed"
+    )
+    args = parser.parse_args()
+    print()
+    main(force=args.force)
+    print()
@@ -0,0 +1,83 @@
+"""Contains functions for downloading structure files ahead of time, so that
+network waits overlap with the processing of earlier structures."""
+
+import asyncio
+import threading
+import functools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import requests
+import cache
+
+def prefetch_structures(codes, concurrency=8, queue_size=32, retries=3,
+                        backoff=1, url=None, skip=None):
+    """Takes an iterable of PDB codes and yields the code, filestring and error
+    for each in the original order, while downloading upcoming structures in
+    the background.
+
+    At most concurrency downloads will be running at once, and no more than
+    queue_size structures will be fetched ahead of the one being yielded.
+    Failed downloads are retried with exponential backoff. Any code for which
+    skip(code) is true is yielded without a filestring, without being
+    downloaded. By default files are fetched from the RCSB, but any URL with a
+    {} placeholder for the code can be given."""
+
+    url = url or cache.STRUCTURE_URL
+    loop = asyncio.new_event_loop()
+    loop.set_default_executor(ThreadPoolExecutor(concurrency))
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    semaphore = asyncio.run_coroutine_threadsafe(
+     create_semaphore(concurrency), loop
+    ).result()
+    codes, pending = iter(codes), deque()
+
+    def queue_next():
+        for code in codes:
+            if skip and skip(code):
+                pending.append((code, None))
+            else:
+                pending.append((code, asyncio.run_coroutine_threadsafe(
+                 download_structure(code, semaphore, url, retries, backoff), loop
+                )))
+            return
+
+    try:
+        for _ in range(max(queue_size, 1)): queue_next()
+        while pending:
+            code, future = pending.popleft()
+            queue_next()
+            yield (code, *future.result()) if future else (code, None, None)
+    finally:
+        for code, future in pending:
+            if future: future.cancel()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+async def create_semaphore(value):
+    """Creates a semaphore inside the running event loop."""
+
+    return asyncio.Semaphore(value)
+
+
+async def download_structure(code, semaphore, url, retries, backoff):
+    """Downloads the file for a PDB code once the semaphore allows it, and
+    returns the filestring and error (one of which will be None). Server
+    errors and connection problems are retried, waiting twice as long each
+    time, but a 404 is not."""
+
+    loop = asyncio.get_event_loop()
+    get = functools.partial(requests.get, url.format(code.lower()), timeout=60)
+    async with semaphore:
+        for attempt in range(retries + 1):
+            try:
+                response = await loop.run_in_executor(None, get)
+                if response.status_code == 200: return response.text, None
+                error = f"Could not fetch {code} (status {response.status_code})"
+                if response.status_code == 404: return None, error
+            except requests.RequestException as e:
+                error = f"Could not fetch {code} ({e})"
+            if attempt < retries: await asyncio.sleep(backoff * 2 ** attempt)
+    return None, error
@@ -0,0 +1,111 @@
+"""Contains functions for timing the stages of a build and measuring how much
+memory each PDB needs, so that slow or pathological structures can be found."""
+
+import sys
+import json
+import time
+import resource
+import tracemalloc
+from contextlib import contextmanager
+
+def create_profile(code):
+    """Creates an empty profile for a PDB code, to which stage timings and the
+    peak memory can be added."""
+
+    return {"code": code, "stages": {}, "peak_memory": None, "traced": False}
+
+
+@contextmanager
+def time_stage(profile, stage):
+    """Times whatever is run inside it and adds the time, in seconds, to that
+    stage of a profile. If there is no profile, nothing is timed."""
+
+    if profile is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_stage_time([profile], stage, time.perf_counter() - start)
+
+
+@contextmanager
+def measure_memory(profile, trace=False):
+    """Records how much memory, in bytes, whatever is inside it needed. By
+    default this is how far it raised the process's peak resident set size,
+    which costs nothing to measure - but a PDB needing less than earlier PDBs
+    in the same process did will show as needing none.
+
+    If trace is True, the peak memory allocated by Python is traced instead.
+    This is exact, but slows everything inside it down several times, so
+    stage timings taken while tracing can't be compared with any others - the
+    profile records whether it was traced. If there is no profile, nothing is
+    measured."""
+
+    if profile is None or tracemalloc.is_tracing():
+        yield
+        return
+    if not trace:
+        start = get_peak_rss()
+        try:
+            yield
+        finally:
+            profile["peak_memory"] = get_peak_rss() - start
+        return
+    tracemalloc.start()
+    try:
+        yield
+    finally:
+        profile["peak_memory"] = tracemalloc.get_traced_memory()[1]
+        profile["traced"] = True
+        tracemalloc.stop()
+
+
+def get_peak_rss():
+    """Gets the peak resident set size of this process so far, in bytes."""
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def add_stage_time(profiles, stage, seconds):
+    """Shares a time equally between the given profiles (any that are None
+    are ignored) - this is how the time to save a batch of PDBs together is
+    attributed to each of them."""
+
+    profiles = [p for p in profiles if p is not None]
+    for profile in profiles:
+        stages = profile["stages"]
+        stages[stage] = stages.get(stage, 0) + seconds / len(profiles)
+
+
+def write_profiles(path, profiles):
+    """Appends profiles to a file as JSON lines, with their total times."""
+
+    with open(path, "a") as f:
+        for profile in profiles:
+            line = dict(profile, total=sum(profile["stages"].values()))
+            f.write(json.dumps(line, sort_keys=True) + "\n")
+
+
+def summarise_profiles(profiles, count=10):
+    """Produces a summary of the slowest and most memory-hungry PDBs from a
+    list of profiles, as a list of lines."""
+
+    total = lambda p: sum(p["stages"].values())
+    lines = [f"Slowest {count} PDBs:"]
+    if any(p.get("traced") for p in profiles):
+        lines[0] = f"Slowest {count} PDBs (slowed down by tracing memory):"
+    for profile in sorted(profiles, key=total, reverse=True)[:count]:
+        stages = ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in
+         sorted(profile["stages"].items(), key=lambda s: -s[1]))
+        lines.append(f"    {profile['code']}: {total(profile):.2f}s ({stages})")
+    lines.append(f"Most memory-hungry {count} PDBs:")
+    measured = [p for p in profiles if p["peak_memory"] is not None]
+    for profile in sorted(
+     measured, key=lambda p: p["peak_memory"], reverse=True
+    )[:count]:
+        megabytes = profile["peak_memory"] / 1024 / 1024
+        lines.append(f"    {profile['code']}: {megabytes:.1f} MB")
+    return lines
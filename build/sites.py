@@ -2,42 +2,78 @@
 
 import math
 from tqdm import tqdm
-from collections import Counter
-from itertools import combinations
+from collections import Counter, defaultdict
+from itertools import groupby
+import numpy as np
+from scipy.spatial import cKDTree
 import atomium
 from django.db.models import F
 
+def create_spatial_index(model):
+    """Creates a spatial index of every atom in a model - a KD-tree built over a
+    single NumPy array of their coordinates - so that many distance queries
+    can be answered at once."""
+
+    atoms = list(model.atoms())
+    coordinates = np.array([a.location for a in atoms], dtype=float)
+    coordinates = coordinates.reshape(-1, 3)
+    return {"atoms": atoms, "tree": cKDTree(coordinates)}
+
+
+def get_nearby_atoms(index, atoms, cutoff):
+    """Takes a spatial index and a list of atoms, and returns a list with the
+    set of indexed atoms within the cutoff distance of each atom (not including
+    the atom itself)."""
+
+    if not atoms: return []
+    locations = np.array([a.location for a in atoms], dtype=float)
+    neighbours = index["tree"].query_ball_point(locations.reshape(-1, 3), cutoff)
+    indexed = index["atoms"]
+    return [set(indexed[i] for i in n) - {atom} for atom, n in zip(atoms, neighbours)]
+
+
 def remove_duplicate_atoms(atoms):
     """Takes a set of atoms, and removes duplicates. For each element that is
-    represented, it creates an empty set of unique atoms. It then goes through
-    all the atoms from the original set of that element, and if the atom is
-    within 1 Angstrom of any atoms in the unique set, it is discarded -
-    otherwise it is added to the unique set. The final set is the union of all
-    the different elements' unique sets."""
+    represented, it goes through all the atoms from the original set of that
+    element, and if the atom is within 1 Angstrom of any atom already kept, it
+    is discarded - otherwise it is kept. The final set is the union of all the
+    different elements' kept atoms.
 
-    new_set = set()
+    The pairs of atoms within 1 Angstrom are found in one query of a KD-tree,
+    rather than by measuring the distance between every pair."""
+
+    atoms, new_set = list(atoms), set()
     elements = set([m.element for m in atoms])
     for element in elements:
         relevant_atoms = [m for m in atoms if m.element == element]
-        unique_relevant = set()
-        for r in relevant_atoms:
-            for u in unique_relevant:
-                if r.distance_to(u) < 1:
-                    break
-            else:
-                unique_relevant.add(r)
-        new_set.update(unique_relevant)
+        coordinates = np.array([a.location for a in relevant_atoms], dtype=float)
+        pairs = cKDTree(coordinates).query_pairs(1, output_type="ndarray")
+        earlier = defaultdict(list)
+        if len(pairs):
+            distances = np.linalg.norm(
+             coordinates[pairs[:, 0]] - coordinates[pairs[:, 1]], axis=1
+            )
+            for i, j in pairs[distances < 1]:
+                earlier[max(i, j)].append(min(i, j))
+        kept = [False] * len(relevant_atoms)
+        for i in range(len(relevant_atoms)):
+            kept[i] = not any(kept[j] for j in earlier[i])
+        new_set.update(a for a, k in zip(relevant_atoms, kept) if k)
     return new_set
 
 
-def get_atom_liganding_atoms(metal):
+def get_atom_liganding_atoms(metal, nearby_atoms=None):
     """Takes an atom and gets all non-metal, non-carbon, non-hydrogen atoms
     within 3Å. It then goes through all these atoms, starting with the closest,
     and if any of them have a coordination bond angle with a closer atom of
-    less than 45 degrees, it is discarded."""
+    less than 45 degrees, it is discarded.
 
-    kwargs = {"cutoff": 3, "is_metal": False}
-    nearby_atoms = [a for a in metal.nearby_atoms(**kwargs) if a.element not in "CH"]
+    If the atoms within 3Å have already been found (with get_nearby_atoms, say)
+    they can be given, otherwise they will be searched for."""
+
+    if nearby_atoms is None: nearby_atoms = metal.nearby_atoms(cutoff=3)
+    nearby_atoms = [a for a in nearby_atoms
+     if not a.is_metal and a.element not in "CH"]
     nearby_atoms = remove_duplicate_atoms(nearby_atoms)
     nearby_atoms = sorted(nearby_atoms, key=lambda a: a.distance_to(metal))
     liganding = []
@@ -70,14 +106,35 @@ def merge_metal_groups(sites):
     the set of residues that bind to them.
     It then creates a list of sites from this, where each site is a dict
     object with metals and residues. Two metals and their residues will be
-    merged together if they share residues."""
-
-    while not check_sites_have_unique_residues(sites):
-        for site1, site2 in combinations(sites, 2):
-            if get_site_residues(site1).intersection(get_site_residues(site2)):
-                site1["metals"].update(site2["metals"])
-                sites.remove(site2)
-                break
+    merged together if they share residues.
+
+    Sites sharing a residue are joined in a disjoint-set forest, so every
+    site's residues are only looked at once. Each merged site takes the place
+    of the earliest site that went into it."""
+
+    parents = list(range(len(sites)))
+    def find(index):
+        while parents[index] != index:
+            parents[index] = parents[parents[index]]
+            index = parents[index]
+        return index
+
+    owners = {}
+    for index, site in enumerate(sites):
+        for residue in get_site_residues(site):
+            if residue in owners:
+                root1, root2 = find(owners[residue]), find(index)
+                if root1 != root2: parents[max(root1, root2)] = min(root1, root2)
+            else:
+                owners[residue] = index
+    merged = {}
+    for index, site in enumerate(sites):
+        root = find(index)
+        if root in merged:
+            merged[root]["metals"].update(site["metals"])
+        else:
+            merged[root] = site
+    sites[:] = merged.values()
     return sites
 
 
@@ -126,16 +183,58 @@ def create_site_family(residues):
     return "".join([f"{c}{codes.count(c)}" for c in sorted(set(codes))])
 
 
-def add_fingerprint_to_site(site):
-    """Adds a fingerprint property to a ZincSite record based on its chains'
-    cluster IDs and chain signature."""
+def add_fingerprints_to_sites(sites, chunk_size=500):
+    """Takes a ZincSite queryset and yields its records with fingerprints
+    added. The sites are read in fixed-size chunks, and the residues of each
+    chunk (with their chains' clusters) are read in one query, so only one
+    chunk is ever held in memory here. Chunks are kept small enough for their
+    site IDs to fit in one query, whatever the database's limit on those."""
+
+    from django.db import connection
+    limit = connection.features.max_query_params
+    if limit: chunk_size = min(chunk_size, limit - 1)
+    for chunk in get_chunks(sites.iterator(chunk_size=chunk_size), chunk_size):
+        fingerprints = dict(get_site_fingerprints(get_fingerprint_rows(chunk)))
+        for site in chunk:
+            site.fingerprint = fingerprints.get(site.id, "__")
+            yield site
+
 
-    site_chain_clusters = set([
-     str(res.chain.cluster.id) for res in site.residue_set.filter(primary=True) if res.chain_signature
-    ])
-    site.fingerprint = "_".join(sorted(site_chain_clusters)) + "__" + "_".join(
-     [str(res.chain_signature) for res in site.residue_set.exclude(chain_signature="")]
-    )
+def get_chunks(iterable, size):
+    """Yields lists of up to a given size from an iterable, in order."""
+
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk: yield chunk
+
+
+def get_fingerprint_rows(sites):
+    """Gets the (site ID, primary, chain signature, cluster ID) rows needed to
+    fingerprint some ZincSite records, ordered by site."""
+
+    from core.models import Residue
+    return Residue.objects.filter(
+     site__in=[site.id for site in sites]
+    ).exclude(chain_signature="").values_list(
+     "site", "primary", "chain_signature", "chain__cluster"
+    ).order_by("site", "residue_number", "id")
+
+
+def get_site_fingerprints(rows):
+    """Takes (site ID, primary, chain signature, cluster ID) rows for residues
+    with chain signatures, ordered by site, and yields the fingerprint of each
+    site they belong to."""
+
+    for site_id, residues in groupby(rows, key=lambda row: row[0]):
+        residues = list(residues)
+        clusters = set([str(r[3]) for r in residues if r[1]])
+        yield site_id, "_".join(sorted(clusters)) + "__" + "_".join(
+         [r[2] for r in residues]
+        )
 
 
 def get_site_clusters(sites):
@@ -149,26 +248,25 @@ def get_site_clusters(sites):
     return unique_sites
 
 
-def get_group_information(sites):
-    """Takes a list of ZincSite records and tries to extract information they
-    have in common."""
-    
-    pdbs = list(set([site.pdb for site in sites]))
+def get_group_information(pdbs):
+    """Takes the (classification, keywords, title) of each PDB in a group and
+    tries to extract information they have in common. Keywords which are in
+    none of the titles are ruled out with one search of them all joined."""
+
     classifications = []
     keywords = []
-    for pdb in pdbs:
-        classifications.append(pdb.classification.upper())
-        keywords += pdb.keywords.upper().split(", ")
+    for classification, pdb_keywords, title in pdbs:
+        classifications.append(classification.upper())
+        keywords += pdb_keywords.upper().split(", ")
     classifications = Counter(classifications)
     keywords = Counter(keywords)
+    titles = [pdb[2] for pdb in pdbs]
+    index = index_titles(titles)
     title_keywords = {}
     bad_keywords = ["INHIBITOR", "ZINC", "ZINC ENZYME"]
     for keyword in keywords:
         if keyword not in bad_keywords and not keyword.isdigit():
-            count = 0
-            for pdb in pdbs:
-                if keyword in pdb.title: count += 1
-            title_keywords[keyword] = count
+            title_keywords[keyword] = count_titles_containing(keyword, titles, index)
     title_keywords = list(reversed(sorted(title_keywords.items(), key=lambda k: k[1])))
     cutoff = int(len(pdbs) * 0.25)
     classifications = [c for c, n in classifications.items() if n >= cutoff]
@@ -177,4 +275,23 @@ def get_group_information(sites):
         if title_keywords[0][0] in keywords:
             keywords.remove(title_keywords[0][0])
         keywords.insert(0, title_keywords[0][0])
-    return ", ".join(keywords), ", ".join(classifications)
\ No newline at end of file
+    return ", ".join(keywords), ", ".join(classifications)
+
+
+def index_titles(titles):
+    """Joins some titles into one string, separated by null characters, so
+    that text can be looked for in all of them with a single search."""
+
+    return "\0".join(titles)
+
+
+def count_titles_containing(text, titles, index):
+    """Counts how many titles contain some text, as a substring. Most keywords
+    are in none of the titles, and a single search of the joined titles rules
+    these out without checking the titles one by one."""
+
+    if "\0" not in text and text not in index: return 0
+    count = 0
+    for title in titles:
+        if text in title: count += 1
+    return count
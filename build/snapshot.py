@@ -0,0 +1,115 @@
+#! /usr/bin/env python3
+
+"""This script manages snapshots of the SQLite database. Running it with
+prepare copies the live database to a shadow database, which build.py and
+cluster.py will write to if ZINCBIND_DATABASE=shadow is set. Running it with
+promote then replaces the live database with the shadow in a single rename,
+keeping the old one so that it can be restored with rollback."""
+
+import os
+import sys
+import sqlite3
+import argparse
+from utilities import setup_django
+setup_django()
+from django.conf import settings
+
+def main(command, force=False):
+    paths = settings.SQLITE_DATABASES
+    if command == "prepare":
+        if prepare_shadow(paths["live"], paths["shadow"], force=force):
+            print(f"Copied {paths['live']} to {paths['shadow']}")
+        else:
+            print(f"Carrying on with existing {paths['shadow']}")
+    elif command == "promote":
+        promote_shadow(paths["shadow"], paths["live"], paths["previous"])
+        print(f"Promoted {paths['shadow']} to {paths['live']}")
+    elif command == "rollback":
+        roll_back(paths["live"], paths["previous"])
+        print(f"Swapped {paths['live']} with {paths['previous']}")
+
+
+def prepare_shadow(live, shadow, force=False):
+    """Copies the live database to the shadow location, using SQLite's backup
+    API so that the copy is consistent even if the live database is being
+    read. If a shadow already exists (from an interrupted build, say) it is
+    kept unless forced, and False is returned."""
+
+    if os.path.exists(shadow) and not force: return False
+    if os.path.exists(shadow): os.remove(shadow)
+    if os.path.exists(live):
+        source = sqlite3.connect(f"file:{live}?mode=ro", uri=True)
+        destination = sqlite3.connect(shadow)
+        try:
+            source.backup(destination)
+        finally:
+            source.close()
+            destination.close()
+    return True
+
+
+def promote_shadow(shadow, live, previous):
+    """Makes the shadow database the live one. The shadow is checked first,
+    and the current live database is kept as the previous snapshot (by
+    hard-linking it, so it is never missing). The final rename is atomic, so
+    readers see either the old database or the new one."""
+
+    check_database(shadow)
+    with open(shadow, "rb") as f: os.fsync(f.fileno())
+    if os.path.exists(live): replace_with_link(live, previous)
+    os.replace(shadow, live)
+
+
+def roll_back(live, previous):
+    """Swaps the live database with the previous snapshot. Rolling back twice
+    restores the database that was live to begin with."""
+
+    if not os.path.exists(previous):
+        raise FileNotFoundError(f"There is no previous snapshot at {previous}")
+    swap = live + ".swap"
+    replace_with_link(live, swap)
+    os.replace(previous, live)
+    os.replace(swap, previous)
+
+
+def check_database(path):
+    """Checks that an SQLite database can be promoted - that it exists, is not
+    in the middle of being written to, and is not corrupt."""
+
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"There is no database at {path}")
+    for suffix in ["-journal", "-wal"]:
+        if os.path.exists(path + suffix):
+            raise ValueError(f"{path} is still being written to")
+    connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        result = connection.execute("PRAGMA quick_check").fetchone()[0]
+    finally:
+        connection.close()
+    if result != "ok": raise ValueError(f"{path} failed its check: {result}")
+
+
+def replace_with_link(path, link):
+    """Hard-links a file to a new path, replacing whatever was there."""
+
+    temporary = link + ".tmp"
+    if os.path.exists(temporary): os.remove(temporary)
+    os.link(path, temporary)
+    os.replace(temporary, link)
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("command", choices=["prepare", "promote", "rollback"])
+    parser.add_argument(
+     "--force", action="store_true",
+     help="when preparing, replace any existing shadow database"
+    )
+    args = parser.parse_args()
+    if settings.DATABASES["default"]["ENGINE"] != "django.db.backends.sqlite3":
+        print("Snapshots are only used with the SQLite database")
+        sys.exit()
+    print()
+    main(args.command, force=args.force)
+    print()
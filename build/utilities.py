@@ -1,6 +1,8 @@
 """Contains utility functions that don't belong anywhere else."""
 
+import os
 import math
+import time
 import requests
 import subprocess
 import json
@@ -8,9 +10,12 @@ from datetime import datetime
 import atomium
 from sites import remove_duplicate_atoms, get_atom_liganding_atoms
 from sites import remove_salt_metals, merge_metal_groups, get_site_residues
-from sites import get_site_chains
+from sites import get_site_chains, create_spatial_index, get_nearby_atoms
 from chains import get_all_chains, get_all_residues, get_chain_sequence
 
+SEARCH_URL = "https://search.rcsb.org/rcsbsearch/v1/query"
+ZINC_CODES_LOCATION = os.path.join("data", "zinc_codes.json")
+
 def setup_django():
     """Sets up the django environment so that it can be used in a script."""
 
@@ -30,10 +35,47 @@ def log(text):
         ))
 
 
-def get_zinc_pdb_codes():
-    """Gets PDB codes for all structures with a zinc atom in them.
-    If the response returned has an error code of 500, or if there are fewer
-    than 10,000 PDB codes sent back, an error will be thrown."""
+def get_zinc_pdb_codes(page_size=10000, retries=3, backoff=1):
+    """Gets PDB codes for all structures with a zinc atom in them, one page of
+    results at a time. Pages which can't be fetched are retried, waiting twice
+    as long each time, and if one still can't be fetched an error will be
+    thrown.
+
+    The codes fetched so far are saved to a checkpoint file after each page,
+    so if the listing is interrupted, the next attempt carries on from where
+    it stopped (unless the checkpoint is more than a day old). Once every page
+    has been fetched, the list is saved as the last good list for offline
+    builds - but only if it has as many codes as the RCSB said there were.
+    If not, the checkpoint is thrown away and an error is thrown."""
+
+    checkpoint_path = ZINC_CODES_LOCATION + ".checkpoint"
+    checkpoint = read_json_file(checkpoint_path)
+    if not checkpoint or time.time() - checkpoint["created"] > 86400:
+        checkpoint = {"created": time.time(), "start": 0, "codes": []}
+    while True:
+        codes, total = get_zinc_pdb_codes_page(
+         checkpoint["start"], page_size, retries, backoff
+        )
+        checkpoint["codes"] += codes
+        checkpoint["start"] += len(codes)
+        if checkpoint["start"] >= total: break
+        write_json_file(checkpoint_path, checkpoint)
+    codes = list(dict.fromkeys(checkpoint["codes"]))
+    if len(codes) != total:
+        if os.path.exists(checkpoint_path): os.remove(checkpoint_path)
+        raise Exception(
+         f"RCSB sent back {len(codes)} PDB codes but said there were {total}"
+        )
+    write_json_file(ZINC_CODES_LOCATION, {"created": time.time(), "codes": codes})
+    if os.path.exists(checkpoint_path): os.remove(checkpoint_path)
+    return codes
+
+
+def get_zinc_pdb_codes_page(start, rows, retries=3, backoff=1):
+    """Gets one page of the PDB codes for structures with zinc in them, along
+    with the total number of codes there are. An empty page means something
+    has gone wrong, as pages are never requested past the end, so it is
+    retried like any other failure."""
 
     query = {
         "query": {
@@ -46,39 +88,111 @@ def get_zinc_pdb_codes():
         },
         "request_options": {
             "pager": {
-            "start": 0,
-            "rows": 1000000000
+            "start": start,
+            "rows": rows
             }
         },
         "return_type": "entry"
     }
-    url = "https://search.rcsb.org/rcsbsearch/v1/query?json="
-    response = requests.get(url + json.dumps(query))
-
-    if response.status_code == 200:
-        data = response.json()
-        return [d["identifier"] for d in data["result_set"]]
+    for attempt in range(retries + 1):
+        try:
+            response = requests.get(
+             SEARCH_URL, params={"json": json.dumps(query)}, timeout=120
+            )
+            if response.status_code == 200:
+                data = response.json()
+                codes = [d["identifier"] for d in data["result_set"]]
+                if codes: return codes, data["total_count"]
+        except (requests.RequestException, ValueError, KeyError): pass
+        if attempt < retries: time.sleep(backoff * 2 ** attempt)
     raise Exception("RCSB didn't send back PDB codes")
 
 
+def get_saved_zinc_pdb_codes():
+    """Gets the last complete list of zinc PDB codes that was fetched, or None
+    if there isn't one."""
+
+    saved = read_json_file(ZINC_CODES_LOCATION)
+    return saved["codes"] if saved else None
+
+
+def read_json_file(path):
+    """Reads a JSON file, returning None if it doesn't exist or can't be
+    read."""
+
+    try:
+        with open(path) as f: return json.load(f)
+    except (FileNotFoundError, ValueError): return None
+
+
+def write_json_file(path, data):
+    """Writes data to a JSON file, replacing any existing file in one step so
+    that an interruption can't leave it half-written."""
+
+    with open(path + ".tmp", "w") as f: json.dump(data, f)
+    os.replace(path + ".tmp", path)
+
+
+def get_pdb_revisions(codes, batch_size=500, timeout=120):
+    """Gets the date of the latest revision of each PDB code given, as a
+    YYYY-MM-DD string, using the RCSB's data API. Codes which the RCSB has no
+    revision date for are left out. If any request takes longer than the
+    timeout (in seconds), an error is thrown."""
+
+    query = """query($ids: [String!]!) {
+     entries(entry_ids: $ids) { rcsb_id rcsb_accession_info { revision_date } }
+    }"""
+    url = "https://data.rcsb.org/graphql"
+    revisions = {}
+    for start in range(0, len(codes), batch_size):
+        response = requests.post(url, json={
+         "query": query, "variables": {"ids": codes[start:start + batch_size]}
+        }, timeout=timeout)
+        if response.status_code != 200:
+            raise Exception("RCSB didn't send back revision dates")
+        for entry in response.json()["data"]["entries"] or []:
+            info = entry.get("rcsb_accession_info") or {}
+            if info.get("revision_date"):
+                revisions[entry["rcsb_id"]] = info["revision_date"][:10]
+    return revisions
+
+
 def get_best_model(pdb):
     """Works out which assembly in a PDB has the lowest energy and returns that
-    model."""
+    model.
+
+    Assemblies with no metals in them are passed over - whether an assembly
+    will have metals can be told from the asymmetric unit structures its
+    transformations use, so only the assembly chosen is ever generated."""
 
     assemblies = sorted(pdb.assemblies, key=lambda a: math.inf
      if a["delta_energy"] is None else a["delta_energy"])
     if assemblies:
-        model = pdb.generate_assembly(assemblies[0]["id"])
-        metals = model.atoms(is_metal=True)
-        while not metals:
-            assemblies.pop(0)
-            model = pdb.generate_assembly(assemblies[0]["id"])
-            metals = model.atoms(is_metal=True)
-        return model, assemblies[0]["id"]
+        metal_ids = get_metal_structure_ids(pdb.model)
+        for assembly in assemblies:
+            for transformation in assembly["transformations"]:
+                if metal_ids.intersection(transformation["chains"]):
+                    return pdb.generate_assembly(assembly["id"]), assembly["id"]
+        raise ValueError("No assembly contains any metals")
     else:
         return pdb.model, None
 
 
+def get_metal_structure_ids(model):
+    """Gets the internal IDs of the chains, ligands and waters in a model which
+    contain metal atoms."""
+
+    structures = list(model.chains()) + list(model.ligands() | model.waters())
+    return set(s._internal_id for s in structures if s.atoms(is_metal=True))
+
+
+def get_skeleton_chains(model):
+    """Takes a model and returns a dict which says, for the internal ID of each
+    of its chains, whether that chain is a skeleton."""
+
+    return {c._internal_id: model_is_skeleton(c) for c in model.chains()}
+
+
 def model_is_skeleton(model):
     """Checks to see if a model contains of nothing but alpha carbons."""
 
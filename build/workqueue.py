@@ -0,0 +1,78 @@
+"""Contains functions for keeping track of the build's progress in the
+database, so that an interrupted build can carry on where it stopped and
+PDBs that keep failing are only retried every so often."""
+
+from datetime import timedelta
+from django.utils import timezone
+from core.models import BuildQueueEntry
+
+BACKOFF_HOURS = 20
+MAX_BACKOFF_DAYS = 30
+
+def reset_interrupted_codes():
+    """Puts any PDBs that were being built when a previous build stopped back
+    in the queue, and returns how many there were."""
+
+    return BuildQueueEntry.objects.filter(
+     status="in_progress"
+    ).update(status="pending")
+
+
+def queue_codes(codes, revisions):
+    """Adds PDB codes which need to be built to the queue and returns those
+    which should be built now, in the original order. PDBs which failed last
+    time are left out until their backoff has passed - unless there is a new
+    revision of them, in which case they are tried again straight away."""
+
+    entries = BuildQueueEntry.objects.in_bulk(list(codes))
+    new_entries, now, ready = [], timezone.now(), []
+    for code in codes:
+        entry, revision = entries.get(code), revisions.get(code)
+        if entry is None:
+            new_entries.append(BuildQueueEntry(id=code, revision=revision))
+        elif entry.status == "failed" and entry.revision == revision\
+         and entry.retry_after and entry.retry_after > now:
+            continue
+        elif entry.status != "pending" or entry.revision != revision:
+            if entry.revision != revision: entry.attempts = 0
+            entry.status, entry.revision = "pending", revision
+            entry.save()
+        ready.append(code)
+    BuildQueueEntry.objects.bulk_create(new_entries, batch_size=500)
+    return ready
+
+
+def start_codes(structures):
+    """Takes an iterable of tuples whose first item is a PDB code and yields
+    them unchanged, marking each PDB as in progress as it is handed out."""
+
+    for structure in structures:
+        BuildQueueEntry.objects.filter(
+         id=structure[0]
+        ).update(status="in_progress")
+        yield structure
+
+
+def finish_codes(codes, unprocessable):
+    """Marks PDBs as done, or as failed if they are in the unprocessable dict.
+    Failed PDBs have their error recorded and won't be tried again for a
+    while - a period which doubles with each attempt."""
+
+    done = [code for code in codes if code not in unprocessable]
+    BuildQueueEntry.objects.filter(id__in=done).update(
+     status="done", attempts=0, error=None, retry_after=None,
+     updated=timezone.now()
+    )
+    for code in codes:
+        if code in unprocessable:
+            entry = BuildQueueEntry.objects.filter(id=code).first()
+            if not entry: continue
+            entry.attempts += 1
+            backoff = min(
+             timedelta(hours=BACKOFF_HOURS * 2 ** (entry.attempts - 1)),
+             timedelta(days=MAX_BACKOFF_DAYS)
+            )
+            entry.status, entry.error = "failed", unprocessable[code]
+            entry.retry_after = timezone.now() + backoff
+            entry.save()
+
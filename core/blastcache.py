@@ -0,0 +1,117 @@
+"""Contains functions for caching the results of BLAST searches in an SQLite
+file, so that every API worker can reuse them. Results are stored against the
+version of the BLAST database they came from, and those from any other
+version are thrown away."""
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+
+MAX_CACHE_SIZE = 50 * 1024 * 1024
+
+def normalise_sequence(sequence):
+    """Puts a sequence in the form it is searched and cached in - upper case,
+    with any whitespace removed."""
+
+    return "".join(sequence.split()).upper()
+
+
+def get_database_location(root):
+    """Gets the location of the BLAST database that searches should use - the
+    version data/blastdb/current points to, or if make_sequencedb hasn't made
+    one yet, the data/chains.fasta database older builds left behind. The link
+    is resolved here, once, so that the database searched is the one whose
+    version the results are cached under even if the link is switched."""
+
+    current = os.path.join(root, "data", "blastdb", "current")
+    if os.path.isdir(current):
+        return os.path.join(os.path.realpath(current), "chains.fasta")
+    return os.path.join(root, "data", "chains.fasta")
+
+
+def get_database_version(location):
+    """Gets the version of the BLAST database at a location, which is the name
+    of its directory in data/blastdb. If it isn't in there (as with the older
+    data/chains.fasta database), there is no version and results can't be
+    cached."""
+
+    directory = os.path.dirname(location)
+    if os.path.basename(os.path.dirname(directory)) == "blastdb":
+        return os.path.basename(directory)
+
+
+def connect_to_cache(path):
+    """Opens the cache file, creating its table if needed. Several processes
+    can use it at once - writes wait for each other rather than failing."""
+
+    connection = sqlite3.connect(path, timeout=10, isolation_level=None)
+    connection.execute(
+     "CREATE TABLE IF NOT EXISTS blast_results (key TEXT PRIMARY KEY, "
+     "version TEXT, results TEXT, size INTEGER, used REAL)"
+    )
+    return connection
+
+
+def get_cache_key(sequence, evalue, version):
+    """Creates the key that results are stored under."""
+
+    return hashlib.sha256(f"{version}|{evalue!r}|{sequence}".encode()).hexdigest()
+
+
+def get_cached_results(path, sequence, evalue, version):
+    """Gets the cached results of a BLAST search, or None if there aren't any
+    (or the cache can't be read). Getting results marks them as recently
+    used."""
+
+    if version is None: return None
+    key = get_cache_key(sequence, evalue, version)
+    try:
+        connection = connect_to_cache(path)
+    except sqlite3.Error: return None
+    try:
+        row = connection.execute(
+         "SELECT results FROM blast_results WHERE key=? AND version=?",
+         [key, version]
+        ).fetchone()
+        if row is None: return None
+        connection.execute(
+         "UPDATE blast_results SET used=? WHERE key=?", [time.time(), key]
+        )
+        return json.loads(row[0])
+    except sqlite3.Error: return None
+    finally:
+        connection.close()
+
+
+def cache_results(path, sequence, evalue, version, results, max_size=MAX_CACHE_SIZE):
+    """Saves the results of a BLAST search to the cache. Results from other
+    versions of the BLAST database are removed, and then the least recently
+    used results until the cache is no bigger than the maximum size (in
+    bytes). If the cache can't be written to, the results aren't saved."""
+
+    if version is None: return
+    text = json.dumps(results)
+    try:
+        connection = connect_to_cache(path)
+    except sqlite3.Error: return
+    try:
+        connection.execute("BEGIN IMMEDIATE")
+        connection.execute("DELETE FROM blast_results WHERE version!=?", [version])
+        connection.execute(
+         "INSERT OR REPLACE INTO blast_results VALUES (?, ?, ?, ?, ?)", [
+          get_cache_key(sequence, evalue, version), version, text,
+          len(text), time.time()
+        ])
+        total = 0
+        for key, size in connection.execute(
+         "SELECT key, size FROM blast_results ORDER BY used DESC"
+        ).fetchall():
+            total += size
+            if total > max_size:
+                connection.execute("DELETE FROM blast_results WHERE key=?", [key])
+        connection.execute("COMMIT")
+    except sqlite3.Error: pass
+    finally:
+        connection.close()
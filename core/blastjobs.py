@@ -0,0 +1,173 @@
+"""Contains functions for running BLAST searches as jobs in the background, so
+that a long search doesn't hold up an API worker. Jobs are recorded in an
+SQLite file so that any worker can report on them, and are run in a small
+pool of processes belonging to the worker that accepted them. If too many
+jobs are waiting, across all workers, new ones are turned away."""
+
+import os
+import json
+import time
+import uuid
+import sqlite3
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from django.conf import settings
+
+EXECUTOR = None
+
+def connect_to_jobs(path):
+    """Opens the jobs file, creating its table if needed."""
+
+    connection = sqlite3.connect(path, timeout=10, isolation_level=None)
+    connection.execute(
+     "CREATE TABLE IF NOT EXISTS blast_jobs (id TEXT PRIMARY KEY, "
+     "sequence TEXT, evalue REAL, status TEXT, error TEXT, results TEXT, "
+     "submitted REAL, started REAL, finished REAL, owner INTEGER)"
+    )
+    columns = [row[1] for row in connection.execute("PRAGMA table_info(blast_jobs)")]
+    if "started" not in columns:
+        connection.execute("ALTER TABLE blast_jobs ADD COLUMN started REAL")
+    if "owner" not in columns:
+        connection.execute("ALTER TABLE blast_jobs ADD COLUMN owner INTEGER")
+    return connection
+
+
+def get_executor():
+    """Gets this process's pool of BLAST workers, creating it the first time.
+    The pool's processes are forked from this one, so Django is already set
+    up in them."""
+
+    global EXECUTOR
+    if EXECUTOR is None:
+        EXECUTOR = ProcessPoolExecutor(
+         settings.BLAST_JOB_WORKERS, mp_context=multiprocessing.get_context("fork")
+        )
+    return EXECUTOR
+
+
+def is_process_running(pid):
+    """Checks whether a process with some ID is still running on this
+    machine."""
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError: return False
+    except PermissionError: pass
+    return True
+
+
+def submit_blast_job(sequence, evalue):
+    """Records a new BLAST job and hands it to the pool, returning the job as
+    a dict. Each job records the process that owns the pool it was handed
+    to. Jobs whose owner has stopped can never finish, and are marked as
+    failed along with jobs which have been running or waiting too long, and
+    finished jobs are eventually removed. If too many jobs are still waiting
+    or running, a ValueError is raised instead."""
+
+    global EXECUTOR
+    path, now = settings.BLAST_JOBS_LOCATION, time.time()
+    connection = connect_to_jobs(path)
+    try:
+        connection.execute("BEGIN IMMEDIATE")
+        connection.execute(
+         "UPDATE blast_jobs SET status='failed', error='Job timed out', "
+         "finished=? WHERE (status='running' AND started<?) OR "
+         "(status='queued' AND submitted<?)",
+         [now, now - settings.BLAST_JOB_TIMEOUT, now - settings.BLAST_JOB_EXPIRY]
+        )
+        stopped = [row[0] for row in connection.execute(
+         "SELECT DISTINCT owner FROM blast_jobs WHERE status IN "
+         "('queued', 'running') AND owner IS NOT NULL"
+        ) if not is_process_running(row[0])]
+        if stopped:
+            connection.execute(
+             "UPDATE blast_jobs SET status='failed', error='Job was lost', "
+             "finished=? WHERE status IN ('queued', 'running') AND owner IN "
+             "({})".format(", ".join("?" for owner in stopped)), [now, *stopped]
+            )
+        connection.execute(
+         "DELETE FROM blast_jobs WHERE finished<?", [now - settings.BLAST_JOB_EXPIRY]
+        )
+        active = connection.execute(
+         "SELECT COUNT(*) FROM blast_jobs WHERE status IN ('queued', 'running')"
+        ).fetchone()[0]
+        if active >= settings.BLAST_JOB_QUEUE_LIMIT:
+            connection.execute("ROLLBACK")
+            raise ValueError("Too many BLAST jobs are waiting - try again later")
+        id = uuid.uuid4().hex
+        connection.execute(
+         "INSERT INTO blast_jobs (id, sequence, evalue, status, submitted, "
+         "owner) VALUES (?, ?, ?, 'queued', ?, ?)",
+         [id, sequence, evalue, now, os.getpid()]
+        )
+        connection.execute("COMMIT")
+    finally:
+        connection.close()
+    try:
+        get_executor().submit(run_blast_job, path, id, sequence, evalue)
+    except Exception as e:
+        EXECUTOR = None
+        update_blast_job(
+         path, id, ["queued"], status="failed", error=str(e), finished=now
+        )
+    return get_blast_job(id)
+
+
+def run_blast_job(path, id, sequence, evalue):
+    """Runs a BLAST job, recording its progress and then its results (or the
+    error that stopped it) in the jobs file. If the job is no longer queued
+    by the time it is picked up, it isn't run, and if it has been given up
+    on while running, its results are thrown away."""
+
+    from .models import Chain
+    if not update_blast_job(
+     path, id, ["queued"], status="running", started=time.time()
+    ): return
+    try:
+        results = Chain.blast_search(sequence, evalue)
+    except Exception as e:
+        update_blast_job(
+         path, id, ["running"], status="failed", error=str(e),
+         finished=time.time()
+        )
+    else:
+        update_blast_job(
+         path, id, ["running"], status="complete", results=json.dumps(results),
+         finished=time.time()
+        )
+
+
+def update_blast_job(path, id, statuses, **fields):
+    """Updates the given fields of a job's record, as long as the job has one
+    of the statuses given - so a job that has finished or failed can't be
+    changed again. Returns whether the job was updated."""
+
+    connection = connect_to_jobs(path)
+    try:
+        return connection.execute(
+         "UPDATE blast_jobs SET {} WHERE id=? AND status IN ({})".format(
+          ", ".join(f"{field}=?" for field in fields),
+          ", ".join("?" for status in statuses)
+         ), [*fields.values(), id, *statuses]
+        ).rowcount > 0
+    finally:
+        connection.close()
+
+
+def get_blast_job(id):
+    """Gets a job as a dict, with its results decoded, or None if there is no
+    such job."""
+
+    connection = connect_to_jobs(settings.BLAST_JOBS_LOCATION)
+    try:
+        row = connection.execute(
+         "SELECT id, sequence, evalue, status, error, results FROM blast_jobs "
+         "WHERE id=?", [id]
+        ).fetchone()
+    finally:
+        connection.close()
+    if row is None: return None
+    return {
+     "id": row[0], "sequence": row[1], "evalue": row[2], "status": row[3],
+     "error": row[4], "results": json.loads(row[5]) if row[5] else None
+    }
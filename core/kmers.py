@@ -0,0 +1,156 @@
+"""Contains functions for searching chain sequences with an inverted index of
+their k-mers - much faster than BLAST for finding close matches, though not
+as sensitive."""
+
+import os
+from collections import Counter
+import numpy as np
+
+K = 3
+ALPHABET_SIZE = 26
+INDEXES = {}
+
+def encode_kmers(sequence, k=K):
+    """Turns a sequence into an array of integer codes, one for each k-mer in
+    it, in order. Anything other than a letter is treated as an X."""
+
+    letters = np.frombuffer(
+     sequence.upper().encode("ascii", "replace"), dtype=np.uint8
+    ).astype(np.int64) - ord("A")
+    letters[(letters < 0) | (letters >= ALPHABET_SIZE)] = ord("X") - ord("A")
+    count = len(letters) - k + 1
+    if count < 1: return np.zeros(0, dtype=np.int64)
+    codes = np.zeros(count, dtype=np.int64)
+    for offset in range(k):
+        codes = codes * ALPHABET_SIZE + letters[offset:offset + count]
+    return codes
+
+
+def create_kmer_index(chains, k=K):
+    """Creates an index from (chain ID, sequence) pairs. For every possible
+    k-mer, the positions of the chains which contain it are stored in one
+    array, with a second array of offsets saying where each k-mer's chains
+    start."""
+
+    ids, codes, owners = [], [], []
+    for id, sequence in chains:
+        chain_codes = np.unique(encode_kmers(sequence, k))
+        codes.append(chain_codes)
+        owners.append(np.full(len(chain_codes), len(ids), dtype=np.int32))
+        ids.append(id)
+    codes = np.concatenate(codes) if codes else np.zeros(0, dtype=np.int64)
+    owners = np.concatenate(owners) if owners else np.zeros(0, dtype=np.int32)
+    offsets = np.zeros(ALPHABET_SIZE ** k + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(codes, minlength=ALPHABET_SIZE ** k))
+    return {
+     "k": k, "ids": np.array(ids, dtype=str),
+     "offsets": offsets, "chains": owners[np.argsort(codes, kind="stable")]
+    }
+
+
+def save_kmer_index(index, path):
+    """Saves a k-mer index to a NumPy .npz file. The file is written
+    elsewhere first and then moved into place, so that it is never seen half
+    written."""
+
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as f: np.savez(f, **index)
+    os.replace(temporary, path)
+
+
+def load_kmer_index(path):
+    """Loads a k-mer index from a file saved by save_kmer_index."""
+
+    with np.load(path) as data:
+        return {
+         "k": int(data["k"]), "ids": data["ids"],
+         "offsets": data["offsets"], "chains": data["chains"]
+        }
+
+
+def get_kmer_index(path, chains):
+    """Gets the k-mer index saved at a path, or if there isn't one there,
+    creates one from a queryset of chains. Either way it is kept in memory,
+    until the file changes or the number of chains does."""
+
+    key = os.path.getmtime(path) if os.path.exists(path) else chains.count()
+    if path not in INDEXES or INDEXES[path][0] != key:
+        if os.path.exists(path):
+            index = load_kmer_index(path)
+        else:
+            index = create_kmer_index(chains.values_list("id", "sequence"))
+        INDEXES[path] = (key, index)
+    return INDEXES[path][1]
+
+
+def search_kmer_index(index, sequence, limit=50):
+    """Finds the chains which share the most k-mers with a sequence, best
+    first, as dicts of their ID, the number of k-mers shared, and the
+    proportion of the sequence's k-mers that this is."""
+
+    codes = np.unique(encode_kmers(sequence, index["k"]))
+    if not len(codes) or not len(index["ids"]): return []
+    offsets, chains = index["offsets"], index["chains"]
+    postings = np.concatenate(
+     [chains[offsets[code]:offsets[code + 1]] for code in codes]
+    )
+    counts = np.bincount(postings, minlength=len(index["ids"]))
+    candidates = np.nonzero(counts)[0]
+    candidates = candidates[np.lexsort((candidates, -counts[candidates]))]
+    return [{
+     "id": str(index["ids"][position]),
+     "shared_kmers": int(counts[position]),
+     "coverage": float(counts[position] / len(codes))
+    } for position in candidates[:limit]]
+
+
+def align_banded(query, target, k=K, band=16):
+    """Locally aligns two sequences, only looking at the band of cells around
+    the diagonal on which they share the most k-mers. The aligned sequences,
+    the midline between them, the number of identical residues, and where the
+    alignment starts and ends in each sequence (counting from 1) are
+    returned as a dict."""
+
+    match_award, mismatch_penalty, gap_penalty = 10, -5, -5
+    query_kmers = {}
+    for i in range(len(query) - k + 1):
+        query_kmers.setdefault(query[i:i + k].upper(), []).append(i)
+    diagonals = Counter(j - i for j in range(len(target) - k + 1)
+     for i in query_kmers.get(target[j:j + k].upper(), []))
+    diagonal = diagonals.most_common(1)[0][0] if diagonals else 0
+    scores, best, best_cell = {}, 0, None
+    for i in range(1, len(query) + 1):
+        for j in range(max(1, i + diagonal - band),
+         min(len(target), i + diagonal + band) + 1):
+            same = query[i - 1].upper() == target[j - 1].upper()
+            score = max(
+             0, scores.get((i - 1, j - 1), 0) + (
+              match_award if same else mismatch_penalty
+             ), scores.get((i - 1, j), 0) + gap_penalty,
+             scores.get((i, j - 1), 0) + gap_penalty
+            )
+            scores[(i, j)] = score
+            if score > best: best, best_cell = score, (i, j)
+    qseq, hseq, midline, identity = "", "", "", 0
+    i, j = best_cell or (0, 0)
+    query_to, hit_to = i, j
+    while i > 0 and j > 0 and scores.get((i, j), 0) > 0:
+        same = query[i - 1].upper() == target[j - 1].upper()
+        if scores[(i, j)] == scores.get((i - 1, j - 1), 0) + (
+         match_award if same else mismatch_penalty
+        ):
+            qseq, hseq = query[i - 1] + qseq, target[j - 1] + hseq
+            midline = (query[i - 1] if same else " ") + midline
+            identity += same
+            i, j = i - 1, j - 1
+        elif scores[(i, j)] == scores.get((i - 1, j), 0) + gap_penalty:
+            qseq, hseq, midline = query[i - 1] + qseq, "-" + hseq, " " + midline
+            i -= 1
+        else:
+            qseq, hseq, midline = "-" + qseq, target[j - 1] + hseq, " " + midline
+            j -= 1
+    return {
+     "qseq": qseq, "hseq": hseq, "midline": midline, "identity": identity,
+     "query_from": i + 1, "query_to": query_to,
+     "hit_from": j + 1, "hit_to": hit_to
+    }
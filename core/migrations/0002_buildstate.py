@@ -0,0 +1,25 @@
+# Generated by Django 2.2.13 on 2026-10-18 12:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BuildState',
+            fields=[
+                ('id', models.CharField(max_length=32, primary_key=True, serialize=False)),
+                ('revision', models.CharField(blank=True, max_length=32, null=True)),
+                ('content_hash', models.CharField(blank=True, max_length=64, null=True)),
+                ('built', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'db_table': 'build_states',
+            },
+        ),
+    ]
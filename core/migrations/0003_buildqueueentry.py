@@ -0,0 +1,28 @@
+# Generated by Django 2.2.13 on 2026-10-18 12:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_buildstate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BuildQueueEntry',
+            fields=[
+                ('id', models.CharField(max_length=32, primary_key=True, serialize=False)),
+                ('status', models.CharField(choices=[('pending', 'pending'), ('in_progress', 'in progress'), ('done', 'done'), ('failed', 'failed')], default='pending', max_length=16)),
+                ('revision', models.CharField(blank=True, max_length=32, null=True)),
+                ('attempts', models.IntegerField(default=0)),
+                ('error', models.TextField(blank=True, null=True)),
+                ('retry_after', models.DateTimeField(blank=True, null=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'db_table': 'build_queue',
+            },
+        ),
+    ]
@@ -1,7 +1,10 @@
+import re
 import subprocess
 import json
 import atomium
 from django.db import models
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
 from django.conf import settings
 
 class Pdb(models.Model):
@@ -105,27 +108,85 @@ class Chain(models.Model):
 
     @staticmethod
     def blast_search(sequence, evalue):
-        """Searches all chains using a BLAST binary. This method currently has
-        no tests."""
+        """Searches all chains using a BLAST binary. The results are cached for
+        as long as the BLAST database stays the same."""
         
-        location = f"{'' if settings.DEBUG else '../'}data/chains.fasta"
-        p = subprocess.Popen(
-         'echo "{}" | blastp -db {} -outfmt 15 -evalue {}'.format(
-          sequence, location, evalue
-         ), stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True
-        )
-        out, err = p.communicate()
-        results = sorted([item for sublist in [
-            x["report"]["results"]["search"]["hits"]\
-             for x in json.loads(out)["BlastOutput2"]
-        ] for item in sublist], key=lambda r: r["hsps"][0]["evalue"])
-        ids = [r["description"][0]["title"].split("|")[1] for r in results]
-        return [{
-         "id": r["description"][0]["id"], "title": r["description"][0]["title"],
-         **{key: r["hsps"][0][key] for key in (
-          "qseq", "midline", "hseq", "bit_score", "evalue", "hit_from",
-          "hit_to", "query_from", "query_to", "identity", "score"
-         )}} for r in results]
+        return Chain.blast_search_batch([sequence], evalue)[0]
+    
+
+    @staticmethod
+    def blast_search_batch(sequences, evalue):
+        """Searches all chains for several sequences at once, returning a list
+        of results for each. Any that aren't cached are searched for with a
+        single run of the BLAST binary, as one multi-sequence query, and each
+        report is matched back to its query by the query's title. A query
+        with no report gets no results, which aren't cached. Sequences which
+        aren't valid protein sequences are rejected with a ValueError."""
+
+        from .blastcache import normalise_sequence, get_database_location
+        from .blastcache import get_database_version, get_cached_results, cache_results
+        location = get_database_location("" if settings.DEBUG else "..")
+        cache = settings.BLAST_CACHE_LOCATION
+        version = get_database_version(location)
+        sequences = [normalise_sequence(sequence) for sequence in sequences]
+        for sequence in sequences:
+            if not re.fullmatch(r"[A-Z*-]+", sequence):
+                raise ValueError(f"{sequence!r} is not a valid protein sequence")
+        results = {}
+        for sequence in sequences:
+            if sequence not in results:
+                results[sequence] = get_cached_results(cache, sequence, evalue, version)
+        missing = [sequence for sequence in results if results[sequence] is None]
+        if missing:
+            p = subprocess.Popen([
+             "blastp", "-db", location, "-outfmt", "15", "-evalue", str(evalue),
+             "-num_threads", str(settings.BLAST_THREADS)
+            ], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+             stderr=subprocess.PIPE, universal_newlines=True)
+            out, err = p.communicate("".join(
+             f">query{n}\n{sequence}\n" for n, sequence in enumerate(missing)
+            ))
+            reports = {}
+            for report in json.loads(out)["BlastOutput2"]:
+                search = report["report"]["results"]["search"]
+                reports[search.get("query_title") or search.get("query_id")] = search
+            for n, sequence in enumerate(missing):
+                if f"query{n}" not in reports:
+                    results[sequence] = []
+                    continue
+                hits = sorted(
+                 reports[f"query{n}"]["hits"], key=lambda r: r["hsps"][0]["evalue"]
+                )
+                results[sequence] = [{
+                 "id": r["description"][0]["id"],
+                 "title": r["description"][0]["title"],
+                 **{key: r["hsps"][0][key] for key in (
+                  "qseq", "midline", "hseq", "bit_score", "evalue", "hit_from",
+                  "hit_to", "query_from", "query_to", "identity", "score"
+                 )}} for r in hits]
+                cache_results(cache, sequence, evalue, version, results[sequence])
+        return [results[sequence] for sequence in sequences]
+    
+
+    @staticmethod
+    def kmer_search(sequence, limit=50, align=False, skip=0):
+        """Searches all chains for those sharing the most k-mers with a
+        sequence, using an index held in memory. Some of the top hits can be
+        skipped, and those that remain can optionally be aligned with the
+        sequence too."""
+
+        from .kmers import get_kmer_index, search_kmer_index, align_banded
+        location = f"{'' if settings.DEBUG else '../'}data/chains.kmers.npz"
+        index = get_kmer_index(location, Chain.objects.all())
+        results = search_kmer_index(index, sequence, skip + limit)[skip:]
+        if align:
+            sequences = dict(Chain.objects.filter(
+             id__in=[r["id"] for r in results]
+            ).values_list("id", "sequence"))
+            for result in results:
+                if result["id"] in sequences:
+                    result.update(align_banded(sequence, sequences[result["id"]]))
+        return results
          
   
 
@@ -198,4 +259,52 @@ class StabilisingBond(models.Model):
         db_table = "stabilising_bonds"
 
     primary_atom = models.ForeignKey(Atom, on_delete=models.CASCADE, related_name="primary_stabilisers")
-    secondary_atom = models.ForeignKey(Atom, on_delete=models.CASCADE, related_name="secondary_stabilisers")
\ No newline at end of file
+    secondary_atom = models.ForeignKey(Atom, on_delete=models.CASCADE, related_name="secondary_stabilisers")
+
+
+
+class BuildState(models.Model):
+    """The state of a PDB entry as of the last time it was built, so that the
+    build can tell when it needs to be processed again."""
+
+    class Meta:
+        db_table = "build_states"
+
+    id = models.CharField(primary_key=True, max_length=32)
+    revision = models.CharField(null=True, blank=True, max_length=32)
+    content_hash = models.CharField(null=True, blank=True, max_length=64)
+    built = models.DateTimeField(auto_now=True)
+
+
+
+class BuildQueueEntry(models.Model):
+    """A PDB waiting to be built, being built, or which has been built (or
+    failed to be built) - a durable record of the nightly build's progress,
+    so that an interrupted build can resume and repeated failures can be
+    backed off."""
+
+    class Meta:
+        db_table = "build_queue"
+
+    STATUSES = ("pending", "in_progress", "done", "failed")
+
+    id = models.CharField(primary_key=True, max_length=32)
+    status = models.CharField(max_length=16, default="pending", choices=[
+     (status, status.replace("_", " ")) for status in STATUSES
+    ])
+    revision = models.CharField(null=True, blank=True, max_length=32)
+    attempts = models.IntegerField(default=0)
+    error = models.TextField(null=True, blank=True)
+    retry_after = models.DateTimeField(null=True, blank=True)
+    updated = models.DateTimeField(auto_now=True)
+
+
+
+@receiver(connection_created)
+def memory_map_database(sender, connection, **kwargs):
+    """Memory-maps the SQLite database when the settings ask for it, as they do
+    when the API is reading an immutable snapshot."""
+
+    if connection.vendor == "sqlite" and settings.SQLITE_MMAP_SIZE:
+        with connection.cursor() as cursor:
+            cursor.execute(f"PRAGMA mmap_size={int(settings.SQLITE_MMAP_SIZE)}")
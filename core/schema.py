@@ -82,6 +82,42 @@ def generate_args(Model):
     return args
 
 
+def create_blast_hits(results, skip=0, limit=None, chains=None):
+    """Turns BLAST results into BlastType objects, skipping some first and
+    keeping only the top few if asked, so that a large set of hits never
+    has to be serialized. The chains of the hits that remain are fetched in
+    one query, with their PDBs and clusters joined on, unless a dict of
+    chains that have already been fetched is given."""
+
+    results = results[skip:] if limit is None else results[skip:skip + limit]
+    if chains is None: chains = get_blast_hit_chains(results)
+    return [BlastType(
+     **result, chain=chains.get(result["title"].split("|")[1])
+    ) for result in results]
+
+
+def get_blast_hit_chains(results):
+    """Fetches the chains of some BLAST results in one query, with their PDBs
+    and clusters joined on, as a dict."""
+
+    return Chain.objects.select_related("pdb", "cluster").in_bulk(
+     list(set(result["title"].split("|")[1] for result in results))
+    )
+
+
+def create_kmer_hits(results):
+    """Turns k-mer search results into KmerHitType objects, fetching the
+    chains of all the hits in one query, with their PDBs and clusters joined
+    on. If the index is older than the database, a hit's chain may have gone,
+    in which case the hit has no chain."""
+
+    chains = Chain.objects.select_related("pdb", "cluster").in_bulk(
+     [result["id"] for result in results]
+    )
+    return [KmerHitType(**result, chain=chains.get(result["id"]))
+     for result in results]
+
+
 
 class CoordinateBondType(DjangoObjectType):
 
@@ -584,9 +620,6 @@ class BlastType(graphene.ObjectType):
     score = graphene.Int()
     chain = graphene.Field(ChainType)
 
-    def resolve_chain(self, info, **kwargs):
-        return Chain.objects.get(id=self.title.split("|")[1])
-
 
 
 class BlastConnection(Connection):
@@ -601,6 +634,88 @@ class BlastConnection(Connection):
 
 
 
+class BlastBatchType(graphene.ObjectType):
+
+    sequence = graphene.String()
+    results = graphene.ConnectionField(
+     BlastConnection, skip=graphene.Int(), limit=graphene.Int()
+    )
+
+    def __init__(self, *args, chains=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.chains = chains
+
+
+    def resolve_results(self, info, **kwargs):
+        return create_blast_hits(
+         self.results, kwargs.get("skip", 0), kwargs.get("limit"), self.chains
+        )
+
+
+
+class BlastJobType(graphene.ObjectType):
+
+    id = graphene.String()
+    sequence = graphene.String()
+    evalue = graphene.Float()
+    status = graphene.String()
+    error = graphene.String()
+    results = graphene.ConnectionField(
+     BlastConnection, skip=graphene.Int(), limit=graphene.Int()
+    )
+
+    def resolve_results(self, info, **kwargs):
+        if self.results is None: return []
+        return create_blast_hits(
+         self.results, kwargs.get("skip", 0), kwargs.get("limit")
+        )
+
+
+
+class SubmitBlastJob(graphene.Mutation):
+
+    class Arguments:
+        sequence = graphene.String(required=True)
+        evalue = graphene.Float()
+    
+    job = graphene.Field(BlastJobType)
+
+    def mutate(self, info, **kwargs):
+        from .blastjobs import submit_blast_job
+        job = submit_blast_job(kwargs["sequence"], kwargs.get("evalue", 0.1))
+        return SubmitBlastJob(job=BlastJobType(**job))
+
+
+
+class KmerHitType(graphene.ObjectType):
+
+    id = graphene.String()
+    shared_kmers = graphene.Int()
+    coverage = graphene.Float()
+    qseq = graphene.String()
+    midline = graphene.String()
+    hseq = graphene.String()
+    hit_from = graphene.Int()
+    hit_to = graphene.Int()
+    query_from = graphene.Int()
+    query_to = graphene.Int()
+    identity = graphene.Int()
+    chain = graphene.Field(ChainType)
+
+
+
+class KmerHitConnection(Connection):
+    
+    class Meta:
+        node = KmerHitType
+    
+    count = graphene.Int()
+
+    def resolve_count(self, info, **kwargs):
+        return len(self.edges)
+
+
+
 class StatsPoint(graphene.ObjectType):
 
     label = graphene.String()
@@ -692,8 +807,17 @@ class Query(HasPdbs, HasZincSites, HasMetals, HasResidues, HasAtoms, HasChains,
     version = graphene.String()
     blast = graphene.ConnectionField(
      BlastConnection, sequence=graphene.String(required=True),
-     evalue=graphene.Float(), skip=graphene.Int()
+     evalue=graphene.Float(), skip=graphene.Int(), limit=graphene.Int()
+    )
+    kmer_search = graphene.ConnectionField(
+     KmerHitConnection, sequence=graphene.String(required=True),
+     limit=graphene.Int(), align=graphene.Boolean(), skip=graphene.Int()
     )
+    blast_batch = graphene.List(
+     BlastBatchType, sequences=graphene.List(graphene.String, required=True),
+     evalue=graphene.Float()
+    )
+    blast_job = graphene.Field(BlastJobType, id=graphene.String(required=True))
     stats = graphene.Field(Stats)
     families = graphene.List(graphene.String)
     
@@ -703,7 +827,37 @@ class Query(HasPdbs, HasZincSites, HasMetals, HasResidues, HasAtoms, HasChains,
 
     def resolve_blast(self, info, **kwargs):
         results = Chain.blast_search(kwargs["sequence"], kwargs.get("evalue", 0.1))
-        return [BlastType(**d) for d in results][kwargs.get("skip", 0):]
+        return create_blast_hits(
+         results, kwargs.get("skip", 0), kwargs.get("limit")
+        )
+    
+
+    def resolve_blast_batch(self, info, **kwargs):
+        if len(kwargs["sequences"]) > settings.BLAST_BATCH_LIMIT:
+            raise ValueError(
+             f"No more than {settings.BLAST_BATCH_LIMIT} sequences can be "
+             "searched at once - submit BLAST jobs for the rest"
+            )
+        results = Chain.blast_search_batch(
+         kwargs["sequences"], kwargs.get("evalue", 0.1)
+        )
+        chains = get_blast_hit_chains([hit for r in results for hit in r])
+        return [BlastBatchType(sequence=sequence, results=r, chains=chains)
+         for sequence, r in zip(kwargs["sequences"], results)]
+    
+
+    def resolve_blast_job(self, info, **kwargs):
+        from .blastjobs import get_blast_job
+        job = get_blast_job(kwargs["id"])
+        return BlastJobType(**job) if job else None
+    
+
+    def resolve_kmer_search(self, info, **kwargs):
+        results = Chain.kmer_search(
+         kwargs["sequence"], kwargs.get("limit", 50),
+         kwargs.get("align", False), kwargs.get("skip", 0)
+        )
+        return create_kmer_hits(results)
     
 
     def resolve_stats(self, info, **kwargs):
@@ -714,6 +868,12 @@ class Query(HasPdbs, HasZincSites, HasMetals, HasResidues, HasAtoms, HasChains,
         families = Counter(Group.objects.all().values_list("family", flat=True))
         return [f"{k}-{v}" for k, v in families.most_common()]
     
+
+
+class Mutation(graphene.ObjectType):
+
+    submit_blast_job = SubmitBlastJob.Field()
+    
     
-schema = graphene.Schema(query=Query)
+schema = graphene.Schema(query=Query, mutation=Mutation)
 
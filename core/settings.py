@@ -34,11 +34,45 @@ MIDDLEWARE = [
  "corsheaders.middleware.CorsMiddleware",
 ]
 
+# The build scripts can write to a shadow copy of the SQLite database, which
+# build/snapshot.py then promotes to be the live database. API workers can
+# open the live database as an immutable, read-only file, as it is replaced
+# rather than written to.
+SQLITE_DATABASES = {
+ "live": os.path.join(BASE_DIR, "data", "db.sqlite3"),
+ "shadow": os.path.join(BASE_DIR, "data", "shadow.sqlite3"),
+ "previous": os.path.join(BASE_DIR, "data", "previous.sqlite3")
+}
+SQLITE_MMAP_SIZE = 0
+
+# BLAST results are cached here, and shared by every API worker. No more than
+# BLAST_BATCH_LIMIT sequences can be searched in one request.
+BLAST_CACHE_LOCATION = os.path.join(BASE_DIR, "data", "blast_cache.sqlite3")
+BLAST_THREADS = 2
+BLAST_BATCH_LIMIT = 20
+
+# BLAST jobs are recorded here, and run in a pool of this many processes per
+# API worker - with new jobs turned away if too many are waiting or running.
+# Jobs time out an hour after they start running (or a day after they were
+# submitted, if they never start), and are forgotten a day after they finish.
+BLAST_JOBS_LOCATION = os.path.join(BASE_DIR, "data", "blast_jobs.sqlite3")
+BLAST_JOB_WORKERS = 2
+BLAST_JOB_QUEUE_LIMIT = 20
+BLAST_JOB_TIMEOUT = 60 * 60
+BLAST_JOB_EXPIRY = 24 * 60 * 60
+
 if DEBUG:
     DATABASES = {"default": {
      "ENGINE": "django.db.backends.sqlite3",
-     "NAME": os.path.join(BASE_DIR, "data", "db.sqlite3")
+     "NAME": SQLITE_DATABASES["live"]
     }}
+    if os.environ.get("ZINCBIND_DATABASE") == "shadow":
+        DATABASES["default"]["NAME"] = SQLITE_DATABASES["shadow"]
+    elif os.environ.get("ZINCBIND_DATABASE") == "readonly":
+        DATABASES["default"]["NAME"] = "file:{}?mode=ro&immutable=1".format(
+         SQLITE_DATABASES["live"]
+        )
+        SQLITE_MMAP_SIZE = 2 ** 30
 else:
     DATABASES = {"default": {
         "ENGINE": "django.db.backends.postgresql_psycopg2",
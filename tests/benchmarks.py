@@ -0,0 +1,531 @@
+"""Times the hot paths of the build - site detection and sequence alignment -
+on synthetic and fixture-derived structures of increasing size. Each optimised
+function is run alongside the reference implementation it replaced, and their
+outputs are compared. Run from the repository root:
+
+    python tests/benchmarks.py --output benchmarks.json
+
+The process exits with an error if any optimised function's output differs
+from the reference."""
+
+import sys; sys.path.append("build")
+import json
+import math
+import time
+import random
+import argparse
+import platform
+from datetime import datetime
+from collections import defaultdict, Counter
+from itertools import combinations
+import atomium
+from atomium.structures import Atom, Residue, Ligand, Chain, Model
+import sites
+import chains
+import descriptions
+
+SYNTHETIC_SIZES = [10, 50, 200]
+FIXTURES = "core/fixtures/pre-cluster.json"
+
+def reference_remove_duplicate_atoms(atoms):
+    """The original, pairwise version of sites.remove_duplicate_atoms."""
+
+    new_set = set()
+    elements = set([m.element for m in atoms])
+    for element in elements:
+        relevant_atoms = [m for m in atoms if m.element == element]
+        unique_relevant = set()
+        for r in relevant_atoms:
+            for u in unique_relevant:
+                if r.distance_to(u) < 1:
+                    break
+            else:
+                unique_relevant.add(r)
+        new_set.update(unique_relevant)
+    return new_set
+
+
+def reference_get_atom_liganding_atoms(metal):
+    """The original version of sites.get_atom_liganding_atoms, which searches
+    the model around each metal separately."""
+
+    kwargs = {"cutoff": 3, "is_metal": False}
+    nearby_atoms = [a for a in metal.nearby_atoms(**kwargs) if a.element not in "CH"]
+    nearby_atoms = reference_remove_duplicate_atoms(nearby_atoms)
+    nearby_atoms = sorted(nearby_atoms, key=lambda a: a.distance_to(metal))
+    liganding = []
+    for atom in nearby_atoms:
+        for ligand in liganding:
+            if metal.angle(atom, ligand) < math.pi / 4:
+                break
+        else:
+            liganding.append(atom)
+    return liganding
+
+
+def reference_merge_metal_groups(site_list):
+    """The original version of sites.merge_metal_groups, which merges one pair
+    of sites per pass."""
+
+    while not sites.check_sites_have_unique_residues(site_list):
+        for site1, site2 in combinations(site_list, 2):
+            if sites.get_site_residues(site1).intersection(
+             sites.get_site_residues(site2)):
+                site1["metals"].update(site2["metals"])
+                site_list.remove(site2)
+                break
+    return site_list
+
+
+def reference_align_sequences(seq1, seq2):
+    """The original, pure Python version of chains.align_sequences."""
+
+    match_award      = 10
+    mismatch_penalty = -5
+    gap_penalty      = -5
+    score_of = lambda a, b: chains.match_score(
+     a, b, match_award, mismatch_penalty, gap_penalty
+    )
+    m, n = len(seq1), len(seq2)
+    score = [[0 for y in range(n + 1)] for x in range(m + 1)]
+    for i in range(0, m + 1): score[i][0] = gap_penalty * i
+    for j in range(0, n + 1): score[0][j] = gap_penalty * j
+    for i in range(1, m + 1):
+        for j in range(1, n + 1):
+            match = score[i - 1][j - 1] + score_of(seq1[i-1], seq2[j-1])
+            delete = score[i - 1][j] + gap_penalty
+            insert = score[i][j - 1] + gap_penalty
+            score[i][j] = max(match, delete, insert)
+    align1, align2 = "", ""
+    i, j = m, n
+    while i > 0 and j > 0:
+        if score[i][j] == score[i-1][j - 1] + score_of(seq1[i-1], seq2[j-1]):
+            align1, align2 = align1 + seq1[i - 1], align2 + seq2[j - 1]
+            i, j = i - 1, j - 1
+        elif score[i][j] == score[i - 1][j] + gap_penalty:
+            align1, align2 = align1 + seq1[i - 1], align2 + "-"
+            i -= 1
+        elif score[i][j] == score[i][j - 1] + gap_penalty:
+            align1, align2 = align1 + "-", align2 + seq2[j - 1]
+            j -= 1
+    while i > 0:
+        align1, align2 = align1 + seq1[i - 1], align2 + "-"
+        i -= 1
+    while j > 0:
+        align1, align2 = align1 + "-", align2 + seq2[j - 1]
+        j -= 1
+    return align1[::-1], align2[::-1]
+
+
+def reference_get_chain_sequence(chain, residues):
+    """The original version of chains.get_chain_sequence."""
+
+    full = "".join(res.code for res in chain)
+    alignment = reference_align_sequences(full, chain.sequence)
+    seq, indices, dash_count = "", [], 0
+    for i, char in enumerate(alignment[0]):
+        if char == "-":
+            dash_count += 1
+        elif chain[i - dash_count].id in [r.id for r in residues]:
+            indices.append(i)
+    for i, char in enumerate(chain.sequence):
+        seq += char.upper() if i in indices else char.lower()
+    return seq
+
+
+def reference_get_group_information(pdbs):
+    """The original version of sites.get_group_information, which searches
+    every title for every keyword, taking (classification, keywords, title)
+    tuples."""
+
+    classifications = []
+    keywords = []
+    for classification, pdb_keywords, title in pdbs:
+        classifications.append(classification.upper())
+        keywords += pdb_keywords.upper().split(", ")
+    classifications = Counter(classifications)
+    keywords = Counter(keywords)
+    title_keywords = {}
+    bad_keywords = ["INHIBITOR", "ZINC", "ZINC ENZYME"]
+    for keyword in keywords:
+        if keyword not in bad_keywords and not keyword.isdigit():
+            count = 0
+            for pdb in pdbs:
+                if keyword in pdb[2]: count += 1
+            title_keywords[keyword] = count
+    title_keywords = list(reversed(sorted(title_keywords.items(), key=lambda k: k[1])))
+    cutoff = int(len(pdbs) * 0.25)
+    classifications = [c for c, n in classifications.items() if n >= cutoff]
+    keywords = [k for k, n in keywords.items() if n >= cutoff]
+    if title_keywords:
+        if title_keywords[0][0] in keywords:
+            keywords.remove(title_keywords[0][0])
+        keywords.insert(0, title_keywords[0][0])
+    return ", ".join(keywords), ", ".join(classifications)
+
+
+def create_atom(element, location, id, name):
+    """Creates an atomium atom with no charge, B-factor or anisotropy."""
+
+    return Atom(element, *location, id, name, 0, 0, [0] * 6)
+
+
+def link_residues(residues):
+    """Sets the next and previous residues of a list of residues, wherever
+    their numbers are consecutive."""
+
+    for residue1, residue2 in zip(residues, residues[1:]):
+        if descriptions.split_residue_id(residue2.id)[0]\
+         == descriptions.split_residue_id(residue1.id)[0] + 1:
+            residue1.next = residue2
+
+
+def create_synthetic_model(site_count, seed=0):
+    """Creates a model with a tetrahedral Cys4 zinc site every 15Å on a cubic
+    grid. Every third zinc has a superimposed duplicate 0.4Å away, and the
+    chain's SEQRES has residues that aren't in the model, so that alignment
+    has gaps to find."""
+
+    rng = random.Random(seed)
+    directions = [(1, 1, 1), (1, -1, -1), (-1, 1, -1), (-1, -1, 1)]
+    atom_names = [
+     ("SG", "S", 2.3), ("CB", "C", 3.3), ("CA", "C", 4.5),
+     ("N", "N", 5.5), ("C", "C", 5.6), ("O", "O", 6.5)
+    ]
+    side = math.ceil(site_count ** (1 / 3))
+    residues, zincs, atom_id = [], [], 1
+    for n in range(site_count):
+        centre = [15 * (n % side), 15 * (n // side % side), 15 * (n // side ** 2)]
+        for direction in directions:
+            atoms = []
+            for name, element, distance in atom_names:
+                location = [c + distance * d / math.sqrt(3) + rng.uniform(-0.1, 0.1)
+                 for c, d in zip(centre, direction)]
+                atoms.append(create_atom(element, location, atom_id, name))
+                atom_id += 1
+            residues.append(Residue(
+             *atoms, id=f"A.{len(residues) + 1}", name="CYS"
+            ))
+        zincs.append(create_atom("ZN", centre, atom_id, "ZN"))
+        atom_id += 1
+        if n % 3 == 0:
+            duplicate = [centre[0] + 0.4, centre[1], centre[2]]
+            zincs.append(create_atom("ZN", duplicate, atom_id, "ZN"))
+            atom_id += 1
+    link_residues(residues)
+    sequence = "".join(
+     ("MG" if n % 10 == 0 else "") + "C" for n in range(len(residues))
+    )
+    chain = Chain(*residues, id="A", sequence=sequence)
+    ligands = [Ligand(zinc, id=f"A.{10000 + n}", name="ZN", chain=chain)
+     for n, zinc in enumerate(zincs)]
+    return Model(chain, *ligands)
+
+
+def create_fixture_models(path=FIXTURES):
+    """Rebuilds atomium models from the atoms, residues and metals in the test
+    fixtures, one per PDB, and returns them sorted by size."""
+
+    records = defaultdict(list)
+    with open(path) as f:
+        for record in json.load(f):
+            records[record["model"]].append(record)
+    site_pdbs = {r["pk"]: r["fields"]["pdb"] for r in records["core.zincsite"]}
+    sequences = {r["pk"]: r["fields"]["sequence"] for r in records["core.chain"]}
+    residue_atoms = defaultdict(list)
+    for record in records["core.atom"]:
+        residue_atoms[record["fields"]["residue"]].append(record["fields"])
+    pdbs = defaultdict(lambda: {"residues": {}, "metals": {}, "sequences": {}})
+    for record in records["core.residue"]:
+        fields = record["fields"]
+        pdb = pdbs[site_pdbs[fields["site"]]]
+        residue = pdb["residues"].setdefault(
+         fields["atomium_id"], dict(fields, atoms={})
+        )
+        for atom in residue_atoms[record["pk"]]:
+            residue["atoms"][atom["atomium_id"]] = atom
+        if fields["chain"]:
+            pdb["sequences"][fields["chain_identifier"]] = sequences[fields["chain"]]
+    for record in records["core.metal"]:
+        fields = record["fields"]
+        pdbs[fields["pdb"]]["metals"][fields["atomium_id"]] = fields
+    models = []
+    for code, pdb in pdbs.items():
+        chain_residues, ligands = defaultdict(list), []
+        for residue_id, fields in pdb["residues"].items():
+            atoms = [create_atom(
+             a["element"], (a["x"], a["y"], a["z"]), a["atomium_id"], a["name"]
+            ) for a in fields["atoms"].values()]
+            if fields["chain"]:
+                chain_residues[fields["chain_identifier"]].append(
+                 Residue(*atoms, id=residue_id, name=fields["name"])
+                )
+            else:
+                ligands.append((fields["chain_identifier"], Ligand(
+                 *atoms, id=residue_id, name=fields["name"]
+                )))
+        for metal in pdb["metals"].values():
+            ligands.append((metal["chain_id"], Ligand(create_atom(
+             metal["element"], (metal["x"], metal["y"], metal["z"]),
+             metal["atomium_id"], metal["name"]
+            ), id="{}.{}{}".format(
+             metal["chain_id"], metal["residue_number"], metal["insertion_code"]
+            ), name=metal["residue_name"])))
+        model_chains = {}
+        for chain_id in set(chain_residues) | set(c for c, _ in ligands):
+            residues = sorted(chain_residues[chain_id],
+             key=lambda r: descriptions.split_residue_id(r.id))
+            link_residues(residues)
+            model_chains[chain_id] = Chain(*residues, id=chain_id,
+             sequence=pdb["sequences"].get(chain_id, "").upper())
+        for chain_id, ligand in ligands:
+            ligand._chain = model_chains[chain_id]
+        models.append((code, Model(
+         *model_chains.values(), *[ligand for _, ligand in ligands]
+        )))
+    return sorted(models, key=lambda m: len(m[1].atoms()))
+
+
+def create_synthetic_group(pdb_count, seed=0):
+    """Creates the (classification, keywords, title) tuples of a group of PDBs.
+    As in the real data, a few common words recur in keywords and titles, but
+    most keywords (mutations, ligands and so on) are specific to one PDB."""
+
+    rng = random.Random(seed)
+    common = [
+     "ZINC", "FINGER", "PROTEASE", "HYDROLASE", "METALLOPROTEINASE", "DOMAIN",
+     "CARBONIC ANHYDRASE", "COMPLEX", "INHIBITOR", "BINDING", "TRANSCRIPTION",
+     "DNA", "CATALYTIC", "MUTANT", "HUMAN", "LYASE", "STRUCTURE"
+    ]
+    specific = lambda: rng.choice("ACDEFGHIKLMNPQRSTVWY") + str(
+     rng.randint(10, 400)
+    ) + rng.choice("ACDEFGHIKLMNPQRSTVWY")
+    group = []
+    for _ in range(pdb_count):
+        keywords = rng.sample(common, rng.randint(1, 3))
+        keywords += [specific() for _ in range(rng.randint(1, 4))]
+        if rng.random() < 0.3: keywords.append(str(rng.randint(1, 20)))
+        title = rng.sample(common, rng.randint(2, 5)) + [specific()]
+        rng.shuffle(title)
+        group.append((
+         rng.choice(["hydrolase", "lyase", "transcription"]),
+         ", ".join(keywords).lower(), " ".join(title)
+        ))
+    return group
+
+
+def find_liganding_atoms(model):
+    """Finds the liganding atoms of every metal in a model the optimised way,
+    as build.py does."""
+
+    index = sites.create_spatial_index(model)
+    metals = list(sites.remove_duplicate_atoms(model.atoms(is_metal=True)))
+    nearby = sites.get_nearby_atoms(index, metals, 3)
+    return {
+     m: sites.get_atom_liganding_atoms(m, n) for m, n in zip(metals, nearby)
+    }
+
+
+def create_merge_input(liganding, seed=0):
+    """Creates a list of single-metal sites from a metal: liganding atoms dict.
+    To give the merge some work, some metals also get one liganding atom of
+    another metal, as happens in multi-metal clusters."""
+
+    rng = random.Random(seed)
+    metals = sorted(liganding, key=lambda m: m.id)
+    site_list = []
+    for index, metal in enumerate(metals):
+        atoms = list(liganding[metal])
+        if index and rng.random() < 0.3 and liganding[metals[index - 1]]:
+            atoms.append(liganding[metals[index - 1]][0])
+        site_list.append({"metals": {metal: atoms}})
+    return site_list
+
+
+def get_sites(model, liganding):
+    """Turns a metal: liganding atoms dict into finished site dicts, the way
+    build.py does."""
+
+    metals = {m: atoms for m, atoms in liganding.items()}
+    sites.remove_salt_metals(metals)
+    site_list = [{"metals": {m: v}} for m, v in metals.items()]
+    sites.merge_metal_groups(site_list)
+    site_list.sort(key=lambda s: min(a.id for a in s["metals"].keys()))
+    for site in site_list:
+        site["residues"] = sites.get_site_residues(site)
+        site["chains"] = sites.get_site_chains(site)
+    return site_list
+
+
+def clear_alignment_cache():
+    """Empties the alignment cache, so that every timed run aligns afresh."""
+
+    chains.align_sequences.cache_clear()
+    return ()
+
+
+def time_function(function, setup=lambda: (), repeats=3):
+    """Runs a function several times, with fresh arguments from the setup
+    function each time, and returns the output and the fastest time."""
+
+    times = []
+    for _ in range(repeats):
+        args = setup()
+        start = time.perf_counter()
+        output = function(*args)
+        times.append(time.perf_counter() - start)
+    return output, min(times)
+
+
+def compare(benchmark, structure, size, reference, optimised, normalise,
+            repeats=3):
+    """Times a reference and an optimised implementation, each given as a
+    (function, setup) pair, and returns a result dict saying how long each
+    took and whether their normalised outputs are the same."""
+
+    reference_output, reference_time = time_function(*reference, repeats)
+    optimised_output, optimised_time = time_function(*optimised, repeats)
+    return {
+     "benchmark": benchmark, "structure": structure, "size": size,
+     "reference_seconds": reference_time, "optimised_seconds": optimised_time,
+     "speedup": reference_time / optimised_time if optimised_time else None,
+     "equivalent": normalise(reference_output) == normalise(optimised_output)
+    }
+
+
+def benchmark_model(structure, model, repeats=3):
+    """Runs every benchmark on a single model and returns a list of results."""
+
+    size = len(model.atoms())
+    ids = lambda atoms: [a.id for a in atoms]
+    metals = model.atoms(is_metal=True)
+    results = [compare(
+     "remove_duplicate_atoms", structure, size,
+     (reference_remove_duplicate_atoms, lambda: (metals,)),
+     (sites.remove_duplicate_atoms, lambda: (metals,)),
+     lambda atoms: sorted(ids(atoms)), repeats
+    )]
+
+    unique_metals = sorted(sites.remove_duplicate_atoms(metals), key=lambda m: m.id)
+    def reference_liganding():
+        model.optimise_distances()
+        return [reference_get_atom_liganding_atoms(m) for m in unique_metals]
+    def optimised_liganding():
+        index = sites.create_spatial_index(model)
+        nearby = sites.get_nearby_atoms(index, unique_metals, 3)
+        return [sites.get_atom_liganding_atoms(m, n)
+         for m, n in zip(unique_metals, nearby)]
+    results.append(compare(
+     "get_atom_liganding_atoms", structure, size,
+     (reference_liganding, lambda: ()), (optimised_liganding, lambda: ()),
+     lambda output: [ids(atoms) for atoms in output], repeats
+    ))
+
+    liganding = find_liganding_atoms(model)
+    results.append(compare(
+     "merge_metal_groups", structure, size,
+     (reference_merge_metal_groups, lambda: (create_merge_input(liganding),)),
+     (sites.merge_metal_groups, lambda: (create_merge_input(liganding),)),
+     lambda output: [sorted(ids(s["metals"])) for s in output], repeats
+    ))
+
+    site_list = get_sites(model, liganding)
+    model_chains = sorted(sites.get_site_chains({"residues": set().union(
+     *[s["residues"] for s in site_list]
+    )}), key=lambda c: c.id)
+    pairs = [("".join(r.code for r in chain), chain.sequence)
+     for chain in model_chains]
+    results.append(compare(
+     "align_sequences", structure, size,
+     (lambda: [reference_align_sequences(*p) for p in pairs], lambda: ()),
+     (lambda: [chains.align_sequences.__wrapped__(*p) for p in pairs],
+      lambda: ()), lambda output: output, repeats
+    ))
+
+    residues = set().union(*[s["residues"] for s in site_list])
+    results.append(compare(
+     "get_chain_sequence", structure, size,
+     (lambda: [reference_get_chain_sequence(c, residues)
+      for c in model_chains], lambda: ()),
+     (lambda: [chains.get_chain_sequence(c, residues) for c in model_chains],
+      clear_alignment_cache), lambda output: output, repeats
+    ))
+
+    def reference_describe():
+        model.optimise_distances()
+        return [descriptions.describe_site(site) for site in site_list]
+    def optimised_describe():
+        index = sites.create_spatial_index(model)
+        return [descriptions.describe_site(site, index) for site in site_list]
+    results.append(compare(
+     "describe_site", structure, size,
+     (reference_describe, clear_alignment_cache),
+     (optimised_describe, clear_alignment_cache),
+     lambda output: output, repeats
+    ))
+    return results
+
+
+def run_benchmarks(sizes=SYNTHETIC_SIZES, fixtures=True, repeats=3):
+    """Runs the benchmarks on synthetic models of the sizes given (in zinc
+    sites), and optionally on models rebuilt from the test fixtures, and
+    returns the results as a list of dicts. Group information is benchmarked
+    on synthetic groups of five PDBs per zinc site."""
+
+    results = []
+    for size in sizes:
+        model = create_synthetic_model(size)
+        results += benchmark_model(f"synthetic-{size}", model, repeats)
+    if fixtures:
+        for code, model in create_fixture_models():
+            results += benchmark_model(code, model, repeats)
+    for size in sizes:
+        group = create_synthetic_group(size * 5)
+        results.append(compare(
+         "get_group_information", f"group-{size * 5}", size * 5,
+         (reference_get_group_information, lambda: (group,)),
+         (sites.get_group_information, lambda: (group,)),
+         lambda output: output, repeats
+        ))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+     "--output", metavar="PATH", help="write the results to a JSON file"
+    )
+    parser.add_argument(
+     "--sizes", type=int, nargs="+", default=SYNTHETIC_SIZES, metavar="N",
+     help="numbers of zinc sites in the synthetic models"
+    )
+    parser.add_argument(
+     "--repeats", type=int, default=3, help="runs of each function to time"
+    )
+    parser.add_argument(
+     "--no-fixtures", action="store_true",
+     help="only benchmark the synthetic models"
+    )
+    args = parser.parse_args()
+    results = run_benchmarks(args.sizes, not args.no_fixtures, args.repeats)
+    for result in results:
+        print("{:26}{:16}{:>8} atoms {:10.4f}s {:10.4f}s {:>8}  {}".format(
+         result["benchmark"], result["structure"], result["size"],
+         result["reference_seconds"], result["optimised_seconds"],
+         "{:.1f}x".format(result["speedup"]) if result["speedup"] else "-",
+         "OK" if result["equivalent"] else "DIFFERENT"
+        ))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+             "created": datetime.now().isoformat(),
+             "python": platform.python_version(),
+             "atomium": atomium.__version__ if hasattr(atomium, "__version__") else None,
+             "platform": platform.platform(), "results": results
+            }, f, indent=1)
+    if not all(result["equivalent"] for result in results):
+        sys.exit("Some optimised functions gave different outputs")
+
+
+if __name__ == "__main__":
+    main()
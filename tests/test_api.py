@@ -1,5 +1,12 @@
+import os
+import json
+import time
+import tempfile
 import kirjava
-from django.test import LiveServerTestCase
+from unittest.mock import patch
+from django.conf import settings
+from django.test import LiveServerTestCase, TestCase, override_settings
+from core.models import Chain
 
 class ApiTest(LiveServerTestCase):
 
@@ -315,6 +322,334 @@ class ChainApiTests(ApiTest):
 
 
 
+class KmerSearchApiTests(ApiTest):
+
+    def test_can_search_chains_by_kmers(self):
+        data = self.client.execute("""{ kmerSearch(
+         sequence: "FVNQHLCGSHLVEALYLVCGERGFFYTPKT", limit: 6
+        ) { count edges { node { id sharedKmers chain { pdb { id } } }}}}""")
+        self.assertEqual(data, {"data": {"kmerSearch": {"count": 6, "edges": [
+         {"node": {"id": "1MSOB", "sharedKmers": 28, "chain": {"pdb": {"id": "1MSO"}}}},
+         {"node": {"id": "1MSOD", "sharedKmers": 28, "chain": {"pdb": {"id": "1MSO"}}}},
+         {"node": {"id": "1XDAF", "sharedKmers": 27, "chain": {"pdb": {"id": "1XDA"}}}},
+         {"node": {"id": "1XDAH", "sharedKmers": 27, "chain": {"pdb": {"id": "1XDA"}}}},
+         {"node": {"id": "1IZBB", "sharedKmers": 25, "chain": {"pdb": {"id": "1IZB"}}}},
+         {"node": {"id": "1IZBD", "sharedKmers": 25, "chain": {"pdb": {"id": "1IZB"}}}}
+        ]}}})
+    
+
+    def test_can_skip_kmer_hits(self):
+        data = self.client.execute("""{ kmerSearch(
+         sequence: "FVNQHLCGSHLVEALYLVCGERGFFYTPKT", limit: 2, skip: 2
+        ) { count edges { node { id }}}}""")
+        self.assertEqual(data, {"data": {"kmerSearch": {"count": 2, "edges": [
+         {"node": {"id": "1XDAF"}}, {"node": {"id": "1XDAH"}}
+        ]}}})
+    
+
+    def test_kmer_hit_chains_are_fetched_in_one_query(self):
+        from core.schema import create_kmer_hits
+        with self.assertNumQueries(1):
+            hits = create_kmer_hits([{"id": "1XDAF"}, {"id": "XXXXX"}])
+            self.assertEqual(hits[0].chain.pdb.id, "1XDA")
+        self.assertIsNone(hits[1].chain)
+    
+
+    def test_can_align_kmer_hits(self):
+        data = self.client.execute("""{ kmerSearch(
+         sequence: "AAFVNQHLCGSHLVEALYLVCGERGFFYTPK", limit: 1, align: true
+        ) { edges { node {
+         id identity queryFrom queryTo hitFrom hitTo qseq hseq midline
+        }}}}""")
+        self.assertEqual(data, {"data": {"kmerSearch": {"edges": [{"node": {
+         "id": "1MSOB", "identity": 29,
+         "queryFrom": 3, "queryTo": 31, "hitFrom": 1, "hitTo": 29,
+         "qseq": "FVNQHLCGSHLVEALYLVCGERGFFYTPK",
+         "hseq": "fvnqhlcgsHlvealylvcgergffytpk",
+         "midline": "FVNQHLCGSHLVEALYLVCGERGFFYTPK"
+        }}]}}})
+
+
+
+class BlastMocks:
+
+    def setUp(self):
+        super().setUp()
+        self.location = tempfile.TemporaryDirectory()
+        self.cache = os.path.join(self.location.name, "cache.sqlite3")
+        self.patch1 = override_settings(
+         BLAST_CACHE_LOCATION=self.cache,
+         BLAST_JOBS_LOCATION=os.path.join(self.location.name, "jobs.sqlite3")
+        )
+        self.patch2 = patch("core.models.subprocess.Popen")
+        self.patch3 = patch("core.blastcache.get_database_version")
+        self.patch1.enable()
+        self.mock_popen = self.patch2.start()
+        self.mock_version = self.patch3.start()
+        self.mock_version.return_value = "v1"
+        self.hit = hit = lambda id, evalue: {"description": [{
+         "id": f"gnl|BL_ORD_ID|{id}", "title": f"lcl|{id}"
+        }], "hsps": [{
+         "qseq": "FVNQ", "midline": "FVNQ", "hseq": "FVNQ", "bit_score": 10.0,
+         "evalue": evalue, "hit_from": 1, "hit_to": 4, "query_from": 1,
+         "query_to": 4, "identity": 4, "score": 20
+        }]}
+        self.mock_popen.return_value.communicate.return_value = (json.dumps({
+         "BlastOutput2": [{"report": {"results": {"search": {
+          "query_title": "query0", "hits": [hit("1XDAF", 0.01), hit("1IZBB", 0.001)]
+         }}}}]
+        }), b"")
+
+
+    def tearDown(self):
+        self.patch1.disable()
+        self.patch2.stop()
+        self.patch3.stop()
+        self.location.cleanup()
+
+
+
+class BlastSearchTests(BlastMocks, TestCase):
+
+    def test_blast_results_are_cached(self):
+        results = Chain.blast_search("fvnq", 0.1)
+        self.assertEqual([r["title"] for r in results], ["lcl|1IZBB", "lcl|1XDAF"])
+        self.assertEqual(Chain.blast_search(" FVNQ\n", 0.1), results)
+        self.assertEqual(self.mock_popen.call_count, 1)
+        Chain.blast_search("FVNQ", 1)
+        self.assertEqual(self.mock_popen.call_count, 2)
+
+
+    def test_blast_searches_can_be_batched(self):
+        report = lambda n, *hits: {"report": {"results": {"search": {
+         "query_title": f"query{n}", "hits": [self.hit(*hit) for hit in hits]
+        }}}}
+        self.mock_popen.return_value.communicate.return_value = (json.dumps({
+         "BlastOutput2": [
+          report(0, ("1XDAF", 0.01)), report(1), report(2, ("12CAA", 0.1))
+         ]
+        }), "")
+        results = Chain.blast_search_batch(["fvnq", "GGGG", "FVNQ", "MSHH"], 0.1)
+        self.assertEqual([[r["title"] for r in hits] for hits in results], [
+         ["lcl|1XDAF"], [], ["lcl|1XDAF"], ["lcl|12CAA"]
+        ])
+        self.assertEqual(self.mock_popen.call_count, 1)
+        self.assertIn("-num_threads", self.mock_popen.call_args[0][0])
+        self.assertEqual(
+         self.mock_popen.return_value.communicate.call_args[0][0],
+         ">query0\nFVNQ\n>query1\nGGGG\n>query2\nMSHH\n"
+        )
+        self.mock_popen.return_value.communicate.return_value = (json.dumps({
+         "BlastOutput2": [report(0, ("1IZBB", 0.01))]
+        }), "")
+        results = Chain.blast_search_batch(["MSHH", "HLCG"], 0.1)
+        self.assertEqual([[r["title"] for r in hits] for hits in results], [
+         ["lcl|12CAA"], ["lcl|1IZBB"]
+        ])
+        self.assertEqual(
+         self.mock_popen.return_value.communicate.call_args[0][0],
+         ">query0\nHLCG\n"
+        )
+
+
+    @patch("core.blastcache.get_database_location")
+    def test_blast_database_is_only_located_once(self, mock_location):
+        mock_location.return_value = "/blastdb/v2/chains.fasta"
+        Chain.blast_search_batch(["FVNQ"], 0.1)
+        mock_location.assert_called_once()
+        self.mock_version.assert_called_once_with("/blastdb/v2/chains.fasta")
+        args = self.mock_popen.call_args[0][0]
+        self.assertEqual(args[args.index("-db") + 1], "/blastdb/v2/chains.fasta")
+
+
+    def test_blast_reports_are_matched_to_queries_by_title(self):
+        report = lambda n, id: {"report": {"results": {"search": {
+         "query_title": f"query{n}", "hits": [self.hit(id, 0.01)]
+        }}}}
+        self.mock_popen.return_value.communicate.return_value = (json.dumps({
+         "BlastOutput2": [report(2, "12CAA"), report(0, "1XDAF")]
+        }), "")
+        results = Chain.blast_search_batch(["FVNQ", "GGGG", "MSHH"], 0.1)
+        self.assertEqual([[r["title"] for r in hits] for hits in results], [
+         ["lcl|1XDAF"], [], ["lcl|12CAA"]
+        ])
+        Chain.blast_search_batch(["FVNQ", "GGGG", "MSHH"], 0.1)
+        self.assertEqual(
+         self.mock_popen.return_value.communicate.call_args[0][0],
+         ">query0\nGGGG\n"
+        )
+
+
+    def test_invalid_blast_sequences_are_rejected(self):
+        for sequence in ["", "  \n", "FVNQ1", "FV>NQ"]:
+            with self.assertRaises(ValueError):
+                Chain.blast_search_batch(["FVNQ", sequence], 0.1)
+        self.assertEqual(self.mock_popen.call_count, 0)
+
+
+    def test_blast_cache_is_invalidated_by_new_database(self):
+        Chain.blast_search("FVNQ", 0.1)
+        self.mock_version.return_value = "v2"
+        Chain.blast_search("FVNQ", 0.1)
+        self.assertEqual(self.mock_popen.call_count, 2)
+        self.mock_version.return_value = "v1"
+        Chain.blast_search("FVNQ", 0.1)
+        self.assertEqual(self.mock_popen.call_count, 3)
+
+
+    def test_blast_cache_evicts_least_recently_used(self):
+        from core.blastcache import cache_results, get_cached_results
+        for sequence in ["A", "B", "C"]:
+            cache_results(self.cache, sequence, 0.1, "v1", ["x" * 40], max_size=100)
+            get_cached_results(self.cache, "A", 0.1, "v1")
+        self.assertIsNotNone(get_cached_results(self.cache, "A", 0.1, "v1"))
+        self.assertIsNone(get_cached_results(self.cache, "B", 0.1, "v1"))
+        self.assertIsNotNone(get_cached_results(self.cache, "C", 0.1, "v1"))
+
+
+
+class BlastApiTests(BlastMocks, ApiTest):
+
+    def tearDown(self):
+        from core import blastjobs
+        if blastjobs.EXECUTOR: blastjobs.EXECUTOR.shutdown()
+        blastjobs.EXECUTOR = None
+        super().tearDown()
+
+
+    def test_can_run_blast_job(self):
+        data = self.client.execute("""mutation { submitBlastJob(sequence: "FVNQ") {
+         job { id status }
+        }}""")
+        job = data["data"]["submitBlastJob"]["job"]
+        self.assertIn(job["status"], ["queued", "running", "complete"])
+        for _ in range(100):
+            data = self.client.execute("""{ blastJob(id: "%s") {
+             status results(skip: 1) { count edges { node { title chain { id }}}}
+            }}""" % job["id"])
+            if data["data"]["blastJob"]["status"] != "queued"\
+             and data["data"]["blastJob"]["status"] != "running": break
+            time.sleep(0.1)
+        self.assertEqual(data, {"data": {"blastJob": {"status": "complete", "results": {
+         "count": 1, "edges": [{"node": {"title": "lcl|1XDAF", "chain": {"id": "1XDAF"}}}]
+        }}}})
+
+
+    def test_blast_batches_are_limited(self):
+        with self.settings(BLAST_BATCH_LIMIT=1):
+            data = self.client.execute("""{ blastBatch(sequences: ["FVNQ", "HLCG"]) {
+             sequence
+            }}""")
+        self.assertIn("No more than 1", data["errors"][0]["message"])
+        self.assertEqual(self.mock_popen.call_count, 0)
+
+
+    def test_can_run_blast_batch(self):
+        data = self.client.execute("""{ blastBatch(sequences: ["FVNQ", "fvnq"]) {
+         sequence results { count edges { node { title chain { id }}}}
+        }}""")
+        results = {"count": 2, "edges": [
+         {"node": {"title": "lcl|1IZBB", "chain": {"id": "1IZBB"}}},
+         {"node": {"title": "lcl|1XDAF", "chain": {"id": "1XDAF"}}}
+        ]}
+        self.assertEqual(data, {"data": {"blastBatch": [
+         {"sequence": "FVNQ", "results": results},
+         {"sequence": "fvnq", "results": results}
+        ]}})
+
+
+    def test_blast_batch_chains_are_fetched_in_one_query(self):
+        from core.schema import schema
+        report = lambda n, *ids: {"report": {"results": {"search": {
+         "query_title": f"query{n}", "hits": [self.hit(id, 0.01) for id in ids]
+        }}}}
+        self.mock_popen.return_value.communicate.return_value = (json.dumps({
+         "BlastOutput2": [
+          report(0, "1XDAF", "1IZBB"), report(1, "1IZBB"), report(2, "1XDAF")
+         ]
+        }), "")
+        with self.assertNumQueries(1):
+            result = schema.execute("""{ blastBatch(sequences: ["FVNQ", "HLCG", "MSHH"]) {
+             results { edges { node { chain { id pdb { id } }}}}
+            }}""")
+        self.assertEqual([[edge["node"]["chain"]["id"] for edge in batch[
+         "results"
+        ]["edges"]] for batch in result.data["blastBatch"]], [
+         ["1XDAF", "1IZBB"], ["1IZBB"], ["1XDAF"]
+        ])
+
+
+    def test_blast_jobs_are_limited(self):
+        with self.settings(BLAST_JOB_QUEUE_LIMIT=0):
+            data = self.client.execute("""mutation { submitBlastJob(sequence: "FVNQ") {
+             job { id }
+            }}""")
+        self.assertIn("Too many BLAST jobs", data["errors"][0]["message"])
+        data = self.client.execute("""{ blastJob(id: "xxx") { status }}""")
+        self.assertEqual(data, {"data": {"blastJob": None}})
+
+
+    def test_blast_jobs_time_out_from_when_they_start(self):
+        from core.blastjobs import run_blast_job, update_blast_job, get_blast_job
+        from core.blastjobs import submit_blast_job
+        path = settings.BLAST_JOBS_LOCATION
+        with patch("core.blastjobs.get_executor"):
+            job = submit_blast_job("FVNQ", 0.1)
+        with patch("time.time", return_value=time.time() + 7200):
+            with patch("core.blastjobs.get_executor"):
+                submit_blast_job("FVNQ", 0.1)
+            self.assertEqual(get_blast_job(job["id"])["status"], "queued")
+            update_blast_job(path, job["id"], ["queued"], status="running", started=0)
+            with patch("core.blastjobs.get_executor"):
+                submit_blast_job("FVNQ", 0.1)
+        self.assertEqual(get_blast_job(job["id"])["status"], "failed")
+        self.assertFalse(update_blast_job(path, job["id"], ["running"], status="complete"))
+        run_blast_job(path, job["id"], "FVNQ", 0.1)
+        self.assertEqual(get_blast_job(job["id"])["status"], "failed")
+        self.assertEqual(self.mock_popen.call_count, 0)
+
+
+    def test_blast_jobs_of_stopped_workers_are_failed(self):
+        from core.blastjobs import update_blast_job, get_blast_job, submit_blast_job
+        path = settings.BLAST_JOBS_LOCATION
+        pid = os.fork()
+        if pid == 0: os._exit(0)
+        os.waitpid(pid, 0)
+        with self.settings(BLAST_JOB_QUEUE_LIMIT=2):
+            with patch("core.blastjobs.get_executor"):
+                jobs = [submit_blast_job("FVNQ", 0.1) for _ in range(2)]
+                update_blast_job(path, jobs[0]["id"], ["queued"], owner=pid)
+                job = submit_blast_job("FVNQ", 0.1)
+                with self.assertRaises(ValueError):
+                    submit_blast_job("FVNQ", 0.1)
+        self.assertEqual(get_blast_job(jobs[0]["id"])["status"], "failed")
+        self.assertEqual(get_blast_job(jobs[1]["id"])["status"], "queued")
+        self.assertEqual(get_blast_job(job["id"])["status"], "queued")
+
+
+    def test_can_limit_blast_hits(self):
+        data = self.client.execute("""{ blast(sequence: "FVNQ", limit: 1) {
+         count edges { node { title chain { id pdb { id } cluster { id }}}}
+        }}""")
+        self.assertEqual(data, {"data": {"blast": {"count": 1, "edges": [{"node": {
+         "title": "lcl|1IZBB", "chain": {
+          "id": "1IZBB", "pdb": {"id": "1IZB"}, "cluster": {"id": "1IZBB"}
+         }
+        }}]}}})
+
+
+    def test_blast_hit_chains_are_fetched_in_one_query(self):
+        from core.schema import create_blast_hits
+        results = Chain.blast_search("FVNQ", 0.1)
+        with self.assertNumQueries(1):
+            hits = create_blast_hits(results)
+            self.assertEqual(
+             [(hit.chain.id, hit.chain.pdb.id) for hit in hits],
+             [("1IZBB", "1IZB"), ("1XDAF", "1XDA")]
+            )
+
+
+
 class ChainInteractionApiTests(ApiTest):
     
     def test_can_get_chain_interaction(self):
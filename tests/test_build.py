@@ -1,11 +1,24 @@
 import sys; sys.path.append("build")
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import tempfile
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import HTTPServer, BaseHTTPRequestHandler
 from datetime import date
 from collections import Counter
 from unittest.mock import patch, Mock, MagicMock
-from django.test import LiveServerTestCase
-from core.models import Pdb, Chain, ZincSite, ChainCluster, Group
+from django.test import LiveServerTestCase, TestCase
+from django.db import transaction, connection
+from core.models import Pdb, Chain, ZincSite, ChainCluster, Group, Metal, BuildState
+from core.models import BuildQueueEntry
 from build.build import main as build_main
 from build.cluster import main as cluster_main
+from tests.benchmarks import run_benchmarks
+from utilities import get_zinc_pdb_codes, get_saved_zinc_pdb_codes
 
 class DatabaseBuildingTests(LiveServerTestCase):
 
@@ -14,11 +27,14 @@ class DatabaseBuildingTests(LiveServerTestCase):
         self.patch2 = patch("builtins.print")
         self.patch3 = patch("build.build.tqdm")
         self.patch4 = patch("build.build.log")
+        self.patch5 = patch("build.build.get_pdb_revisions")
         self.mock_codes = self.patch1.start()
         self.mock_print = self.patch2.start()
         self.mock_tqdm = self.patch3.start()
         self.mock_log = self.patch4.start()
+        self.mock_revisions = self.patch5.start()
         self.mock_tqdm.side_effect = lambda l: l
+        self.mock_revisions.return_value = {}
 
 
     def tearDown(self):
@@ -26,6 +42,7 @@ class DatabaseBuildingTests(LiveServerTestCase):
         self.patch2.stop()
         self.patch3.stop()
         self.patch4.stop()
+        self.patch5.stop()
 
 
     def check_print_statement(self, fragment):
@@ -43,6 +60,50 @@ class DatabaseBuildingTests(LiveServerTestCase):
         self.check_print_statement("1 of these need to be checked")
 
 
+    def test_can_build_with_multiple_workers(self):
+        self.mock_codes.return_value = ["6EQU", "1B0N", "XXXX"]
+        build_main(workers=2)
+        self.assertEqual(Pdb.objects.count(), 2)
+        pdb = Pdb.objects.get(id="1B0N")
+        self.assertEqual(pdb.chain_set.count(), 2)
+        site = pdb.zincsite_set.get(id="1B0N-1")
+        self.assertEqual(site.chaininteraction_set.count(), 2)
+        self.check_print_statement("XXXX")
+
+
+    @patch("build.build.describe_pdb_code")
+    def test_dead_workers_are_recorded_as_unprocessable(self, mock_describe):
+        from build.build import describe_pdb_codes
+        mock_describe.side_effect = lambda code, *args, **kwargs: (
+         os._exit(1) if code == "DEAD" else {"pdb": {"id": code}}
+        )
+        results = list(describe_pdb_codes(
+         [(code, None, None) for code in ["1ABC", "DEAD", "2ABC", "3ABC"]], 2
+        ))
+        self.assertEqual([r[0] for r in results], ["1ABC", "DEAD", "2ABC", "3ABC"])
+        self.assertEqual(results[0], ("1ABC", {"pdb": {"id": "1ABC"}}, None))
+        self.assertIsNone(results[1][1])
+        self.assertIn("died", results[1][2])
+        self.assertEqual(results[3], ("3ABC", {"pdb": {"id": "3ABC"}}, None))
+
+
+    def test_can_build_with_bulk_inserts(self):
+        self.mock_codes.return_value = ["6EQU", "1B0N"]
+        build_main(bulk=2, defer_indexes=True)
+        self.assertEqual(Pdb.objects.count(), 2)
+        site = ZincSite.objects.get(id="6EQU-1")
+        self.assertEqual(site.residue_set.filter(primary=True).count(), 4)
+        metal = site.metal_set.first()
+        self.assertEqual(metal.atomium_id, 2133)
+        bonds = metal.coordinatebond_set.all()
+        self.assertEqual(bonds.count(), 5)
+        bound_res_ids = Counter([b.atom.residue.atomium_id for b in bonds])
+        self.assertEqual(bound_res_ids, {"A.94": 1, "A.96": 1, "A.119": 1, "A.302": 2})
+        pdb = Pdb.objects.get(id="1B0N")
+        chain_a = pdb.chain_set.get(atomium_id="A")
+        self.assertEqual(len([r for r in chain_a.sequence if r.isupper()]), 7)
+
+
     def test_can_get_best_model(self):
         self.mock_codes.return_value = ["1B21"]
         build_main()
@@ -270,3 +331,790 @@ class DatabaseClusteringTests(LiveServerTestCase):
         dehydro_sites = dehydro.zincsite_set.all()
         self.assertEqual(dehydro_sites.count(), 4)
 
+    
+
+    @patch("builtins.print")
+    @patch("build.cluster.tqdm")
+    @patch("build.sites.tqdm")
+    def test_can_cluster_incrementally(self, mock_tqdm1, mock_tqdm2, mock_print):
+        mock_tqdm1.side_effect = lambda l: l
+        mock_tqdm2.side_effect = lambda l: l
+        cluster_main()
+        get_state = lambda: (
+         set(Chain.objects.values_list("id", "cluster")),
+         set(ZincSite.objects.values_list("id", "group", "representative")),
+         set(Group.objects.values_list("id", "keywords", "classifications"))
+        )
+        state = get_state()
+
+        # Nothing has changed
+        cluster_main(incremental=True)
+        self.assertEqual(get_state(), state)
+        mock_print.assert_any_call("0 chains need clustering (0 clusters broken up)")
+
+        # A PDB has been rebuilt
+        Chain.objects.filter(pdb="1MSO").update(cluster=None)
+        ZincSite.objects.filter(pdb="1MSO").update(group=None, representative=False)
+        cluster_main(incremental=True)
+        self.assertEqual(get_state(), state)
+        mock_print.assert_any_call("2 chains joined existing clusters")
+
+        # A PDB with cluster and group representatives has been rebuilt
+        Chain.objects.filter(pdb="1IZB").update(cluster=None)
+        ZincSite.objects.filter(pdb="1IZB").update(group=None, representative=False)
+        cluster_main(incremental=True)
+        self.assertEqual(get_state(), state)
+        mock_print.assert_any_call("6 chains need clustering (1 clusters broken up)")
+
+
+    @patch("builtins.print")
+    def test_can_cluster_with_multiple_workers(self, mock_print):
+        cluster_main()
+        groups = set(Group.objects.values_list("id", "keywords", "classifications"))
+        cluster_main(workers=2)
+        self.assertEqual(set(Group.objects.values_list(
+         "id", "keywords", "classifications"
+        )), groups)
+        self.assertEqual(
+         Group.objects.get(id="1IZB-1").classifications,
+         "HORMONE, HORMONE/GROWTH FACTOR"
+        )
+
+
+    def test_titles_are_searched_with_index(self):
+        from sites import index_titles, count_titles_containing
+        titles = [
+         "CARBONIC ANHYDRASE II", "ZINC FINGER PROTEIN", "ZINC-FINGER",
+         "CRYSTAL STRUCTURE OF CARBONIC ANHYDRASE", "INSULIN HEXAMER"
+        ]
+        index = index_titles(titles)
+        for text in ["", "Z", "IN", "ZINC", "NHYDRASE", "IC ANHYD", "RYSTAL ",
+         " OF CARBONIC ANH", "ZINC-FINGER PROTEIN", "HEXAMERS"]:
+            self.assertEqual(
+             count_titles_containing(text, titles, index),
+             sum(text in title for title in titles), text
+            )
+
+
+    def test_chain_clusters_are_saved_in_bulk(self):
+        from factories import create_chain_cluster_records
+        dates = dict(Chain.objects.values_list("id", "pdb__deposition_date"))
+        clusters = [["1BNTA", "12CAA", "1G48A"], ["5Y5BA"], ["6ISOA"]]
+        with transaction.atomic(), self.assertNumQueries(4):
+            create_chain_cluster_records(clusters, dates, batch_size=2)
+        self.assertEqual(
+         set(ChainCluster.objects.values_list("id", flat=True)),
+         {"12CAA", "5Y5BA", "6ISOA"}
+        )
+        self.assertEqual(set(Chain.objects.filter(
+         cluster="12CAA"
+        ).values_list("id", flat=True)), {"1BNTA", "12CAA", "1G48A"})
+
+
+    def test_sites_are_fingerprinted_in_chunks(self):
+        from sites import add_fingerprints_to_sites
+        ChainCluster.objects.create(id="1IZBB")
+        Chain.objects.filter(pdb__in=["1IZB", "1XDA"]).update(cluster="1IZBB")
+        with self.assertNumQueries(2):
+            sites = list(add_fingerprints_to_sites(ZincSite.objects.all()))
+        self.assertEqual(len(sites), 19)
+        fingerprints = {site.id: site.fingerprint for site in sites}
+        self.assertEqual(fingerprints["1IZB-1"], fingerprints["1XDA-1"])
+        self.assertTrue(fingerprints["1IZB-1"].startswith("1IZBB__"))
+        with self.assertNumQueries(5):
+            sites = list(add_fingerprints_to_sites(ZincSite.objects.all(), 5))
+        self.assertEqual({site.id: site.fingerprint for site in sites}, fingerprints)
+        with patch.object(connection.features, "max_query_params", 4):
+            with self.assertNumQueries(8):
+                sites = list(add_fingerprints_to_sites(ZincSite.objects.all(), 5))
+        self.assertEqual({site.id: site.fingerprint for site in sites}, fingerprints)
+
+
+
+class BenchmarkTests(TestCase):
+
+    def test_optimised_functions_match_references(self):
+        results = run_benchmarks(sizes=[3, 10], repeats=1)
+        self.assertEqual(len(set(r["benchmark"] for r in results)), 7)
+        for result in results:
+            self.assertTrue(result["equivalent"], result)
+
+
+
+MINIMAL_CIF = """data_1ABC
+_entry.id 1ABC
+_struct.title "TEST STRUCTURE"
+#
+loop_
+_pdbx_audit_revision_history.ordinal
+_pdbx_audit_revision_history.revision_date
+1 2019-01-01
+2 2020-05-06
+#
+loop_
+_entity.id
+_entity.type
+1 polymer
+2 non-polymer
+#
+loop_
+_entity_poly_seq.entity_id
+_entity_poly_seq.num
+_entity_poly_seq.mon_id
+1 1 GLY
+#
+loop_
+_struct_asym.id
+_struct_asym.entity_id
+A 1
+B 2
+#
+loop_
+_atom_site.group_PDB
+_atom_site.id
+_atom_site.type_symbol
+_atom_site.label_atom_id
+_atom_site.label_alt_id
+_atom_site.label_comp_id
+_atom_site.label_asym_id
+_atom_site.label_entity_id
+_atom_site.label_seq_id
+_atom_site.pdbx_PDB_ins_code
+_atom_site.Cartn_x
+_atom_site.Cartn_y
+_atom_site.Cartn_z
+_atom_site.occupancy
+_atom_site.B_iso_or_equiv
+_atom_site.pdbx_formal_charge
+_atom_site.auth_seq_id
+_atom_site.auth_comp_id
+_atom_site.auth_asym_id
+_atom_site.auth_atom_id
+_atom_site.pdbx_PDB_model_num
+ATOM 1 N N . GLY A 1 1 ? 0 0 0 1 0 0 1 GLY A N 1
+ATOM 2 C CA . GLY A 1 1 ? 1 0 0 1 0 0 1 GLY A CA 1
+HETATM 3 ZN ZN . ZN B 2 . ? 1 2 3 1 0 0 100 ZN A ZN 1
+"""
+
+class StructureCacheTests(TestCase):
+
+    def setUp(self):
+        self.location = tempfile.TemporaryDirectory()
+        self.patch1 = patch("cache.CACHE_LOCATION", self.location.name)
+        self.patch2 = patch("cache.requests.get")
+        self.patch1.start()
+        self.mock_get = self.patch2.start()
+        self.mock_get.return_value = Mock(status_code=200, text=MINIMAL_CIF)
+
+
+    def tearDown(self):
+        self.patch1.stop()
+        self.patch2.stop()
+        self.location.cleanup()
+
+
+    def test_structures_are_only_downloaded_once(self):
+        from cache import fetch_structure
+        pdb, status = fetch_structure("1ABC")
+        self.assertEqual(status, "miss")
+        self.assertEqual(pdb.title, "TEST STRUCTURE")
+        pdb, status = fetch_structure("1ABC", offline=True)
+        self.assertEqual(status, "hit")
+        self.assertEqual(pdb.model.atom(element="ZN").location, (1, 2, 3))
+        self.assertEqual(self.mock_get.call_count, 1)
+
+
+    def test_other_revisions_are_downloaded_again(self):
+        from cache import fetch_structure, get_cache_entry
+        fetch_structure("1ABC")
+        self.assertEqual(get_cache_entry("1ABC")["revision"], "2020-05-06")
+        fetch_structure("1ABC", revision="2020-05-06")
+        self.assertEqual(self.mock_get.call_count, 1)
+        fetch_structure("1ABC", revision="2021-01-01")
+        self.assertEqual(self.mock_get.call_count, 2)
+        self.assertEqual(get_cache_entry("1ABC")["revision"], "2021-01-01")
+
+
+    def test_offline_misses_raise_errors(self):
+        from cache import fetch_structure
+        with self.assertRaises(ValueError):
+            fetch_structure("1ABC", offline=True)
+        self.assertFalse(self.mock_get.called)
+
+
+    def test_can_evict_structures(self):
+        from cache import fetch_structure, evict_structures, get_cached_codes
+        from cache import get_cache_entry, save_cache_entry
+        fetch_structure("1ABC")
+        fetch_structure("2ABC")
+        entry = get_cache_entry("1ABC")
+        entry["used"] = time.time() - 10 * 86400
+        save_cache_entry(entry)
+        self.assertEqual(evict_structures(max_age=5), 1)
+        self.assertEqual(get_cached_codes(), ["2ABC"])
+        self.assertEqual(evict_structures(max_size=0), 1)
+        self.assertEqual(get_cached_codes(), [])
+        self.assertEqual(os.listdir(os.path.join(self.location.name, "objects")), [])
+
+
+
+class SequenceDatabaseTests(TestCase):
+
+    fixtures = ["pre-cluster.json"]
+
+    def setUp(self):
+        self.location = tempfile.TemporaryDirectory()
+        self.blast = os.path.join(self.location.name, "blastdb")
+        self.patch1 = patch("build.make_sequencedb.BLAST_LOCATION", self.blast)
+        self.patch2 = patch("build.make_sequencedb.KMER_INDEX_LOCATION", os.path.join(
+         self.location.name, "chains.kmers.npz"
+        ))
+        self.patch3 = patch("build.make_sequencedb.subprocess.run")
+        self.patch4 = patch("builtins.print")
+        self.patch1.start()
+        self.patch2.start()
+        self.mock_run = self.patch3.start()
+        self.patch4.start()
+
+
+    def tearDown(self):
+        self.patch1.stop()
+        self.patch2.stop()
+        self.patch3.stop()
+        self.patch4.stop()
+        self.location.cleanup()
+
+
+    def test_chains_fasta_is_streamed(self):
+        from chains import get_all_chains_fasta, save_all_chains_fasta
+        fasta = get_all_chains_fasta()
+        self.assertEqual(fasta.count(">lcl|"), 15)
+        self.assertTrue(fasta.startswith(">lcl|12CAA\nmshhwgygkhngpehwhkdfpiakg"))
+        self.assertEqual(max(len(line) for line in fasta.split("\n")), 80)
+        path = os.path.join(self.location.name, "chains.fasta")
+        digest = save_all_chains_fasta(path)
+        with open(path) as f: self.assertEqual(f.read(), fasta)
+        self.assertEqual(digest, hashlib.sha256(fasta.encode()).hexdigest())
+
+
+    def test_blast_database_is_only_rebuilt_when_chains_change(self):
+        from build.make_sequencedb import main, get_current_version
+        main()
+        self.assertEqual(self.mock_run.call_count, 1)
+        version = get_current_version()
+        current = os.path.join(self.blast, "current", "chains.fasta")
+        self.assertTrue(os.path.exists(current))
+        main()
+        self.assertEqual(self.mock_run.call_count, 1)
+        self.assertEqual(get_current_version(), version)
+        Chain.objects.filter(id="6ISOA").update(sequence="mkv")
+        main()
+        self.assertEqual(self.mock_run.call_count, 2)
+        self.assertNotEqual(get_current_version(), version)
+        self.assertNotEqual(get_current_version().split("-")[0], version.split("-")[0])
+        with open(current) as f: self.assertIn(">lcl|6ISOA\nmkv", f.read())
+        self.assertEqual(sorted(os.listdir(self.blast)), sorted([
+         "current", version, get_current_version()
+        ]))
+
+
+    def test_blast_searches_fall_back_to_old_database(self):
+        from core.blastcache import get_database_location, get_database_version
+        root = self.location.name
+        self.assertEqual(
+         get_database_location(root), os.path.join(root, "data", "chains.fasta")
+        )
+        self.assertIsNone(get_database_version(get_database_location(root)))
+        os.makedirs(os.path.join(root, "data", "blastdb", "v1"))
+        os.symlink("v1", os.path.join(root, "data", "blastdb", "current"))
+        self.assertEqual(get_database_location(root), os.path.join(
+         os.path.realpath(root), "data", "blastdb", "v1", "chains.fasta"
+        ))
+
+
+    def test_blast_database_version_is_where_the_link_pointed(self):
+        from core.blastcache import get_database_location, get_database_version
+        blastdb = os.path.join(self.location.name, "data", "blastdb")
+        for version in ["v1", "v2"]: os.makedirs(os.path.join(blastdb, version))
+        os.symlink("v1", os.path.join(blastdb, "current"))
+        location = get_database_location(self.location.name)
+        os.remove(os.path.join(blastdb, "current"))
+        os.symlink("v2", os.path.join(blastdb, "current"))
+        self.assertEqual(get_database_version(location), "v1")
+        self.assertEqual(
+         get_database_version(get_database_location(self.location.name)), "v2"
+        )
+
+
+
+class DatabaseSnapshotTests(TestCase):
+
+    def setUp(self):
+        self.location = tempfile.TemporaryDirectory()
+        self.live, self.shadow, self.previous = [os.path.join(
+         self.location.name, f"{name}.sqlite3"
+        ) for name in ["live", "shadow", "previous"]]
+        self.write(self.live, "old")
+
+
+    def tearDown(self):
+        self.location.cleanup()
+
+
+    def write(self, path, value):
+        connection = sqlite3.connect(path)
+        with connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS t (value TEXT)")
+            connection.execute("DELETE FROM t")
+            connection.execute("INSERT INTO t VALUES (?)", [value])
+        connection.close()
+
+
+    def read(self, path):
+        connection = sqlite3.connect(f"file:{path}?mode=ro&immutable=1", uri=True)
+        value = connection.execute("SELECT value FROM t").fetchone()[0]
+        connection.close()
+        return value
+
+
+    def test_shadow_can_be_promoted_and_rolled_back(self):
+        from snapshot import prepare_shadow, promote_shadow, roll_back
+        self.assertTrue(prepare_shadow(self.live, self.shadow))
+        self.assertFalse(prepare_shadow(self.live, self.shadow))
+        self.write(self.shadow, "new")
+        reader = sqlite3.connect(f"file:{self.live}?mode=ro&immutable=1", uri=True)
+        self.assertEqual(self.read(self.live), "old")
+        promote_shadow(self.shadow, self.live, self.previous)
+        self.assertEqual(self.read(self.live), "new")
+        self.assertEqual(self.read(self.previous), "old")
+        self.assertFalse(os.path.exists(self.shadow))
+        self.assertEqual(reader.execute("SELECT value FROM t").fetchone()[0], "old")
+        reader.close()
+        roll_back(self.live, self.previous)
+        self.assertEqual(self.read(self.live), "old")
+        self.assertEqual(self.read(self.previous), "new")
+        roll_back(self.live, self.previous)
+        self.assertEqual(self.read(self.live), "new")
+
+
+    def test_unfinished_shadow_is_not_promoted(self):
+        from snapshot import prepare_shadow, promote_shadow
+        prepare_shadow(self.live, self.shadow)
+        open(self.shadow + "-journal", "w").close()
+        with self.assertRaises(ValueError):
+            promote_shadow(self.shadow, self.live, self.previous)
+        with self.assertRaises(FileNotFoundError):
+            promote_shadow(self.previous, self.live, self.shadow)
+        self.assertEqual(self.read(self.live), "old")
+
+
+
+class StructureServer(BaseHTTPRequestHandler):
+
+    requests = []
+    content = MINIMAL_CIF
+    codes = []
+    failing_pages = set()
+    empty_pages = set()
+    other_structures = set()
+
+    def do_GET(self):
+        StructureServer.requests.append(self.path)
+        if self.path.startswith("/search"):
+            query = json.loads(parse_qs(urlparse(self.path).query)["json"][0])
+            pager = query["request_options"]["pager"]
+            if pager["start"] in StructureServer.failing_pages:
+                self.send_response(500)
+                self.end_headers()
+                return
+            if not StructureServer.codes:
+                self.send_response(204)
+                self.end_headers()
+                return
+            codes = StructureServer.codes[pager["start"]:pager["start"] + pager["rows"]]
+            if pager["start"] in StructureServer.empty_pages: codes = []
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(json.dumps({
+             "total_count": len(StructureServer.codes),
+             "result_set": [{"identifier": code} for code in codes]
+            }).encode())
+        elif self.path == "/flaky.cif" and StructureServer.requests.count(self.path) < 3:
+            self.send_response(500)
+            self.end_headers()
+        elif self.path in ("/1abc.cif", "/flaky.cif"):
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(StructureServer.content.encode())
+        elif self.path[1:5].upper() in StructureServer.other_structures:
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(StructureServer.content.replace(
+             "1ABC", self.path[1:5].upper()
+            ).encode())
+        else:
+            self.send_response(404)
+            self.end_headers()
+    
+
+    def log_message(self, *args): pass
+
+
+
+class StructureServerTestCase(LiveServerTestCase):
+
+    def setUp(self):
+        StructureServer.requests = []
+        StructureServer.content = MINIMAL_CIF
+        StructureServer.codes = [f"{n}ABC" for n in range(1, 26)]
+        StructureServer.failing_pages = set()
+        StructureServer.empty_pages = set()
+        StructureServer.other_structures = set()
+        self.server = HTTPServer(("127.0.0.1", 0), StructureServer)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}/{{}}.cif"
+        self.search_url = f"http://127.0.0.1:{self.server.server_port}/search"
+
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+
+
+class ZincCodeListingTests(StructureServerTestCase):
+
+    def setUp(self):
+        StructureServerTestCase.setUp(self)
+        self.directory = tempfile.TemporaryDirectory()
+        self.location = os.path.join(self.directory.name, "zinc_codes.json")
+        self.patch1 = patch("utilities.SEARCH_URL", self.search_url)
+        self.patch2 = patch("utilities.ZINC_CODES_LOCATION", self.location)
+        self.patch1.start()
+        self.patch2.start()
+
+
+    def tearDown(self):
+        self.patch1.stop()
+        self.patch2.stop()
+        self.directory.cleanup()
+        StructureServerTestCase.tearDown(self)
+
+
+    def test_codes_are_fetched_in_pages(self):
+        codes = get_zinc_pdb_codes(page_size=10)
+        self.assertEqual(codes, StructureServer.codes)
+        self.assertEqual(len(StructureServer.requests), 3)
+        self.assertEqual(get_saved_zinc_pdb_codes(), StructureServer.codes)
+        self.assertFalse(os.path.exists(self.location + ".checkpoint"))
+    
+
+    def test_interrupted_listing_can_resume(self):
+        StructureServer.failing_pages = {10}
+        with self.assertRaises(Exception):
+            get_zinc_pdb_codes(page_size=10, retries=1, backoff=0)
+        self.assertEqual(len(StructureServer.requests), 3)
+        self.assertIsNone(get_saved_zinc_pdb_codes())
+        StructureServer.failing_pages = set()
+        codes = get_zinc_pdb_codes(page_size=10)
+        self.assertEqual(codes, StructureServer.codes)
+        self.assertEqual(len(StructureServer.requests), 5)
+    
+
+    def test_empty_listings_are_not_saved(self):
+        StructureServer.empty_pages = {10}
+        with self.assertRaises(Exception):
+            get_zinc_pdb_codes(page_size=10, retries=1, backoff=0)
+        self.assertEqual(len(StructureServer.requests), 3)
+        self.assertIsNone(get_saved_zinc_pdb_codes())
+        StructureServer.codes = []
+        with self.assertRaises(Exception):
+            get_zinc_pdb_codes(page_size=10, retries=0)
+        self.assertIsNone(get_saved_zinc_pdb_codes())
+    
+
+    def test_short_listings_are_not_saved(self):
+        StructureServer.codes = [f"{n % 20}ABC" for n in range(1, 26)]
+        with self.assertRaises(Exception):
+            get_zinc_pdb_codes(page_size=10)
+        self.assertIsNone(get_saved_zinc_pdb_codes())
+        self.assertFalse(os.path.exists(self.location + ".checkpoint"))
+    
+
+    def test_old_checkpoints_are_ignored(self):
+        StructureServer.failing_pages = {10}
+        with self.assertRaises(Exception):
+            get_zinc_pdb_codes(page_size=10, retries=0)
+        StructureServer.failing_pages = set()
+        with patch("time.time", return_value=time.time() + 100000):
+            codes = get_zinc_pdb_codes(page_size=10)
+        self.assertEqual(codes, StructureServer.codes)
+        self.assertEqual(len(StructureServer.requests), 5)
+
+
+
+class StructurePrefetchingTests(StructureServerTestCase):
+
+    def test_can_prefetch_structures_in_order(self):
+        from prefetch import prefetch_structures
+        results = list(prefetch_structures(
+         ["1ABC", "2ABC", "FLAKY", "3ABC"], concurrency=2, queue_size=2,
+         backoff=0, url=self.url, skip=lambda code: code == "3ABC"
+        ))
+        self.assertEqual([r[0] for r in results], ["1ABC", "2ABC", "FLAKY", "3ABC"])
+        self.assertEqual(results[0], ("1ABC", MINIMAL_CIF, None))
+        self.assertIsNone(results[1][1])
+        self.assertIn("404", results[1][2])
+        self.assertEqual(results[2], ("FLAKY", MINIMAL_CIF, None))
+        self.assertEqual(results[3], ("3ABC", None, None))
+        self.assertEqual(StructureServer.requests.count("/flaky.cif"), 3)
+        self.assertEqual(StructureServer.requests.count("/2abc.cif"), 1)
+    
+
+    def test_can_give_up_after_retries(self):
+        from prefetch import prefetch_structures
+        results = list(prefetch_structures(
+         ["FLAKY"], retries=1, backoff=0, url=self.url
+        ))
+        self.assertIn("500", results[0][2])
+    
+
+    @patch("build.build.get_zinc_pdb_codes")
+    @patch("build.build.get_pdb_revisions")
+    @patch("build.build.log")
+    @patch("builtins.print")
+    def test_can_build_from_prefetched_structures(self, mock_print, mock_log, mock_revisions, mock_codes):
+        mock_codes.return_value = ["1ABC", "2ABC"]
+        mock_revisions.return_value = {}
+        with patch("cache.STRUCTURE_URL", self.url):
+            build_main(prefetch=2)
+        self.assertEqual(Pdb.objects.count(), 1)
+        pdb = Pdb.objects.get(id="1ABC")
+        self.assertEqual(pdb.title, "TEST STRUCTURE")
+        self.assertIn("side chain", pdb.metal_set.first().omission_reason)
+
+
+
+class IncrementalBuildingTests(StructureServerTestCase):
+
+    def setUp(self):
+        StructureServerTestCase.setUp(self)
+        self.patch1 = patch("build.build.get_zinc_pdb_codes")
+        self.patch2 = patch("build.build.get_pdb_revisions")
+        self.patch3 = patch("build.build.log")
+        self.patch4 = patch("builtins.print")
+        self.patch5 = patch("cache.STRUCTURE_URL", self.url)
+        self.mock_codes = self.patch1.start()
+        self.mock_revisions = self.patch2.start()
+        self.patch3.start()
+        self.mock_print = self.patch4.start()
+        self.patch5.start()
+        self.mock_codes.return_value = ["1ABC"]
+        self.mock_revisions.return_value = {"1ABC": "2020-05-06"}
+
+
+    def tearDown(self):
+        for patcher in (self.patch1, self.patch2, self.patch3, self.patch4, self.patch5):
+            patcher.stop()
+        StructureServerTestCase.tearDown(self)
+
+
+    def test_dead_workers_dont_lose_uncommitted_pdbs(self):
+        from build import build
+        describe = build.describe_pdb_code
+        def describe_or_die(code, *args, **kwargs):
+            if code == "DEAD":
+                time.sleep(1)
+                os._exit(1)
+            return describe(code, *args, **kwargs)
+        StructureServer.other_structures = {"2ABC", "DEAD"}
+        self.mock_codes.return_value = ["1ABC", "DEAD", "2ABC"]
+        close_all = lambda: self.assertFalse(connection.in_atomic_block)
+        with patch("build.build.describe_pdb_code", side_effect=describe_or_die):
+            with patch("build.build.connections.close_all", side_effect=close_all):
+                build_main(workers=2, prefetch=1, commit_every=10)
+        self.assertEqual(
+         list(Pdb.objects.values_list("id", flat=True)), ["1ABC", "2ABC"]
+        )
+        self.assertEqual(BuildQueueEntry.objects.get(id="DEAD").status, "failed")
+
+
+    def test_build_state_is_recorded(self):
+        build_main(prefetch=1)
+        state = BuildState.objects.get(id="1ABC")
+        self.assertEqual(state.revision, "2020-05-06")
+        self.assertEqual(len(state.content_hash), 64)
+
+
+    def test_unrevised_pdbs_are_not_checked(self):
+        build_main(prefetch=1)
+        build_main(prefetch=1)
+        self.assertEqual(StructureServer.requests, ["/1abc.cif"])
+    
+
+    def test_revised_pdbs_with_new_content_are_replaced(self):
+        build_main(prefetch=1)
+        metal_id = Metal.objects.get().id
+        self.mock_revisions.return_value = {"1ABC": "2021-01-01"}
+        StructureServer.content = MINIMAL_CIF.replace("1 2 3 1 0 0 100", "4 5 6 1 0 0 100")
+        build_main(prefetch=1)
+        self.assertEqual(Pdb.objects.count(), 1)
+        metal = Metal.objects.get()
+        self.assertNotEqual(metal.id, metal_id)
+        self.assertEqual((metal.x, metal.y, metal.z), (4, 5, 6))
+        self.assertEqual(BuildState.objects.get(id="1ABC").revision, "2021-01-01")
+    
+
+    def test_revised_pdbs_with_same_content_are_kept(self):
+        build_main(prefetch=1)
+        metal_id = Metal.objects.get().id
+        self.mock_revisions.return_value = {"1ABC": "2021-01-01"}
+        build_main(prefetch=1)
+        self.assertEqual(len(StructureServer.requests), 2)
+        self.assertEqual(Metal.objects.get().id, metal_id)
+        self.assertEqual(BuildState.objects.get(id="1ABC").revision, "2021-01-01")
+    
+
+    def test_obsolete_pdbs_are_removed(self):
+        build_main(prefetch=1)
+        self.mock_codes.return_value = ["2ABC"]
+        build_main(prefetch=1)
+        self.assertEqual(Pdb.objects.count(), 0)
+        self.assertEqual(Metal.objects.count(), 0)
+        self.assertEqual(BuildState.objects.count(), 0)
+    
+
+    def test_obsolete_pdbs_are_kept_if_list_is_too_short(self):
+        StructureServer.other_structures = {"2ABC"}
+        self.mock_codes.return_value = ["1ABC", "2ABC"]
+        build_main(prefetch=1)
+        self.mock_codes.return_value = ["2ABC"]
+        build_main(prefetch=1)
+        self.assertEqual(Pdb.objects.count(), 2)
+        self.assertTrue(any(
+         "--force-prune" in call[0][0] for call in self.mock_print.call_args_list
+        ))
+        build_main(prefetch=1, force_prune=True)
+        self.assertEqual(list(Pdb.objects.values_list("id", flat=True)), ["2ABC"])
+        self.mock_codes.return_value = []
+        build_main(prefetch=1)
+        self.assertEqual(Pdb.objects.count(), 1)
+    
+
+    def test_pdbs_built_before_states_are_adopted(self):
+        for code in ["1ABC", "2ABC", "3ABC"]:
+            Pdb.objects.create(id=code, skeleton=False)
+        self.mock_codes.return_value = ["1ABC", "2ABC", "3ABC"]
+        self.mock_revisions.return_value = {
+         "1ABC": "2020-05-06", "2ABC": "2020-05-07", "3ABC": "2020-05-08"
+        }
+        with patch.object(BuildState.objects, "update_or_create") as mock_update:
+            build_main(prefetch=1)
+        self.assertFalse(mock_update.called)
+        self.assertEqual(StructureServer.requests, [])
+        self.assertEqual(dict(BuildState.objects.values_list("id", "revision")), {
+         "1ABC": "2020-05-06", "2ABC": "2020-05-07", "3ABC": "2020-05-08"
+        })
+    
+
+    @patch("utilities.requests.post")
+    def test_revision_requests_time_out(self, mock_post):
+        from utilities import get_pdb_revisions
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.json.return_value = {"data": {"entries": [
+         {"rcsb_id": "1ABC", "rcsb_accession_info": {"revision_date": "2020-05-06T00:00:00"}}
+        ]}}
+        self.assertEqual(get_pdb_revisions(["1ABC"]), {"1ABC": "2020-05-06"})
+        self.assertEqual(mock_post.call_args[1]["timeout"], 120)
+    
+
+    def test_offline_builds_use_saved_code_list(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with patch("cache.CACHE_LOCATION", directory):
+                build_main(cache=True)
+                Pdb.objects.all().delete()
+                BuildState.objects.all().delete()
+                with patch("build.build.get_saved_zinc_pdb_codes") as mock_saved:
+                    mock_saved.return_value = ["2ABC", "1ABC"]
+                    build_main(offline=True)
+        self.assertEqual(Pdb.objects.get().id, "1ABC")
+        self.mock_print.assert_any_call("There are 1 PDB codes with zinc")
+    
+
+    def test_can_commit_several_pdbs_at_once(self):
+        from build.build import save_pdb_description
+        def save(description):
+            save_pdb_description(description)
+            if description["pdb"]["id"] == "2ABC": raise ValueError("Bad PDB")
+        StructureServer.other_structures = {"2ABC", "3ABC", "4ABC"}
+        self.mock_codes.return_value = ["1ABC", "2ABC", "3ABC", "4ABC"]
+        with patch("build.build.save_pdb_description", side_effect=save):
+            build_main(prefetch=1, commit_every=3)
+        self.assertEqual(
+         set(Pdb.objects.values_list("id", flat=True)), {"1ABC", "3ABC", "4ABC"}
+        )
+        self.assertEqual(BuildState.objects.count(), 3)
+        self.assertTrue(any(call[0][0].startswith("2ABC\n")
+         for call in self.mock_print.call_args_list if call[0]))
+    
+
+    def test_failed_pdbs_are_backed_off(self):
+        self.mock_codes.return_value = ["1ABC", "2ABC"]
+        build_main(prefetch=1)
+        entry = BuildQueueEntry.objects.get(id="2ABC")
+        self.assertEqual((entry.status, entry.attempts), ("failed", 1))
+        self.assertIn("404", entry.error)
+        self.assertEqual(BuildQueueEntry.objects.get(id="1ABC").status, "done")
+        build_main(prefetch=1)
+        self.mock_print.assert_any_call("Skipping 1 PDBs which failed recently")
+        self.assertEqual(StructureServer.requests.count("/2abc.cif"), 1)
+        BuildQueueEntry.objects.update(retry_after=entry.updated)
+        build_main(prefetch=1)
+        entry = BuildQueueEntry.objects.get(id="2ABC")
+        self.assertEqual((entry.status, entry.attempts), ("failed", 2))
+        self.assertEqual(StructureServer.requests.count("/2abc.cif"), 2)
+        self.mock_revisions.return_value = {"1ABC": "2020-05-06", "2ABC": "2021-01-01"}
+        build_main(prefetch=1)
+        self.assertEqual(BuildQueueEntry.objects.get(id="2ABC").attempts, 1)
+    
+
+    def test_interrupted_builds_resume(self):
+        from build.build import save_pdb_description
+        def save(description):
+            if description["pdb"]["id"] == "2ABC": raise KeyboardInterrupt
+            save_pdb_description(description)
+        StructureServer.other_structures = {"2ABC", "3ABC"}
+        self.mock_codes.return_value = ["1ABC", "2ABC", "3ABC"]
+        with patch("build.build.save_pdb_description", side_effect=save):
+            with self.assertRaises(KeyboardInterrupt):
+                build_main(prefetch=1)
+        self.assertEqual(BuildQueueEntry.objects.get(id="1ABC").status, "done")
+        self.assertEqual(BuildQueueEntry.objects.get(id="2ABC").status, "in_progress")
+        build_main(prefetch=1)
+        self.mock_print.assert_any_call("Resuming 1 PDBs from an interrupted build")
+        self.assertEqual(Pdb.objects.count(), 3)
+        self.assertEqual(StructureServer.requests.count("/1abc.cif"), 1)
+        self.assertEqual(set(BuildQueueEntry.objects.values_list("status", flat=True)), {"done"})
+    
+
+    def test_can_profile_build(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "profile.jsonl")
+            build_main(prefetch=1, profile=path)
+            with open(path) as f: profiles = [json.loads(line) for line in f]
+            self.assertGreaterEqual(profiles[0]["peak_memory"], 0)
+            self.assertFalse(profiles[0]["traced"])
+            Pdb.objects.all().delete()
+            BuildState.objects.all().delete()
+            os.remove(path)
+            build_main(prefetch=1, profile=path, trace_memory=True)
+            with open(path) as f: profiles = [json.loads(line) for line in f]
+        self.assertEqual(len(profiles), 1)
+        self.assertEqual(profiles[0]["code"], "1ABC")
+        self.assertEqual(set(profiles[0]["stages"]), {"fetch", "assembly", "write"})
+        self.assertGreater(profiles[0]["peak_memory"], 0)
+        self.assertTrue(profiles[0]["traced"])
+        self.assertAlmostEqual(profiles[0]["total"], sum(profiles[0]["stages"].values()))
+        self.mock_print.assert_any_call(f"Stage timings written to {path}")